@@ -48,8 +48,22 @@ The final function, net_cdf_updater() is used to dump the optical parameters and
 metadata into a netcdf file and save it into the working directory to be used as
 a lookup library for the two-stream radiative transfer model BoSNICAR_GO.
 
-The function calls are provided at the bottom of this script in a loop, where the
-user can define the range of side lengths and depths to be looped over.
+build_go_library() generates the library for a grid of side lengths and depths
+incrementally. A manifest (ice_XXX_manifest.json) records the parameters of
+every entry and a hash of the refractive index it was calculated with, so only
+entries that are missing or stale (new grid points, a changed refractive index,
+density or GO_VERSION) are calculated, in batches spread across a process pool.
+All entries are consolidated in one file per refractive index source
+(ice_XXX_library.nc, dimensions entry x wvl), and the new entries are also
+written as the individual files read by BioSNICAR_GO. Running this script
+builds the default grid:
+
+    python Geometric_Optics_Ice.py
+
+or from python:
+
+    build_go_library(savepath, datapath, RIsource=2, side_lengths=np.arange(2000, 11000, 500),
+        depths=np.arange(2000, 31000, 500), processes=8)
 
 NOTE: The extinction coefficient in the current implementation is 2 for all size parameters 
 as assumed in the conventional geometric optics approximation.
@@ -62,10 +76,9 @@ calculate_optical_params() and netcdf_updater()
 
 """
 
+import json
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import interpolate
-import pandas as pd
 import xarray as xr
 
 # Set paths
@@ -73,6 +86,13 @@ savepath = '/home/joe/Code/BioSNICAR_GO_PY/Data/GO_files/480band/'
 datapath = '/home/joe/Code/BioSNICAR_GO_PY/Data/rfidx_ice.nc'
 RIsource = 2
 
+# version of calc_optical_params(); increment it when the calculation changes
+# so that build_go_library() recomputes every entry
+GO_VERSION = 1
+
+# refractive index of this worker process (set by init_go_worker())
+worker_RI = None
+
 def preprocess_RI(RIsource, datapath):
 
     """
@@ -263,6 +283,7 @@ def calc_optical_params(side_length,depth,reals,imags,wavelengths,plots=False,re
 
 
     if plots:
+        import matplotlib.pyplot as plt
         plt.figure(1)    
         plt.plot(wavelengths,SSA_list),plt.ylabel('SSA'),plt.xlabel('Wavelength (um)'),plt.grid(b=None)
         plt.figure(2)
@@ -279,12 +300,13 @@ def calc_optical_params(side_length,depth,reals,imags,wavelengths,plots=False,re
     return Assy_list,SSA_list,MAC_list,depth,side_length, diameter
 
 
-def net_cdf_updater(RIsource,savepath, Assy_list, SSA_list, MAC_list, depth, side_length, density):
+def go_file_stems(RIsource):
 
-    filepathIN = savepath
-    MAC_IN = np.squeeze(MAC_list)
-    SSA_IN = np.squeeze(SSA_list)
-    Assy_IN = np.squeeze(Assy_list)
+    """
+    returns the subdirectory and file name prefix of the files of a refractive
+    index source (0 = Warren 1984, 1 = Warren 2008, 2 = Picard 2016)
+
+    """
 
     if RIsource == 0:
         stb1 = 'ice_Wrn84/'
@@ -298,11 +320,22 @@ def net_cdf_updater(RIsource,savepath, Assy_list, SSA_list, MAC_list, depth, sid
         stb1 = 'ice_Pic16/'
         stb2 = 'ice_Pic16_'
 
-    icefile = pd.DataFrame()
-    icefile['asm_prm'] = Assy_IN
-    icefile['ss_alb'] = SSA_IN
-    icefile['ext_cff_mss'] = MAC_IN
-    icefile = icefile.to_xarray()
+    return stb1, stb2
+
+
+def net_cdf_updater(RIsource,savepath, Assy_list, SSA_list, MAC_list, depth, side_length, density):
+
+    filepathIN = savepath
+    MAC_IN = np.squeeze(MAC_list)
+    SSA_IN = np.squeeze(SSA_list)
+    Assy_IN = np.squeeze(Assy_list)
+
+    stb1, stb2 = go_file_stems(RIsource)
+
+    # same layout as the former pandas DataFrame.to_xarray() files
+    index = np.arange(len(MAC_IN))
+    icefile = xr.Dataset({'asm_prm': ('index', Assy_IN), 'ss_alb': ('index', SSA_IN),\
+        'ext_cff_mss': ('index', MAC_IN)}, coords={'index': index})
     icefile.attrs['medium_type'] = 'air'
     icefile.attrs['description'] = 'Optical properties for ice grain: hexagonal column of side length {}um and length {}um'.format(
         str(side_length), str(depth))
@@ -315,16 +348,185 @@ def net_cdf_updater(RIsource,savepath, Assy_list, SSA_list, MAC_list, depth, sid
 
     return 
 
-###############################################################################
-##########################  FUNCTON CALLS ####################################
 
-reals,imags,wavelengths = preprocess_RI(RIsource,datapath)
+def refractive_index_hash(reals, imags, wavelengths):
 
-for side_length in np.arange(2000,11000,1000):
-    for depth in np.arange(2000,31000,1000):
-        
-        Assy_list, SSA_list, MAC_list, depth, side_length, diameter =\
-            calc_optical_params(side_length,depth, reals,imags,wavelengths,plots=False,
-            report_dims = True)
-        
-        net_cdf_updater(RIsource, savepath,Assy_list,SSA_list,MAC_list, depth, side_length, 917)
+    """
+    hash of the refractive index and GO_VERSION, recorded in the manifest for
+    every entry so that entries calculated with other data are rebuilt
+
+    """
+
+    import hashlib
+
+    digest = hashlib.sha1(str(GO_VERSION).encode())
+    for values in (reals, imags, wavelengths):
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+
+    return digest.hexdigest()
+
+
+def go_library_paths(savepath, RIsource):
+
+    """
+    returns the paths of the consolidated library and the manifest of a
+    refractive index source
+
+    """
+
+    stb1, stb2 = go_file_stems(RIsource)
+
+    return savepath + stb1 + stb2 + 'library.nc', savepath + stb1 + stb2 + 'manifest.json'
+
+
+def load_go_library(savepath, RIsource=2):
+
+    """
+    returns the consolidated library as an xarray Dataset (asm_prm, ss_alb and
+    ext_cff_mss with dimensions entry x wvl, and side_length and depth for
+    every entry), or None if it has not been built
+
+    """
+
+    library_path = go_library_paths(savepath, RIsource)[0]
+
+    if not os.path.exists(library_path):
+        return None
+
+    with xr.open_dataset(library_path) as library:
+        return library.load()
+
+
+def init_go_worker(reals, imags, wavelengths):
+
+    global worker_RI
+
+    worker_RI = (reals, imags, wavelengths)
+
+    return
+
+
+def calc_optical_batch(entries, RI=None):
+
+    """
+    optical properties of a batch of (side_length, depth) entries.
+    returns the entries and arrays (entries, wvl) of asm_prm, ss_alb and
+    ext_cff_mss
+
+    """
+
+    reals, imags, wavelengths = worker_RI if RI is None else RI
+
+    results = [calc_optical_params(side_length, depth, reals, imags, wavelengths)[:3]\
+        for side_length, depth in entries]
+    Assy, SSA, MAC = (np.array(values, dtype=float) for values in zip(*results))
+
+    return entries, Assy, SSA, MAC
+
+
+def build_go_library(savepath, datapath, RIsource=2, side_lengths=np.arange(2000, 11000, 1000),\
+    depths=np.arange(2000, 31000, 1000), density=917, processes=None, batch_size=16, write_files=True):
+
+    """
+    calculates the entries of the grid side_lengths x depths (microns) that are
+    missing from the manifest, were calculated with a different refractive
+    index, density or GO_VERSION, or (if write_files) whose individual file is
+    missing. Batches of batch_size entries are calculated in a process pool of
+    processes workers (serially if processes is 1). The consolidated library
+    (existing entries of any grid plus the new ones, sorted by side length and
+    depth) and then the manifest are rewritten once at the end, and if
+    write_files the new entries are written as individual files with
+    net_cdf_updater().
+    returns the number of entries calculated
+
+    """
+
+    import multiprocessing
+
+    reals, imags, wavelengths = preprocess_RI(RIsource, datapath)
+    RI_hash = refractive_index_hash(reals, imags, wavelengths)
+
+    stb1, stb2 = go_file_stems(RIsource)
+    os.makedirs(savepath + stb1, exist_ok=True)
+    library_path, manifest_path = go_library_paths(savepath, RIsource)
+
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    library = load_go_library(savepath, RIsource)
+    stored = set() if library is None else set(zip(library['side_length'].values.tolist(),\
+        library['depth'].values.tolist()))
+
+    def current(side_length, depth):
+        record = manifest.get('{}_{}'.format(side_length, depth))
+        if record is None or record['RI_hash'] != RI_hash or record['density'] != density:
+            return False
+        if (side_length, depth) not in stored:
+            return False
+        return not write_files or os.path.exists(savepath + stb1 + stb2 + '{}_{}.nc'.format(side_length, depth))
+
+    entries = [(int(side_length), int(depth)) for side_length in side_lengths for depth in depths]
+    todo = [entry for entry in entries if not current(*entry)]
+
+    print("{} of {} entries up to date, calculating {}".format(len(entries)-len(todo), len(entries), len(todo)))
+
+    if len(todo) == 0:
+        return 0
+
+    batches = [todo[start:start+batch_size] for start in np.arange(0, len(todo), batch_size)]
+
+    if processes == 1:
+        results = [calc_optical_batch(batch, (reals, imags, wavelengths)) for batch in batches]
+    else:
+        with multiprocessing.Pool(processes, initializer=init_go_worker, initargs=(reals, imags, wavelengths)) as pool:
+            results = pool.map(calc_optical_batch, batches, chunksize=1)
+
+    new = {}
+    for batch, Assy, SSA, MAC in results:
+        for k, entry in enumerate(batch):
+            new[entry] = (Assy[k], SSA[k], MAC[k])
+
+    # consolidate the kept entries of the old library with the new ones
+    rows = {}
+    if library is not None:
+        for k, entry in enumerate(zip(library['side_length'].values.tolist(), library['depth'].values.tolist())):
+            if entry not in new:
+                rows[entry] = (library['asm_prm'].values[k], library['ss_alb'].values[k], library['ext_cff_mss'].values[k])
+    rows.update(new)
+
+    keys = sorted(rows)
+    Assy, SSA, MAC = (np.array(values) for values in zip(*[rows[key] for key in keys]))
+
+    consolidated = xr.Dataset({'asm_prm': (('entry', 'wvl'), Assy), 'ss_alb': (('entry', 'wvl'), SSA),\
+        'ext_cff_mss': (('entry', 'wvl'), MAC)}, coords={'wvl': wavelengths,\
+        'side_length': ('entry', np.array([key[0] for key in keys])), 'depth': ('entry', np.array([key[1] for key in keys]))})
+    consolidated.attrs['medium_type'] = 'air'
+    consolidated.attrs['psd'] = 'monodisperse'
+    consolidated.attrs['RIsource'] = RIsource
+    consolidated.attrs['origin'] = 'Optical properties derived from geometrical optics calculations'
+
+    # written to a temporary file and renamed, so an interrupted build leaves
+    # the previous library and manifest in place
+    consolidated.to_netcdf(library_path + '.tmp')
+    os.replace(library_path + '.tmp', library_path)
+
+    if write_files:
+        for (side_length, depth), (Assy_list, SSA_list, MAC_list) in new.items():
+            net_cdf_updater(RIsource, savepath, Assy_list, SSA_list, MAC_list, depth, side_length, density)
+
+    for side_length, depth in new:
+        manifest['{}_{}'.format(side_length, depth)] = dict(side_length=side_length, depth=depth, density=density,\
+            RI_hash=RI_hash, GO_VERSION=GO_VERSION)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return len(new)
+
+
+if __name__ == '__main__':
+
+    build_go_library(savepath, datapath, RIsource)
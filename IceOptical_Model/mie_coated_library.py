@@ -0,0 +1,228 @@
+"""
+Precomputed library of the optical properties of ice spheres coated with liquid water.
+
+Wet-snow layers (rwater > grain_rds) used to run the coated-sphere Mie code
+(mie_coated_water_spheres.miecoated_driver()) for every layer of every call to
+snicar_feeder, because unlike the dry ice Mie and GO files there was no
+tabulated library. build_coated_library() runs the calculation once for every
+node of a grid of ice core radius (rice), outer radius of the coated sphere
+(rwater) and refractive index of ice (rf_ice) in a process pool, and writes the
+single scattering albedo, asymmetry parameter and mass cross sections of all
+nodes to one netCDF file indexed by those three coordinates:
+
+    Data/Mie_files/480band/coated_spheres/mie_coated_library.nc
+    ssa, asymmetry, extinction/scattering/absorption_mass_cross_section
+    dimensions (rf_ice, rice, rwater, wvl)
+
+Nodes with rwater <= rice have no coating and are evaluated with a negligible
+one (the limit of an uncoated grain), so that grain sizes just below the first
+coated node can still be interpolated. The coated sphere calculation is
+occasionally unstable at large size parameters (ssa above 1 in the NIR), so
+bands where a node has an unphysical ssa or asymmetry parameter are stored as
+nan and interpolated from the remaining nodes.
+
+coated_sphere_optics() interpolates the library bilinearly in rice and rwater.
+The variables are read once per process through
+optical_library.read_optical_variable(), so pools with an attached shared
+optical library (the file matches DEFAULT_PATTERNS) share a single copy.
+get_ice_optics() in SNICAR_feeder.py uses the library when it exists and covers
+the layer, and otherwise falls back to miecoated_driver(), so wet-snow columns
+cost about the same as dry ones at run time.
+
+usage:
+
+    build_coated_library(dir_base, rice=np.arange(50, 2001, 50), rwater=np.arange(50, 2501, 50), processes=8)
+    optics = coated_sphere_optics(dir_base + LIBRARY_FILE, rf_ice=2, rice=500, rwater=560)
+    optics['ssa'], optics['asymmetry']
+
+"""
+
+import os
+import numpy as np
+
+# library path relative to dir_base
+LIBRARY_FILE = 'Data/Mie_files/480band/coated_spheres/mie_coated_library.nc'
+
+# outputs of miecoated_driver() stored in the library
+VARIABLES = ('ssa', 'asymmetry', 'extinction_mass_cross_section', 'scattering_mass_cross_section',\
+    'absorption_mass_cross_section')
+
+# refractive indices of this worker process, {rf_ice: read_refractive_indices()}
+# (set by init_coated_worker())
+worker_refractive_index = None
+
+# library variables read in this process, {(path, var): array}
+loaded = {}
+
+
+def init_coated_worker(refractive_index):
+
+    global worker_refractive_index
+
+    worker_refractive_index = refractive_index
+
+    return
+
+
+def coated_sphere_node(rf_ice, rice, rwater, wvl, refractive_index=None):
+
+    """
+    returns the VARIABLES (len(VARIABLES), wvl) of one node of the library,
+    calculated with miecoated_driver(), with nan in bands where the ssa or
+    asymmetry parameter is unphysical. Nodes without a coating are evaluated
+    with a negligible one.
+
+    """
+
+    from IceOptical_Model.mie_coated_water_spheres import miecoated_driver
+
+    refractive_index = worker_refractive_index[rf_ice] if refractive_index is None else refractive_index
+    rwater = max(rwater, rice*(1+1e-6))
+
+    res = miecoated_driver(rice=rice, rwater=rwater, fn_ice=None, rf_ice=rf_ice, fn_water=None, wvl=wvl,\
+        refractive_index=refractive_index, progress=False)
+
+    values = np.array([res[var] for var in VARIABLES], dtype=float)
+
+    # the coated sphere recurrences are occasionally unstable at large size
+    # parameters; bands with an unphysical ssa or asymmetry are left out
+    invalid = ~np.all(np.isfinite(values), axis=0) | (res['ssa'] < 0) | (res['ssa'] > 1)\
+        | (np.abs(res['asymmetry']) > 1)
+    values[:, invalid] = np.nan
+
+    return values
+
+
+def build_coated_library(dir_base, rice=np.arange(50, 2001, 50), rwater=np.arange(50, 2501, 50), rf_ice=(0, 1, 2),\
+    processes=None, path=None):
+
+    """
+    calculates every node of the grid rf_ice x rice x rwater (radii in
+    microns) on the wavelengths of the optical property files, in a process
+    pool of processes workers (serially if processes is 1), and writes the
+    library to path (default dir_base + LIBRARY_FILE).
+    returns the path
+
+    """
+
+    import multiprocessing
+    import xarray as xr
+    from IceOptical_Model.mie_coated_water_spheres import read_refractive_indices
+    from optical_library import read_optical_variable
+
+    path = dir_base + LIBRARY_FILE if path is None else path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    rice = np.sort(np.asarray(rice, dtype=float))
+    rwater = np.sort(np.asarray(rwater, dtype=float))
+    rf_ice = [int(rf) for rf in rf_ice]
+
+    wvl = np.array(read_optical_variable(dir_base + 'Data/Mie_files/480band/lap/dust_greenland_Cook_LOW_20190911.nc',\
+        'wvl'))*1e6
+
+    refractive_index = {rf: read_refractive_indices(dir_base + 'Data/rfidx_ice.nc', rf,\
+        dir_base + 'Data/Refractive_Index_Liquid_Water_Segelstein_1981.csv', wvl) for rf in rf_ice}
+
+    tasks = [(rf, ri, rw, wvl) for rf in rf_ice for ri in rice for rw in rwater]
+
+    print("calculating {} coated sphere nodes".format(len(tasks)))
+
+    if processes == 1:
+        results = [coated_sphere_node(*task, refractive_index=refractive_index[task[0]]) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer=init_coated_worker, initargs=(refractive_index,)) as pool:
+            results = pool.starmap(coated_sphere_node, tasks, chunksize=1)
+
+    # (rf_ice, rice, rwater, variable, wvl)
+    values = np.array(results).reshape(len(rf_ice), len(rice), len(rwater), len(VARIABLES), len(wvl))
+
+    invalid = np.isnan(values[:, :, :, 0])
+    if np.any(invalid):
+        print("WARNING: {} nodes have unphysical values in some bands ({} node-bands in total), which are left out"\
+            " of the interpolation".format(np.sum(np.any(invalid, axis=-1)), np.sum(invalid)))
+
+    library = xr.Dataset({var: (('rf_ice', 'rice', 'rwater', 'wvl'), values[:, :, :, k]) for k, var in enumerate(VARIABLES)},\
+        coords={'rf_ice': rf_ice, 'rice': rice, 'rwater': rwater, 'wvl': wvl})
+    library.attrs['description'] = 'Optical properties of ice spheres of radius rice coated with liquid water to'\
+        ' radius rwater (microns), calculated with miecoated_driver()'
+
+    # written to a temporary file and renamed, so readers never see a partial library
+    library.to_netcdf(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+def library_variable(path, var):
+
+    if (path, var) not in loaded:
+
+        from optical_library import read_optical_variable
+
+        loaded[(path, var)] = read_optical_variable(path, var)
+
+    return loaded[(path, var)]
+
+
+def interpolation_weights(grid, value):
+
+    """
+    returns the indices of the nodes of the sorted grid either side of value
+    and the weight of the upper one, or None if value is outside the grid
+
+    """
+
+    if value < grid[0] or value > grid[-1]:
+        return None
+
+    if len(grid) == 1:
+        return 0, 0, 0.0
+
+    upper = min(max(int(np.searchsorted(grid, value)), 1), len(grid)-1)
+    lower = upper - 1
+
+    return lower, upper, float((value - grid[lower])/(grid[upper] - grid[lower]))
+
+
+def coated_sphere_optics(path, rf_ice, rice, rwater, variables=('ssa', 'asymmetry')):
+
+    """
+    returns {var: spectrum} of the coated sphere rice, rwater (microns) with
+    refractive index rf_ice, interpolated bilinearly from the library at path,
+    or None if there is no library at path, it does not cover rf_ice, rice and
+    rwater, or a band has no valid node to interpolate from
+
+    """
+
+    if (path, 'rice') not in loaded and not os.path.exists(path):
+        return None
+
+    rf_grid = library_variable(path, 'rf_ice')
+    if rf_ice not in rf_grid:
+        return None
+
+    rice_weights = interpolation_weights(library_variable(path, 'rice'), rice)
+    rwater_weights = interpolation_weights(library_variable(path, 'rwater'), rwater)
+    if rice_weights is None or rwater_weights is None:
+        return None
+
+    k = int(np.nonzero(rf_grid == rf_ice)[0][0])
+    i0, i1, wi = rice_weights
+    j0, j1, wj = rwater_weights
+
+    corners = ([i0, i0, i1, i1], [j0, j1, j0, j1])
+    weights = np.array([(1-wi)*(1-wj), (1-wi)*wj, wi*(1-wj), wi*wj])[:, np.newaxis]
+
+    # in each band, only the corners with valid (not nan) values are weighted
+    valid = (weights > 0) & ~np.isnan(library_variable(path, 'ssa')[k][corners])
+    weights = weights*valid
+    total = np.sum(weights, axis=0)
+    if np.any(total == 0):
+        return None
+
+    optics = {}
+    for var in variables:
+        values = library_variable(path, var)[k][corners]
+        optics[var] = np.sum(weights*np.where(valid, values, 0), axis=0)/total
+
+    return optics
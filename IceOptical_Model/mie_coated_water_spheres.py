@@ -163,7 +163,49 @@ def miecoated(m1, m2, x, y):
         return qext, qsca, qabs, qb, asy, qratio
 
 
-def miecoated_driver(rice, rwater, fn_ice, rf_ice, fn_water, wvl):
+def read_refractive_indices(fn_ice, rf_ice, fn_water, wvl):
+    """Reads the refractive index of ice and liquid water for miecoated_driver().
+
+    :param fn_ice:   path to netcdf file containing refractive index of ice
+    :param rf_ice:   refractive index of ice: 0 = Warren 1984, 1 = Warren 2008, 2 = Picard 2016
+    :param fn_water: path to csv file containing refractive index of liquid water (Segelstein, 1981)
+    :param wvl:      wavelengths (in microns)
+    :return:         real and imaginary parts of the refractive index of ice and of liquid water interpolated to wvl
+    """
+
+    temp = xr.open_dataset(fn_ice)
+    ref_index_ice = np.zeros(shape=(2,len(wvl)))
+    wvl_ice = temp['wvl'].values
+
+    if rf_ice == 0:
+        n_ice = temp['re_Wrn84'].values
+        k_ice = temp['im_Wrn84'].values
+
+    if rf_ice == 1:
+        n_ice = temp['re_Wrn08'].values
+        k_ice = temp['im_Wrn08'].values
+
+    if rf_ice == 2:
+        n_ice = temp['re_Pic16'].values
+        k_ice = temp['im_Pic16'].values
+
+    ref_index_water = pd.read_csv(fn_water)
+    wvl_water = np.zeros(ref_index_water.shape[0])
+    n_water = np.zeros(ref_index_water.shape[0])
+    k_water = np.zeros(ref_index_water.shape[0])
+
+    for ii in range(ref_index_water.shape[0]):
+        wvl_water[ii] = ref_index_water.at[ii, 'wl']
+        n_water[ii] = ref_index_water.at[ii, 'n']
+        k_water[ii] = ref_index_water.at[ii, 'k']
+
+    n_water_interp = np.interp(x=wvl, xp=wvl_water, fp=n_water)
+    k_water_interp = np.interp(x=wvl, xp=wvl_water, fp=k_water)
+
+    return n_ice, k_ice, n_water_interp, k_water_interp
+
+
+def miecoated_driver(rice, rwater, fn_ice, rf_ice, fn_water, wvl, refractive_index=None, progress=True):
     """Driver for miecoated, originally written by Christian Matzler (see Matzler, 2002). The driver convolves the
        efficiency factors with the particle dimensions to return the cross sections for extinction, scattering and
        absorption plus the asymmetry parameter, q ratio and single scattering albedo.
@@ -178,6 +220,8 @@ def miecoated_driver(rice, rwater, fn_ice, rf_ice, fn_water, wvl):
     :param fn_ice:   path to csv file containing refractive index of ice (Warren, 1984)
     :param fn_water: path to csv file containing refractive index of liquid water (Segelstein, 1981)
     :param wvl:      wavelength which should be calculated (in microns)
+    :param refractive_index: optional output of read_refractive_indices(), to avoid reading the files again
+    :param progress: show a progress bar over the wavelengths
     :return:         cross sections for extinction, scattering and absorption plus the asymmetry parameter, q ratio and
                      single scattering albedo
     """
@@ -206,35 +250,10 @@ def miecoated_driver(rice, rwater, fn_ice, rf_ice, fn_water, wvl):
     TotalMass = IceMass + WatMass
 
     # read in refractive indices of ice and liquid water
-    
-    temp = xr.open_dataset(fn_ice)
-    ref_index_ice = np.zeros(shape=(2,len(wvl)))
-    wvl_ice = temp['wvl'].values
-
-    if rf_ice == 0:
-        n_ice = temp['re_Wrn84'].values
-        k_ice = temp['im_Wrn84'].values
-
-    if rf_ice == 1:
-        n_ice = temp['re_Wrn08'].values
-        k_ice = temp['im_Wrn08'].values
+    if refractive_index is None:
+        refractive_index = read_refractive_indices(fn_ice, rf_ice, fn_water, wvl)
 
-    if rf_ice == 2:
-        n_ice = temp['re_Pic16'].values
-        k_ice = temp['im_Pic16'].values
-
-    ref_index_water = pd.read_csv(fn_water)
-    wvl_water = np.zeros(ref_index_water.shape[0])
-    n_water = np.zeros(ref_index_water.shape[0])
-    k_water = np.zeros(ref_index_water.shape[0])
-
-    for ii in range(ref_index_water.shape[0]):
-        wvl_water[ii] = ref_index_water.at[ii, 'wl']
-        n_water[ii] = ref_index_water.at[ii, 'n']
-        k_water[ii] = ref_index_water.at[ii, 'k']
-
-    n_water_interp = np.interp(x=wvl, xp=wvl_water, fp=n_water)
-    k_water_interp = np.interp(x=wvl, xp=wvl_water, fp=k_water)
+    n_ice, k_ice, n_water_interp, k_water_interp = refractive_index
 
     extinction = np.zeros(len(wvl))
     scattering = np.zeros(len(wvl))
@@ -244,7 +263,7 @@ def miecoated_driver(rice, rwater, fn_ice, rf_ice, fn_water, wvl):
     q_ratio = np.zeros(len(wvl))
     ssa = np.zeros(len(wvl))
 
-    for ii in tqdm(range(len(wvl))):
+    for ii in (tqdm(range(len(wvl))) if progress else range(len(wvl))):
         # size parameters for inner and outer spheres
         x = 2 * np.pi * rice / (wvl[ii])
         y = 2 * np.pi * rwater / (wvl[ii])
@@ -1,11 +1,11 @@
-from SNICAR_feeder import snicar_feeder
-import matplotlib.pyplot as plt
-from sklearn.preprocessing import PolynomialFeatures
-import statsmodels.api as sm  
+# only numpy and the standard library are imported at module level. pandas and
+# statsmodels are imported inside the functions that need them so that importing
+# this module (e.g. from a worker that only runs snicar) stays fast. Prediction
+# from a saved model only needs ParameterisationRuntime.py.
+from SNICAR_feeder import snicar_feeder, snicar_feeder_multizenith, snicar_feeder_impurity_sweep
+from ParameterisationRuntime import save_coefficients
 import numpy as np
-import pandas as pd
 import collections
-import dask
 
 
 def generate_snicar_params_single_layer(density, dz, alg, solzen):
@@ -30,36 +30,39 @@ def generate_snicar_params_single_layer(density, dz, alg, solzen):
 
 def generate_snicar_dataset_single_layer(densities, dzs, algs, solzens, savepath):
     
+    import pandas as pd
+
     data = []
     BBAlist = []
     absList = []
     # change due to density, zenith, algae & thickness
 
     # @dask.delayed
-    def run_snicar(dz,density,zen,alg):
+    def run_snicar(dz,density,zens,algs):
         
-        params = generate_snicar_params_single_layer(density, dz, alg, zen)             
+        params = generate_snicar_params_single_layer(density, dz, 0, zens)
+        params.mss_cnc_glacier_algae = [[alg,0] for alg in algs]
         albedo, BBA, abs_slr = call_snicar(params)
 
         return BBA, abs_slr
 
 
+    # all zenith angles and algae concentrations are solved in a single pass for
+    # each column, since only the direct beam and the algal optical depth change
     for i in np.arange(0,len(dzs),1):
         for j in np.arange(0,len(densities),1):
+
+            dz = dzs[i]
+            density = densities[j]
+            print("alg concs passed to run_snicar: {}".format(algs))
+
+            BBAs, abss = run_snicar(dz,density,list(solzens),list(algs))
+
             for k in np.arange(0,len(solzens),1):
                 for p in np.arange(0,len(algs),1):
-                    
-                    
-                    dz = dzs[i]
-                    density = densities[j]
-                    zen = solzens[k]
-                    alg = algs[p]
-                    print("alg conc passed to run_snicar: {}".format(alg))
-                    
-                    BBA, abs_slr = run_snicar(dz,density,zen,alg)
-                    data.append((dz, density, zen, alg))
-                    BBAlist.append(BBA)
-                    absList.append(abs_slr[0])
+                    data.append((dz, density, solzens[k], algs[p]))
+                    BBAlist.append(BBAs[k,p])
+                    absList.append(abss[k,p,0])
     
     #result = dask.compute(*BBAlist, scheduler='processes')
 
@@ -85,16 +88,16 @@ def regression_single_layer(path_to_data, var):
     so that other functions can make predictions using model.predict()
 
     to see coefficients examine model.summary() - coefficients are labelled x1 - xn
-    to see order of parameters examine polynomial_features.get_features()
     Then create a linear combination of coef(n) * param(n) to give final model
     
     """
 
+    import pandas as pd
+    import statsmodels.api as sm
+
     df = pd.read_csv(path_to_data, index_col=False)
     X = df[['density','dz','zenith','algae']]
     X = sm.add_constant(X)
-    
-    X.to_csv('regression_df.csv')
     X.rename(columns={ X.columns[0]: "const" }, inplace = True)
 
     print(X.columns[0])
@@ -114,11 +117,11 @@ def regression_single_layer(path_to_data, var):
     param3 = X.columns[3]
     param4 = X.columns[4]
 
-    coef1 = np.round(model.params[1],8)
-    coef2 = np.round(model.params[2],8)
-    coef3 = np.round(model.params[3],8)
-    coef4 = np.round(model.params[4],8)
-    const = np.round(model.params[0],8)
+    coef1 = np.round(model.params.iloc[1],8)
+    coef2 = np.round(model.params.iloc[2],8)
+    coef3 = np.round(model.params.iloc[3],8)
+    coef4 = np.round(model.params.iloc[4],8)
+    const = np.round(model.params.iloc[0],8)
     
     r2 = np.round(model.rsquared,4)
 
@@ -140,6 +143,7 @@ def regression_single_layer(path_to_data, var):
 def test_model_single_layer(test_densities, test_dzs, test_algs,\
     test_zeniths, modelBBA, modelABS, savepath):
 
+    import pandas as pd
 
     BBAlist =[]
     modelBBAlist = []
@@ -206,6 +210,10 @@ def save_model(model, filename, var, savepath):
     # save model instance to pickle
     model.save(str(savepath)+f"parameterisation_model_{var}.pkl")
 
+    # save coefficients to csv for the numpy-only runtime (ParameterisationRuntime.py)
+    save_coefficients(model.params.index, model.params.values,\
+        str(savepath)+f"parameterisation_coefs_{var}.csv")
+
     return 
 
 
@@ -213,7 +221,7 @@ def call_snicar(params):
 
     inputs = collections.namedtuple('inputs',['dir_base',\
     'rf_ice', 'incoming_i', 'DIRECT', 'layer_type',\
-    'APRX_TYP', 'DELTA', 'solzen', 'TOON', 'ADD_DOUBLE', 'R_sfc', 'dz', 'rho_layers', 'grain_rds',\
+    'APRX_TYP', 'DELTA', 'JIT', 'solzen', 'TOON', 'ADD_DOUBLE', 'R_sfc', 'dz', 'rho_layers', 'grain_rds',\
     'side_length', 'depth', 'rwater', 'nbr_lyr', 'nbr_aer', 'grain_shp', 'shp_fctr', 'grain_ar', 'SA_units','GA_units',\
     'Cfactor_SA','Cfactor_GA','cdom_layer','mss_cnc_soot1', 'mss_cnc_soot2', 'mss_cnc_brwnC1', 'mss_cnc_brwnC2', 'mss_cnc_dust1',\
     'mss_cnc_dust2', 'mss_cnc_dust3', 'mss_cnc_dust4', 'mss_cnc_dust5', 'mss_cnc_ash1', 'mss_cnc_ash2',\
@@ -257,6 +265,7 @@ def call_snicar(params):
     inputs.DIRECT   = 1       # 1= Direct-beam incident flux, 0= Diffuse incident flux
     inputs.APRX_TYP = 1        # 1= Eddington, 2= Quadrature, 3= Hemispheric Mean
     inputs.DELTA    = 1        # 1= Apply Delta approximation, 0= No delta
+    inputs.JIT      = False    # True = use numba-compiled kernels in the batched solvers (jit_kernels.py)
     inputs.solzen   = params.solzen      # if DIRECT give solar zenith angle between 0 and 89 degrees (from 0 = nadir, 90 = horizon)
 
     # CHOOSE ATMOSPHERIC PROFILE for surface-incident flux:
@@ -399,7 +408,14 @@ def call_snicar(params):
     inputs.mss_cnc_glacier_algae = params.mss_cnc_glacier_algae   # glacier algae type1 (Cook et al. 2020)
     print("alg inside snicar: {}".format(inputs.mss_cnc_glacier_algae))
     
-    outputs = snicar_feeder(inputs)
-    
+    # a list of zeniths and/or a list of algal concentration profiles is solved in
+    # one pass, with leading zenith and concentration axes on the outputs
+    if np.ndim(params.mss_cnc_glacier_algae) > 1:
+        outputs = snicar_feeder_impurity_sweep(inputs, 'glacier_algae', params.mss_cnc_glacier_algae)
+    elif np.ndim(params.solzen) > 0:
+        outputs = snicar_feeder_multizenith(inputs)
+    else:
+        outputs = snicar_feeder(inputs)
+
 
     return outputs.albedo, outputs.BBA, outputs.abs_slr
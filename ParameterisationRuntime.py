@@ -0,0 +1,135 @@
+"""
+Lightweight runtime for the SNICAR parameterisation.
+
+This module only depends on numpy (plus the standard library) so that workers and
+short-lived jobs that just need a BBA or absorption prediction do not pay for importing
+matplotlib, statsmodels, pandas or xarray. The fitting, plotting and dataset tools
+live in ParameterisationFuncs.py and are only imported when they are actually needed.
+
+The regression coefficients are stored as a small two-column csv file (term, coefficient)
+that is written by ParameterisationFuncs.save_model() alongside the statsmodels pickle.
+Each term is either "const", one of the predictor names (density, dz, zenith, algae) or
+a product of predictors separated by "*", where a predictor can be raised to a power
+with "^" (e.g. "density*dz" or "algae^2"). The transformed predictors in TRANSFORMS
+(log_algae = ln(1 + algae), log_dz = ln(dz)) can be used in terms like the others.
+
+A file with a third column, zenith, holds a separate submodel for each solar zenith
+(e.g. as selected by model_selection.py). Predictions between the zeniths of the
+submodels are interpolated linearly in zenith.
+
+"""
+
+import csv
+import numpy as np
+
+PREDICTORS = ('density', 'dz', 'zenith', 'algae')
+
+# transformed predictors that can appear in model terms
+TRANSFORMS = {
+    'log_algae': lambda variables: np.log1p(np.asarray(variables['algae'], dtype=float)),
+    'log_dz': lambda variables: np.log(np.asarray(variables['dz'], dtype=float)),
+}
+
+
+def load_coefficients(path):
+
+    """
+    reads a coefficient file written by save_coefficients() and returns an
+    ordered dict of {term: coefficient}, or of {zenith: {term: coefficient}}
+    if the file holds per-zenith submodels
+
+    """
+
+    coefs = {}
+
+    with open(path, newline='') as fh:
+        for row in csv.DictReader(fh):
+            if row.get('zenith') not in (None, ''):
+                coefs.setdefault(float(row['zenith']), {})[row['term']] = float(row['coefficient'])
+            else:
+                coefs[row['term']] = float(row['coefficient'])
+
+    return coefs
+
+
+def save_coefficients(terms, values, path, zeniths=None):
+
+    """
+    writes the model terms and their coefficients to a csv file that can be
+    read back by load_coefficients() without importing statsmodels or pandas.
+    zeniths optionally gives the zenith of the submodel of each term.
+
+    """
+
+    with open(path, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+
+        if zeniths is None:
+            writer.writerow(['term', 'coefficient'])
+            for term, value in zip(terms, values):
+                writer.writerow([term, repr(float(value))])
+        else:
+            writer.writerow(['term', 'coefficient', 'zenith'])
+            for term, value, zenith in zip(terms, values, zeniths):
+                writer.writerow([term, repr(float(value)), repr(float(zenith))])
+
+    return
+
+
+def evaluate_term(term, variables):
+
+    """
+    evaluates a single model term for arrays of predictor values.
+    variables is a dict of {predictor name: array}
+
+    """
+
+    if term == 'const':
+        return 1.0
+
+    out = 1.0
+
+    for factor in term.split('*'):
+        name, _, power = factor.partition('^')
+        value = TRANSFORMS[name](variables) if name in TRANSFORMS else np.asarray(variables[name], dtype=float)
+        out = out * (value ** int(power) if power else value)
+
+    return out
+
+
+def predict(coefs, density, dz, zenith, algae):
+
+    """
+    predicts the parameterised quantity (BBA or abs, depending on which
+    coefficients are passed) for scalars or arrays of density (kg m-3),
+    dz (m), zenith (degrees) and algae (ppb). Arrays are broadcast against
+    each other so whole grids can be evaluated in a single call.
+
+    If coefs holds per-zenith submodels ({zenith: {term: coefficient}}), the
+    submodels of the two zeniths either side of each zenith are evaluated and
+    interpolated linearly (zeniths outside the range use the nearest submodel).
+
+    """
+
+    variables = dict(zip(PREDICTORS, (density, dz, zenith, algae)))
+    out = np.zeros(np.broadcast(*variables.values()).shape)
+
+    if coefs and isinstance(next(iter(coefs.values())), dict):
+
+        # linear interpolation weights of each submodel (hat functions of the
+        # fractional position between the submodel zeniths)
+        zeniths = np.array(sorted(coefs))
+        position = np.interp(np.broadcast_to(np.asarray(zenith, dtype=float), out.shape), zeniths,\
+            np.arange(len(zeniths)))
+
+        for i, z in enumerate(zeniths):
+            weight = np.maximum(0, 1 - np.abs(position - i))
+            if np.any(weight):
+                out = out + weight*predict(coefs[z], density, dz, zenith, algae)
+
+        return out
+
+    for term, coef in coefs.items():
+        out = out + coef * evaluate_term(term, variables)
+
+    return out
@@ -301,18 +301,13 @@ if smooth:
 
 if print_band_ratios:
 
-    I2DBA = albedo[51]/albedo[46]
-    I3DBA = (albedo[46] - albedo[50]) / albedo[55]
-    NDCI = ((albedo[50]-albedo[48])-(albedo[55]-albedo[48]))*((albedo[50]-albedo[48])/(albedo[55]-albedo[48]))
-    MCI = (albedo[50]-albedo[46])/(albedo[50]+albedo[46])
-    II = np.log(albedo[36])/np.log(albedo[66])
+    from sensor_bands import convolve_bands, band_indices
+
+    indices = band_indices(convolve_bands(albedo, wvl, 'narrowband'), 'narrowband')
 
     print("\nINDEX VALUES")
-    print("2DBA Index: ",I2DBA)
-    print("3DBA index: ", I3DBA)
-    print("NDCI index: ", NDCI)
-    print("MCI index: ", MCI)
-    print("Impurity Index: ", II)
+    for name, value in indices.items():
+        print("{} index: ".format(name), value)
 
 if print_BBA:
 
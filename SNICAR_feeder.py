@@ -20,83 +20,390 @@ def snicar_feeder(inputs):
     """
 
 
-    import numpy as np
-    import xarray as xr
-    import matplotlib.pyplot as plt
-    from IceOptical_Model.mie_coated_water_spheres import miecoated_driver
+    import collections as c
     from Toon_RT_solver import toon_solver
     from adding_doubling_solver import adding_doubling_solver
-    import random
-    import os
-    import collections as c
-    import pandas as pd
-    
-    # load variables from input table
-    dir_base=inputs.dir_base
+
+    # retrieve wavelengths, incoming irradiance and the optical properties of the
+    # ice and impurities in each layer, then combine them into the tau, SSA and g
+    # of each layer for the solver (see the functions below)
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance(inputs, inputs.solzen)
+
+    SSA_snw, MAC_snw, g_snw = get_ice_optics(inputs)
+    SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw =\
+        mix_optical_properties(inputs, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer)
+
     TOON=inputs.TOON
     ADD_DOUBLE=inputs.ADD_DOUBLE
-    nbr_lyr = inputs.nbr_lyr
-    nbr_aer = inputs.nbr_aer
-    layer_type = inputs.layer_type
-    DIRECT=inputs.DIRECT
-    incoming_i=inputs.incoming_i
-    solzen=inputs.solzen
-    grain_rds=inputs.grain_rds
-    grain_shp=inputs.grain_shp
-    shp_fctr=inputs.shp_fctr
-    grain_ar=inputs.grain_ar
-    side_length=inputs.side_length
-    depth=inputs.depth
-    rf_ice=inputs.rf_ice
-    rwater=inputs.rwater
-    rho_layers=inputs.rho_layers
-    dz=inputs.dz
-    FILE_brwnC2=inputs.FILE_brwnC2
-    FILE_soot2=inputs.FILE_soot2
-    Cfactor_SA = inputs.Cfactor_SA
-    Cfactor_GA = inputs.Cfactor_GA
-    cdom_layer = inputs.cdom_layer
-    
+
+    # CALL RT SOLVER (TOON  = TOON ET AL, TRIDIAGONAL MATRIX METHOD; 
+    # ADD_DOUBLE = ADDING-DOUBLING METHOD)
     
-    files = [inputs.FILE_soot1,\
-    inputs.FILE_soot2, inputs.FILE_brwnC1, inputs.FILE_brwnC2, inputs.FILE_dust1, inputs.FILE_dust2, inputs.FILE_dust3, inputs.FILE_dust4, inputs.FILE_dust5,\
-    inputs.FILE_ash1, inputs.FILE_ash2, inputs.FILE_ash3, inputs.FILE_ash4, inputs.FILE_ash5, inputs.FILE_ash_st_helens, inputs.FILE_Skiles_dust1, inputs.FILE_Skiles_dust2,\
-    inputs.FILE_Skiles_dust3, inputs.FILE_Skiles_dust4, inputs.FILE_Skiles_dust5, inputs.FILE_GreenlandCentral1,\
-    inputs.FILE_GreenlandCentral2, inputs.FILE_GreenlandCentral3, inputs.FILE_GreenlandCentral4, inputs.FILE_GreenlandCentral5,\
-    inputs.FILE_Cook_Greenland_dust_L, inputs.FILE_Cook_Greenland_dust_C, inputs.FILE_Cook_Greenland_dust_H,\
-    inputs.FILE_snw_alg, inputs.FILE_glacier_algae]
+    outputs = c.namedtuple('outputs',['wvl', 'albedo', 'BBA', 'BBAVIS', 'BBANIR', 'abls_slr', 'heat_rt'])
+
+    # optical depth truncation, layer merging, single precision and the numba
+    # kernels are only implemented in the batched solvers
+    if getattr(inputs, 'TRUNCATE', 0) > 0 or getattr(inputs, 'MERGE_LAYERS', False)\
+        or getattr(inputs, 'SINGLE_PRECISION', False) or getattr(inputs, 'JIT', False):
+
+        return solve_batch(inputs)
+   
+    if TOON: 
         
-    mass_concentrations = [inputs.mss_cnc_soot1, inputs.mss_cnc_soot2, inputs.mss_cnc_brwnC1, inputs.mss_cnc_brwnC2, inputs.mss_cnc_dust1,\
-    inputs.mss_cnc_dust2, inputs.mss_cnc_dust3, inputs.mss_cnc_dust4, inputs.mss_cnc_dust5, inputs.mss_cnc_ash1, inputs.mss_cnc_ash2,\
-    inputs.mss_cnc_ash3, inputs.mss_cnc_ash4, inputs.mss_cnc_ash5, inputs.mss_cnc_ash_st_helens, inputs.mss_cnc_Skiles_dust1, inputs.mss_cnc_Skiles_dust2,\
-    inputs.mss_cnc_Skiles_dust3, inputs.mss_cnc_Skiles_dust4, inputs.mss_cnc_Skiles_dust5, inputs.mss_cnc_GreenlandCentral1,\
-    inputs.mss_cnc_GreenlandCentral2, inputs.mss_cnc_GreenlandCentral3, inputs.mss_cnc_GreenlandCentral4,\
-    inputs.mss_cnc_GreenlandCentral5, inputs.mss_cnc_Cook_Greenland_dust_L, inputs.mss_cnc_Cook_Greenland_dust_C,\
-    inputs.mss_cnc_Cook_Greenland_dust_H, inputs.mss_cnc_snw_alg, inputs.mss_cnc_glacier_algae]
+        outputs.wvl, outputs.albedo, outputs.BBA, outputs.BBAVIS, outputs.BBANIR, outputs.abs_slr, outputs.heat_rt = toon_solver(inputs)
+
+
+    if ADD_DOUBLE:
+
+        outputs.wvl, outputs.albedo, outputs.BBA, outputs.BBAVIS, outputs.BBANIR, outputs.abs_slr, outputs.heat_rt = adding_doubling_solver(inputs)
+
+    return outputs
+
+
+
+def snicar_feeder_multizenith(inputs):
+
+    """
+    Runs snicar for a single column at several solar zenith angles in one pass.
+    inputs.solzen is a list of zenith angles (degrees). Everything else is set up
+    exactly as for snicar_feeder().
+
+    The optical properties of the column do not depend on the solar zenith, so they
+    are only calculated once. The irradiance for every zenith is then passed to the
+    batched solvers, which also compute the zenith-independent layer terms once and
+    evaluate the direct-beam terms for all zeniths together. This is much faster than
+    calling snicar_feeder() once per zenith.
+
+    The outputs have the same fields as snicar_feeder() with a leading axis of length
+    len(solzen), e.g. outputs.albedo has shape (len(solzen), nbr_wvl).
+
+    """
+
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_batch(inputs)
+
+    SSA_snw, MAC_snw, g_snw = get_ice_optics(inputs)
+    SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw =\
+        mix_optical_properties(inputs, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer)
+
+    return solve_batch(inputs)
+
+
+def snicar_feeder_impurity_sweep(inputs, impurity, concentrations):
+
+    """
+    Runs snicar for a single column with many concentrations of one impurity in
+    one pass. impurity is the name used in the inputs attributes (e.g.
+    'glacier_algae' for inputs.mss_cnc_glacier_algae) and concentrations is a
+    list of per-layer concentration profiles, one per run, in the same units as
+    inputs.mss_cnc_<impurity> (e.g. [[0, 0], [1000, 0], [5000, 0]]).
+
+    The optical depth of each impurity is linear in its concentration, so the
+    ice optics, irradiance and the contribution of every other impurity are
+    calculated once and the swept impurity is added to them by broadcasting.
+    The stacked tau, SSA and g are then solved together by the batched solvers.
+    inputs.solzen can be a single zenith or a list of zeniths.
+
+    The outputs have the same fields as snicar_feeder() with a leading axis of
+    length len(concentrations), preceded by a zenith axis if inputs.solzen is a
+    list, e.g. outputs.BBA has shape (len(solzen), len(concentrations)).
+
+    """
+
+    import numpy as np
+
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_batch(inputs)
+
+    # optics with the swept impurity removed; the caller's concentrations are
+    # restored afterwards
+    original = getattr(inputs, 'mss_cnc_'+impurity)
+    setattr(inputs, 'mss_cnc_'+impurity, [0]*inputs.nbr_lyr)
+
+    try:
+        SSA_snw, MAC_snw, g_snw = get_ice_optics(inputs)
+        SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+        L_snw, tau_snw = ice_optical_depth(inputs, MAC_snw)
+        tau_sum, SSA_sum, g_sum = sum_impurity_optics(inputs, L_snw, SSAaer, MACaer, Gaer, MSSaer)
+
+        # contribution of the swept impurity for each concentration profile, summed
+        # over the layers and applied to all layers as in sum_impurity_optics()
+        aer = IMPURITIES.index(impurity)
+        MSS = convert_impurity_concentration(inputs, getattr(inputs, 'FILE_'+impurity), concentrations)
+        L_aer = np.sum(L_snw * MSS, axis=-1)
+        tau_aer = L_aer[:, np.newaxis, np.newaxis] * MACaer[aer, :]
+
+        tau_sum = tau_sum + tau_aer
+        SSA_sum = SSA_sum + tau_aer * SSAaer[aer, :]
+        g_sum = g_sum + tau_aer * SSAaer[aer, :] * Gaer[aer, :]
+
+        inputs.tau, inputs.SSA, inputs.g = combine_optical_properties(tau_snw, SSA_snw, g_snw, tau_sum, SSA_sum, g_sum)
+        inputs.L_snw = L_snw
+
+        return solve_batch(inputs)
+
+    finally:
+        setattr(inputs, 'mss_cnc_'+impurity, original)
+
+
+def snicar_feeder_reduced_bands(inputs, edges):
+
+    """
+    Runs snicar for a single column on coarse spectral bands instead of the 480
+    band grid. edges are the band edges (indices into the 480 band grid), e.g.
+    from spectral_bands.build_band_set(). The optical properties are set up on the
+    full grid exactly as in snicar_feeder_multizenith() and averaged over each
+    band with the irradiance weights before the batched solvers are called (see
+    spectral_bands.solve_reduced_bands()). inputs.solzen can be a single zenith
+    or a list of zeniths.
+
+    The outputs have the same fields as snicar_feeder(), with albedo and wvl
+    given per band.
+
+    """
+
+    from spectral_bands import solve_reduced_bands
+
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_batch(inputs)
+
+    SSA_snw, MAC_snw, g_snw = get_ice_optics(inputs)
+    SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw =\
+        mix_optical_properties(inputs, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer)
+
+    return solve_reduced_bands(inputs, edges)
+
+
+def get_irradiance_batch(inputs):
+
+    """
+    returns mu_not, flx_slr, Fs and Fd for inputs.solzen. If solzen is a list, the
+    irradiance for each zenith is stacked along a leading axis for the batched
+    solvers.
+
+    """
+
+    import numpy as np
+
+    if np.ndim(inputs.solzen) == 0:
+        return get_irradiance(inputs, inputs.solzen)
+
+    irradiance = [get_irradiance(inputs, solzen) for solzen in inputs.solzen]
+    mu_not, flx_slr, Fs, Fd = zip(*irradiance)
+
+    return np.array(mu_not), np.stack(flx_slr), np.stack(Fs), np.stack(Fd)
+
+
+def get_irradiance_interpolated(inputs, solzen):
+
+    """
+    returns mu_not, flx_slr, Fs and Fd for a 1D array of solar zeniths (degrees)
+    that need not be whole numbers, stacked along a leading axis as in
+    get_irradiance_batch(). The clear-sky irradiance files only exist for whole
+    degrees, so flx_slr is interpolated linearly between the files of the
+    neighbouring whole zeniths (each file is read once) and Fs and Fd are then
+    calculated from it as in get_irradiance(). The cloudy-sky file does not
+    depend on the zenith, so for diffuse runs it is read once. Zeniths are
+    limited to 0-89.
+
+    """
+
+    import numpy as np
+
+    solzen = np.clip(np.asarray(solzen, dtype=float), 0, 89)
+    mu_not = np.cos(solzen * (np.pi / 180))
+
+    if inputs.DIRECT:
+        lower = np.floor(solzen).astype(int)
+        upper = np.minimum(lower+1, 89)
+        frac = (solzen-lower)[:, np.newaxis]
+
+        files = {}
+        for z in np.union1d(lower, upper):
+            files[z] = get_irradiance(inputs, int(z))[1]
+
+        flx_slr = (1-frac)*np.array([files[z] for z in lower]) + frac*np.array([files[z] for z in upper])
+        Fs = flx_slr / (mu_not[:, np.newaxis] * np.pi)
+        Fd = np.zeros(flx_slr.shape)
+
+    else:
+        flx_slr = np.tile(get_irradiance(inputs, int(np.floor(solzen[0])))[1], (len(solzen), 1))
+        Fd = flx_slr / mu_not[:, np.newaxis] * np.pi
+        Fs = np.zeros(flx_slr.shape)
+
+    return mu_not, flx_slr, Fs, Fd
+
+
+def solve_batch(inputs):
+
+    """
+    calls the batched version of the solver selected by inputs.TOON and
+    inputs.ADD_DOUBLE and returns the outputs namedtuple
+
+    """
+
+    import collections as c
+    from Toon_RT_solver import toon_solver_batch
+    from adding_doubling_solver import adding_doubling_solver_batch
+
+    outputs = c.namedtuple('outputs',['wvl', 'albedo', 'BBA', 'BBAVIS', 'BBANIR', 'abs_slr', 'heat_rt'])
+
+    if inputs.TOON:
+
+        outputs.wvl, outputs.albedo, outputs.BBA, outputs.BBAVIS, outputs.BBANIR, outputs.abs_slr, outputs.heat_rt = solve_layers(inputs, toon_solver_batch, toon=True)
+
+    if inputs.ADD_DOUBLE:
+
+        outputs.wvl, outputs.albedo, outputs.BBA, outputs.BBAVIS, outputs.BBANIR, outputs.abs_slr, outputs.heat_rt = solve_layers(inputs, adding_doubling_solver_batch)
+
+    return outputs
+
+
+def merge_identical_layers(inputs, toon=False):
+
+    """
+    finds runs of adjacent layers with the same layer type, optical depth, single
+    scattering albedo and asymmetry parameter (i.e. the same thickness, density,
+    grain size and shape and impurity loading) in every column of inputs.tau,
+    inputs.SSA and inputs.g. Each run is a homogeneous slab that can be solved as
+    one layer.
+
+    The first two layers are never merged, and the first solid ice layer is
+    never merged with the layer below because it carries the Fresnel interface.
+    toon_solver() uses lam of the second layer in C_pls_top of every layer, so
+    its direct beam terms are only an exact particular solution in layers with
+    the lam of the second layer. A run solved as one layer then differs from the
+    stack of its layers, so if toon is set only runs with the single scattering
+    albedo and asymmetry parameter (and therefore lam) of the second layer are
+    merged.
+    returns the index of the first layer of each run
+
+    """
+
+    import numpy as np
+
+    tau = np.asarray(inputs.tau)
+    SSA = np.asarray(inputs.SSA)
+    g = np.asarray(inputs.g)
+    layer_type = np.asarray(inputs.layer_type)
+
+    # all axes except the layer axis
+    axes = tuple(i for i in range(SSA.ndim) if i != SSA.ndim-2)
+
+    same = (layer_type[1:] == layer_type[:-1])\
+        & np.all(tau[..., 1:, :] == tau[..., :-1, :], axis=axes)\
+        & np.all(SSA[..., 1:, :] == SSA[..., :-1, :], axis=axes)\
+        & np.all(g[..., 1:, :] == g[..., :-1, :], axis=axes)
+
+    same[:2] = False
+
+    if toon and len(same) > 1:
+        same[1:] &= np.all(SSA[..., 2:, :] == SSA[..., 1:2, :], axis=axes)\
+            & np.all(g[..., 2:, :] == g[..., 1:2, :], axis=axes)
+
+    if np.any(layer_type == 1):
+        fresnel = np.argmax(layer_type == 1)
+        same[fresnel-1:fresnel+1] = False
+
+    return np.concatenate([[0], np.nonzero(~same)[0]+1])
+
+
+def solve_layers(inputs, solver, toon=False):
+
+    """
+    calls the batched solver with inputs (toon is set for toon_solver_batch).
+    If inputs.MERGE_LAYERS is set, only the first layer of each run of identical
+    layers (merge_identical_layers()) is passed to the solver, with inputs.layer_repeats giving the number of layers in
+    the run, so that the cost of the layer calculations scales with the number of
+    distinct layers. The solvers return absorption and heating rates for every
+    original layer.
+
+    """
+
+    import numpy as np
+
+    if not getattr(inputs, 'MERGE_LAYERS', False):
+        return solver(inputs)
+
+    starts = merge_identical_layers(inputs, toon)
+
+    if len(starts) == inputs.nbr_lyr:
+        return solver(inputs)
+
+    # swap the per-layer inputs for the merged column, restoring them afterwards
+    original = dict(tau=inputs.tau, SSA=inputs.SSA, g=inputs.g, layer_type=inputs.layer_type,\
+        nbr_lyr=inputs.nbr_lyr)
+
+    try:
+        inputs.tau = np.asarray(inputs.tau)[..., starts, :]
+        inputs.SSA = np.asarray(inputs.SSA)[..., starts, :]
+        inputs.g = np.asarray(inputs.g)[..., starts, :]
+        inputs.layer_type = [original['layer_type'][i] for i in starts]
+        inputs.nbr_lyr = len(starts)
+        inputs.layer_repeats = np.diff(np.append(starts, original['nbr_lyr']))
+
+        return solver(inputs)
+
+    finally:
+        for name, value in original.items():
+            setattr(inputs, name, value)
+        del inputs.layer_repeats
 
-    # working directories 
-    dir_mie_ice_files = str(dir_base + 'Data/Mie_files/480band/') # directory with folders ice_Pic16, ice_Wrn08 and ice_Wrn84 with optical properties calculated with Mie theory
-    dir_go_ice_files = str(dir_base + 'Data/GO_files/480band/') # idem for ice OPs calculated with Geometric optics
-    dir_mie_lap_files = str(dir_base + 'Data/Mie_files/480band/lap/') # directory with folders ice_Pic16, ice_Wrn08 and ice_Wrn84 with optical properties calculated with Mie theory
-    dir_bubbly_ice = str(dir_base + 'Data/bubbly_ice_files/')
-    dir_fsds = str(dir_base + 'Data/Mie_files/480band/fsds/')
-    dir_RI_ice = str(dir_base + 'Data/') 
+
+def get_wavelengths(inputs):
+
+    """
+    returns the wavelengths (microns) of the optical property files
+
+    """
+
+    import numpy as np
+    from optical_library import read_optical_variable
+
+    dir_mie_lap_files = str(inputs.dir_base + 'Data/Mie_files/480band/lap/')
 
     # retrieve nbr wvl, aer, layers and layer types 
-    temp = xr.open_dataset(str(dir_mie_lap_files+'dust_greenland_Cook_LOW_20190911.nc'))
-    wvl = np.array(temp['wvl'].values)
+    wvl = np.array(read_optical_variable(str(dir_mie_lap_files+'dust_greenland_Cook_LOW_20190911.nc'), 'wvl'))
     wvl = wvl*1e6
-    nbr_wvl = len(wvl)
-    inputs.nbr_wvl = nbr_wvl
-    inputs.wvl = wvl
+
+    return wvl
+
+
+def get_irradiance(inputs, solzen):
+
+    """
+    loads the spectral incoming irradiance for the atmospheric profile inputs.incoming_i
+    and solar zenith angle solzen (degrees). Clear-sky profiles are loaded when
+    inputs.DIRECT == 1 and cloudy-sky profiles otherwise.
+
+    returns the cosine of the solar zenith, the spectral irradiance flx_slr and
+    the direct (Fs) and diffuse (Fd) fluxes passed to the solvers
+
+    """
+
+    import numpy as np
+    from optical_library import read_optical_variable
+
+    DIRECT=inputs.DIRECT
+    incoming_i=inputs.incoming_i
+    nbr_wvl=inputs.nbr_wvl
+    dir_fsds = str(inputs.dir_base + 'Data/Mie_files/480band/fsds/')
 
     # load incoming irradiance
     # calc cosine of solar zenith (radians)
     mu_not = np.cos(solzen * (np.pi / 180)) # convert radians if required
-    inputs.mu_not = mu_not
     
     print("\ncosine of solar zenith = ", mu_not)
     
+
     flx_slr = []
     
     if DIRECT:
@@ -105,62 +412,100 @@ def snicar_feeder(inputs):
         coszen = str('SZA'+str(solzen).rjust(2,'0'))
 
         if incoming_i == 0:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_mlw_clr_"+coszen+".nc")) 
+            Incoming_file = str(dir_fsds + "swnb_480bnd_mlw_clr_"+coszen+".nc") 
             print("atmospheric profile = mid-lat winter")
         elif incoming_i == 1:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_mls_clr_"+coszen+".nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_mls_clr_"+coszen+".nc")
             print("atmospheric profile = mid-lat summer")
         elif incoming_i == 2:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_saw_clr_"+coszen+".nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_saw_clr_"+coszen+".nc")
             print("atmospheric profile = sub-Arctic winter")
         elif incoming_i == 3:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_sas_clr_"+coszen+".nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_sas_clr_"+coszen+".nc")
             print("atmospheric profile = sub-Arctic summer")
         elif incoming_i == 4:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_smm_clr_"+coszen+".nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_smm_clr_"+coszen+".nc")
             print("atmospheric profile = Summit Station")
         elif incoming_i == 5:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_hmn_clr_"+coszen+".nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_hmn_clr_"+coszen+".nc")
             print("atmospheric profile = High Mountain")  
         elif incoming_i == 6:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_toa_clr.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_toa_clr.nc")
             print("atmospheric profile = top-of-atmosphere")
 
         else:
             raise ValueError ("Invalid choice of atmospheric profile")
         
-        flx_slr = Incoming_file['flx_dwn_sfc'].values #flx_dwn_sfc is the spectral irradiance in W m-2 and is pre-calculated (flx_frc_sfc*flx_bb_sfc in original code)
+        flx_slr = read_optical_variable(Incoming_file, 'flx_dwn_sfc').copy() #flx_dwn_sfc is the spectral irradiance in W m-2 and is pre-calculated (flx_frc_sfc*flx_bb_sfc in original code)
         flx_slr[flx_slr<=0]=1e-30
-        inputs.flx_slr=flx_slr
-        inputs.Fs = flx_slr / (mu_not * np.pi)
-        inputs.Fd = np.zeros(nbr_wvl)
+        Fs = flx_slr / (mu_not * np.pi)
+        Fd = np.zeros(nbr_wvl)
 
     else:
 
         if incoming_i == 0:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_mlw_cld.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_mlw_cld.nc")
         elif incoming_i == 1:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_mls_cld.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_mls_cld.nc")
         elif incoming_i == 2:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_saw_cld.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_saw_cld.nc")
         elif incoming_i == 3:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_sas_cld.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_sas_cld.nc")
         elif incoming_i == 4:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_smm_cld.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_smm_cld.nc")
         elif incoming_i == 5:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_hmn_cld.nc"))   
+            Incoming_file = str(dir_fsds + "swnb_480bnd_hmn_cld.nc")   
         elif incoming_i == 6:
-            Incoming_file = xr.open_dataset(str(dir_fsds + "swnb_480bnd_toa_cld.nc"))
+            Incoming_file = str(dir_fsds + "swnb_480bnd_toa_cld.nc")
 
         else:
             raise ValueError ("Invalid choice of atmospheric profile")     
 
-        flx_slr = Incoming_file['flx_dwn_sfc'].values
+        flx_slr = read_optical_variable(Incoming_file, 'flx_dwn_sfc').copy()
         
         flx_slr[flx_slr<=0]=1e-30
 
-        inputs.Fd = [flx_slr[i]/mu_not*np.pi for i in range(nbr_wvl)]
-        inputs.Fs = np.zeros(nbr_wvl)
+        Fd = np.array([flx_slr[i]/mu_not*np.pi for i in range(nbr_wvl)])
+        Fs = np.zeros(nbr_wvl)
+
+    return mu_not, flx_slr, Fs, Fd
+
+
+def get_ice_optics(inputs):
+
+    """
+    reads in the single scattering albedo, mass extinction coefficient and asymmetry
+    parameter of the ice in each layer: Mie or geometric optics files for granular
+    layers (with the He et al. (2017) adjustments for nonspherical grains) and the
+    bubbly ice files for solid ice layers (layer_type == 1)
+
+    """
+
+    import numpy as np
+    from optical_library import read_optical_variable
+
+    # load variables from input table
+    nbr_lyr = inputs.nbr_lyr
+    nbr_wvl = inputs.nbr_wvl
+    wvl = inputs.wvl
+    dir_base=inputs.dir_base
+    layer_type = inputs.layer_type
+    grain_rds=inputs.grain_rds
+    grain_shp=inputs.grain_shp
+    shp_fctr=inputs.shp_fctr
+    grain_ar=inputs.grain_ar
+    side_length=inputs.side_length
+    depth=inputs.depth
+    rf_ice=inputs.rf_ice
+    rwater=inputs.rwater
+    rho_layers=inputs.rho_layers
+    cdom_layer = inputs.cdom_layer
+
+    # working directories 
+    dir_mie_ice_files = str(dir_base + 'Data/Mie_files/480band/') # directory with folders ice_Pic16, ice_Wrn08 and ice_Wrn84 with optical properties calculated with Mie theory
+    dir_go_ice_files = str(dir_base + 'Data/GO_files/480band/') # idem for ice OPs calculated with Geometric optics
+    dir_bubbly_ice = str(dir_base + 'Data/bubbly_ice_files/')
+    dir_RI_ice = str(dir_base + 'Data/') 
 
 
     ###################################################
@@ -224,29 +569,33 @@ def snicar_feeder(inputs):
                     raise ValueError("Water coating can only be applied to spherical grains")
 
                 else:
-                    # water coating calculations (coated spheres)
-                    fn_ice = dir_base + "/Data/rfidx_ice.nc"
-                    fn_water = dir_base + "Data/Refractive_Index_Liquid_Water_Segelstein_1981.csv"
-                    res = miecoated_driver(rice=grain_rds[i], rwater=rwater[i], fn_ice=fn_ice, rf_ice=rf_ice, fn_water=fn_water, wvl=wvl)
+                    # water coating calculations (coated spheres), interpolated from the
+                    # precomputed library if it covers this layer
+                    from IceOptical_Model.mie_coated_library import LIBRARY_FILE, coated_sphere_optics
+                    res = coated_sphere_optics(dir_base + LIBRARY_FILE, rf_ice, grain_rds[i], rwater[i])
+
+                    if res is None:
+                        from IceOptical_Model.mie_coated_water_spheres import miecoated_driver
+                        fn_ice = dir_base + "/Data/rfidx_ice.nc"
+                        fn_water = dir_base + "Data/Refractive_Index_Liquid_Water_Segelstein_1981.csv"
+                        res = miecoated_driver(rice=grain_rds[i], rwater=rwater[i], fn_ice=fn_ice, rf_ice=rf_ice, fn_water=fn_water, wvl=wvl)
+
                     SSA_snw[i, :] = res["ssa"]
                     g_snw[i, :] = res["asymmetry"]
 
-                with xr.open_dataset(FILE_ice) as temp:
-                    ext_cff_mss = temp['ext_cff_mss'].values
-                    MAC_snw[i, :] = ext_cff_mss
+                ext_cff_mss = read_optical_variable(FILE_ice, 'ext_cff_mss')
+                MAC_snw[i, :] = ext_cff_mss
 
             else:
 
-                with xr.open_dataset(FILE_ice) as temp:
-                    
-                    SSA = temp['ss_alb'].values
-                    SSA_snw[i,:] = SSA
+                SSA = read_optical_variable(FILE_ice, 'ss_alb')
+                SSA_snw[i,:] = SSA
 
-                    ext_cff_mss = temp['ext_cff_mss'].values
-                    MAC_snw[i,:] = ext_cff_mss
+                ext_cff_mss = read_optical_variable(FILE_ice, 'ext_cff_mss')
+                MAC_snw[i,:] = ext_cff_mss
 
-                    asm_prm = temp['asm_prm'].values
-                    g_snw[i,:] = asm_prm
+                asm_prm = read_optical_variable(FILE_ice, 'asm_prm')
+                g_snw[i,:] = asm_prm
         
 
             ###############################################################
@@ -377,35 +726,70 @@ def snicar_feeder(inputs):
             
             rd = "{}".format(grain_rds[i])
             rd = rd.rjust(4,"0")
-            refidx_file = xr.open_dataset(dir_RI_ice+'rfidx_ice.nc')
+            refidx_file = dir_RI_ice+'rfidx_ice.nc'
            
+            # copied because the cdom adjustment below modifies refidx_im
             if rf_ice == 0:
-                refidx_re = refidx_file['re_Wrn84'].values
-                refidx_im = refidx_file['im_Wrn84'].values 
+                refidx_re = read_optical_variable(refidx_file, 're_Wrn84')
+                refidx_im = read_optical_variable(refidx_file, 'im_Wrn84').copy()
 
             elif rf_ice == 1:
-                refidx_re = refidx_file['re_Wrn08'].values
-                refidx_im = refidx_file['im_Wrn08'].values 
+                refidx_re = read_optical_variable(refidx_file, 're_Wrn08')
+                refidx_im = read_optical_variable(refidx_file, 'im_Wrn08').copy()
 
             elif rf_ice == 2:
-                refidx_re = refidx_file['re_Pic16'].values
-                refidx_im = refidx_file['im_Pic16'].values
+                refidx_re = read_optical_variable(refidx_file, 're_Pic16')
+                refidx_im = read_optical_variable(refidx_file, 'im_Pic16').copy()
                 
                 
             if cdom_layer[i]:
+                import pandas as pd
                 cdom_refidx_im = np.array(pd.read_csv(dir_RI_ice+'k_cdom_240_750.csv')).flatten()
                 cdom_refidx_im_rescaled = cdom_refidx_im[::10]
                 refidx_im[3:54] = np.fmax(refidx_im[3:54],cdom_refidx_im_rescaled)
             FILE_ice = str(dir_bubbly_ice + 'bbl_{}.nc').format(rd)
-            file = xr.open_dataset(FILE_ice)
-            sca_cff_vlm = file['sca_cff_vlm'].values # scattering cross section unit per volume of bubble
-            g_snw[i,:] = file['asm_prm'].values
+            sca_cff_vlm = read_optical_variable(FILE_ice, 'sca_cff_vlm') # scattering cross section unit per volume of bubble
+            g_snw[i,:] = read_optical_variable(FILE_ice, 'asm_prm')
             abs_cff_mss_ice[:] = ((4 * np.pi * refidx_im) / (wvl * 1e-6))/917
             vlm_frac_air = (917 - rho_layers[i]) / 917
             MAC_snw[i,:] = ((sca_cff_vlm * vlm_frac_air) /917) + abs_cff_mss_ice
             SSA_snw[i,:] = ((sca_cff_vlm * vlm_frac_air) /917) / MAC_snw[i,:]
 
-    
+    return SSA_snw, MAC_snw, g_snw
+
+
+# names of the impurities, in the order of the columns of MSSaer. Each has a
+# FILE_<name> and mss_cnc_<name> attribute in inputs
+IMPURITIES = ['soot1', 'soot2', 'brwnC1', 'brwnC2', 'dust1', 'dust2', 'dust3', 'dust4', 'dust5',\
+    'ash1', 'ash2', 'ash3', 'ash4', 'ash5', 'ash_st_helens', 'Skiles_dust1', 'Skiles_dust2',\
+    'Skiles_dust3', 'Skiles_dust4', 'Skiles_dust5', 'GreenlandCentral1',\
+    'GreenlandCentral2', 'GreenlandCentral3', 'GreenlandCentral4', 'GreenlandCentral5',\
+    'Cook_Greenland_dust_L', 'Cook_Greenland_dust_C', 'Cook_Greenland_dust_H',\
+    'snw_alg', 'glacier_algae']
+
+
+def get_impurity_optics(inputs):
+
+    """
+    reads in the single scattering albedo, mass extinction coefficient and asymmetry
+    parameter of each impurity and converts the user-defined concentrations into
+    MSSaer (one row per layer, one column per impurity)
+
+    """
+
+    import numpy as np
+    from optical_library import read_optical_variable
+
+    nbr_lyr = inputs.nbr_lyr
+    nbr_aer = inputs.nbr_aer
+    nbr_wvl = inputs.nbr_wvl
+    FILE_brwnC2=inputs.FILE_brwnC2
+    FILE_soot2=inputs.FILE_soot2
+    dir_mie_lap_files = str(inputs.dir_base + 'Data/Mie_files/480band/lap/')
+
+    files = [getattr(inputs, 'FILE_'+name) for name in IMPURITIES]
+    mass_concentrations = [getattr(inputs, 'mss_cnc_'+name) for name in IMPURITIES]
+
     ###################################################
     # Read in impurity optical properties
     ###################################################
@@ -419,80 +803,127 @@ def snicar_feeder(inputs):
     MSSaer = np.zeros([nbr_lyr, nbr_aer])
     
     for aer in range(nbr_aer):
-        impurity_properties = xr.open_dataset(str(dir_mie_lap_files + files[aer]))
-        Gaer[aer,:] = impurity_properties['asm_prm'].values
-        SSAaer[aer,:] = impurity_properties['ss_alb'].values
+        impurity_properties = str(dir_mie_lap_files + files[aer])
+        Gaer[aer,:] = read_optical_variable(impurity_properties, 'asm_prm')
+        SSAaer[aer,:] = read_optical_variable(impurity_properties, 'ss_alb')
         if files[aer] == FILE_brwnC2 or files[aer] == FILE_soot2: #coated particles: use ext_cff_mss_ncl for MAC
-            MACaer[aer,:] = impurity_properties['ext_cff_mss_ncl'].values
+            MACaer[aer,:] = read_optical_variable(impurity_properties, 'ext_cff_mss_ncl')
         else:
-            MACaer[aer,:] = impurity_properties['ext_cff_mss'].values
-        if files[aer] == inputs.FILE_glacier_algae:
-            # if GA_units == 1, GA concentration provided in cells/mL 
-            # MSSaer should be in cells/kg 
-            # thus MSSaer is divided by kg/mL ice = 0.917*10**(-3) 
-            if inputs.GA_units == 1:
-                MSSaer[0:nbr_lyr,aer] = np.array(mass_concentrations[aer])/(0.917*10**(-3))
-            else:
-                MSSaer[0:nbr_lyr,aer] = np.array(mass_concentrations[aer])*1e-9
-        elif files[aer] == inputs.FILE_snw_alg:
-            # if SA_units == 1, SA concentration provided in cells/mL 
-            # but MSSaer should be in cells/kg
-            # thus MSSaer is divided by kg/mL ice = 0.917*10**(-3)
-            if inputs.SA_units == 1:
-                MSSaer[0:nbr_lyr,aer] = np.array(mass_concentrations[aer])/(0.917*10**(-3))
-            else:
-                MSSaer[0:nbr_lyr,aer] = np.array(mass_concentrations[aer])*1e-9
-        else: 
-            # conversion to kg/kg ice from ng/g
-            MSSaer[0:nbr_lyr,aer] = np.array(mass_concentrations[aer])*1e-9
-        
-        # if Cfactor provided, then MSSaer multiplied by Cfactor
-        if (files[aer] == inputs.FILE_glacier_algae and isinstance(Cfactor_GA,(int, float)) and (Cfactor_GA > 0)): 
-            MSSaer[0:nbr_lyr,aer] = Cfactor_GA*MSSaer[0:nbr_lyr,aer]
-        if (files[aer] == inputs.FILE_snw_alg and isinstance(Cfactor_SA,(int, float)) and (Cfactor_SA > 0)): 
-            MSSaer[0:nbr_lyr,aer] = Cfactor_SA*MSSaer[0:nbr_lyr,aer]
-        
-        
-    #####################################
-    # Begin solving Radiative Transfer
-    #####################################
+            MACaer[aer,:] = read_optical_variable(impurity_properties, 'ext_cff_mss')
+
+        MSSaer[0:nbr_lyr,aer] = convert_impurity_concentration(inputs, files[aer], mass_concentrations[aer])
+
+    return SSAaer, MACaer, Gaer, MSSaer
+
+
+def convert_impurity_concentration(inputs, file, concentration):
+
+    """
+    converts the user-defined concentration of the impurity stored in file into
+    the mass (or cell) concentration per kg of ice used in MSSaer. concentration
+    can be a per-layer list or an array with the layers on the last axis.
 
     """
-    #1. Calculate effective tau (optical depth), SSA (single scattering albedo) and 
-    # g (assymetry parameter) for the ice + impurities mixture.
 
-    # SSA and g for the individual components has been calculated using Mie theory and
-    # stored in a netcdf file. Here, these values are combined to give an overall
-    # SSA and g for the ice + impurity mixture
+    import numpy as np
+
+    Cfactor_SA = inputs.Cfactor_SA
+    Cfactor_GA = inputs.Cfactor_GA
+
+    if file == inputs.FILE_glacier_algae:
+        # if GA_units == 1, GA concentration provided in cells/mL 
+        # MSSaer should be in cells/kg 
+        # thus MSSaer is divided by kg/mL ice = 0.917*10**(-3) 
+        if inputs.GA_units == 1:
+            MSS = np.array(concentration)/(0.917*10**(-3))
+        else:
+            MSS = np.array(concentration)*1e-9
+    elif file == inputs.FILE_snw_alg:
+        # if SA_units == 1, SA concentration provided in cells/mL 
+        # but MSSaer should be in cells/kg
+        # thus MSSaer is divided by kg/mL ice = 0.917*10**(-3)
+        if inputs.SA_units == 1:
+            MSS = np.array(concentration)/(0.917*10**(-3))
+        else:
+            MSS = np.array(concentration)*1e-9
+    else: 
+        # conversion to kg/kg ice from ng/g
+        MSS = np.array(concentration)*1e-9
     
+    # if Cfactor provided, then MSSaer multiplied by Cfactor
+    if (file == inputs.FILE_glacier_algae and isinstance(Cfactor_GA,(int, float)) and (Cfactor_GA > 0)): 
+        MSS = Cfactor_GA*MSS
+    if (file == inputs.FILE_snw_alg and isinstance(Cfactor_SA,(int, float)) and (Cfactor_SA > 0)): 
+        MSS = Cfactor_SA*MSS
+
+    return MSS
+
+
+def mix_optical_properties(inputs, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer):
+
     """
+    combines the optical properties of the ice and impurities in each layer into the
+    effective tau (optical depth), SSA (single scattering albedo) and g (asymmetry
+    parameter) of each layer. Also returns the layer mass L_snw.
+
+    """
+
+    L_snw, tau_snw = ice_optical_depth(inputs, MAC_snw)
+    tau_sum, SSA_sum, g_sum = sum_impurity_optics(inputs, L_snw, SSAaer, MACaer, Gaer, MSSaer)
+    tau, SSA, g = combine_optical_properties(tau_snw, SSA_snw, g_snw, tau_sum, SSA_sum, g_sum)
+
+    return tau, SSA, g, L_snw
+
+
+def ice_optical_depth(inputs, MAC_snw):
+
+    """
+    returns the mass (L_snw) and the optical depth of the ice (tau_snw) in each layer
+
+    """
+
+    import numpy as np
+
+    nbr_lyr = inputs.nbr_lyr
+    nbr_wvl = inputs.nbr_wvl
+    rho_layers=inputs.rho_layers
+    dz=inputs.dz
 
-    # initialize arrays
-    g_sum = np.zeros([nbr_lyr, nbr_wvl])
-    SSA_sum = np.zeros([nbr_lyr, nbr_aer, nbr_wvl])
-    tau = np.zeros([nbr_lyr, nbr_wvl])
-    SSA = np.zeros([nbr_lyr, nbr_wvl])
-    g = np.zeros([nbr_lyr, nbr_wvl])
-    L_aer = np.zeros([nbr_lyr, nbr_aer, nbr_wvl])
-    tau_aer = np.zeros([nbr_lyr, nbr_aer, nbr_wvl])
-    tau_sum = np.zeros([nbr_lyr, nbr_wvl])
-    SSA_sum = np.zeros([nbr_lyr, nbr_wvl])
     L_snw = np.zeros(nbr_lyr)
     tau_snw = np.zeros([nbr_lyr,nbr_wvl])
 
-
     # for each layer, the layer mass (L) is density * layer thickness
     # for each layer the optical depth is the layer mass * the mass extinction coefficient
-    # first for the ice in each layer
     
     for i in range(nbr_lyr):
 
         L_snw[i] = rho_layers[i] * dz[i]
         tau_snw[i, :] = L_snw[i] * MAC_snw[i, :]
 
+    return L_snw, tau_snw
+
+
+def sum_impurity_optics(inputs, L_snw, SSAaer, MACaer, Gaer, MSSaer):
+
+    """
+    returns the tau, tau*SSA and tau*SSA*g summed over the impurities. Note that
+    the contributions of the impurities in every layer are summed and the total
+    is applied to all layers, so tau_sum, SSA_sum and g_sum have identical rows.
+
+    """
+
+    import numpy as np
+
+    nbr_lyr = inputs.nbr_lyr
+    nbr_aer = inputs.nbr_aer
+    nbr_wvl = inputs.nbr_wvl
 
+    g_sum = np.zeros([nbr_lyr, nbr_wvl])
+    L_aer = np.zeros([nbr_lyr, nbr_aer, nbr_wvl])
+    tau_aer = np.zeros([nbr_lyr, nbr_aer, nbr_wvl])
+    tau_sum = np.zeros([nbr_lyr, nbr_wvl])
+    SSA_sum = np.zeros([nbr_lyr, nbr_wvl])
 
-    # then for the LAPs in each layer
     for i in range(nbr_lyr):
         for j in range(nbr_aer):
 
@@ -502,41 +933,26 @@ def snicar_feeder(inputs):
             SSA_sum = SSA_sum + (tau_aer[i, j, :] * SSAaer[j, :])
             g_sum = g_sum + (tau_aer[i, j, :] * SSAaer[j, :] * Gaer[j, :])
 
+    return tau_sum, SSA_sum, g_sum
 
-    # finally, for each layer calculate the effective SSA, tau and g for the snow+LAP
-    for i in range(nbr_lyr):
-        
-        tau[i,:] = tau_sum[i,:] + tau_snw[i,:]
-        SSA[i,:] = (1 / tau[i,:]) * (SSA_sum[i,:] + SSA_snw[i,:] * tau_snw[i,:])
-        g[i, :] = (1 / (tau[i, :] * (SSA[i, :]))) * (g_sum[i,:] + (g_snw[i, :] * SSA_snw[i, :] * tau_snw[i, :]))
+
+def combine_optical_properties(tau_snw, SSA_snw, g_snw, tau_sum, SSA_sum, g_sum):
+
+    """
+    calculates the effective tau, SSA and g of the ice + impurity mixture in each
+    layer. tau_sum, SSA_sum and g_sum can have extra leading axes (e.g. one per
+    impurity concentration), which are carried through to the outputs.
+
+    """
+
+    tau = tau_sum + tau_snw
+    SSA = (1 / tau) * (SSA_sum + SSA_snw * tau_snw)
+    g = (1 / (tau * SSA)) * (g_sum + (g_snw * SSA_snw * tau_snw))
         
-    inputs.tau=tau
-    inputs.SSA=SSA
-    inputs.g=g
-    inputs.L_snw=L_snw
     # just in case any unrealistic values arise (none detected so far)
     SSA[SSA<=0]=0.00000001
     SSA[SSA>=1]=0.99999999
     g[g<=0]=0.00001
     g[g>=1]=0.99999
 
-    # CALL RT SOLVER (TOON  = TOON ET AL, TRIDIAGONAL MATRIX METHOD; 
-    # ADD_DOUBLE = ADDING-DOUBLING METHOD)
-    
-    outputs = c.namedtuple('outputs',['wvl', 'albedo', 'BBA', 'BBAVIS', 'BBANIR', 'abls_slr', 'heat_rt'])
-
-   
-    if TOON: 
-        
-        outputs.wvl, outputs.albedo, outputs.BBA, outputs.BBAVIS, outputs.BBANIR, outputs.abs_slr, outputs.heat_rt = toon_solver(inputs)
-
-
-    if ADD_DOUBLE:
-
-        outputs.wvl, outputs.albedo, outputs.BBA, outputs.BBAVIS, outputs.BBANIR, outputs.abs_slr, outputs.heat_rt = adding_doubling_solver(inputs)
-
-    return outputs
-
-
-
-
+    return tau, SSA, g
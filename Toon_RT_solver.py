@@ -365,3 +365,418 @@ def toon_solver(inputs):
 
     return wvl, albedo, BBA, BBAVIS, BBANIR, abs_slr, heat_rt
 
+
+
+
+def toon_solver_batch(inputs):
+
+    """
+    Vectorised version of toon_solver() that solves many columns and/or solar
+    zeniths in one call. The physics and the order of operations are the same as
+    in toon_solver(), but instead of looping over wavelengths every step operates
+    on whole arrays.
+
+    inputs.tau, inputs.SSA and inputs.g have shape (..., nbr_lyr, nbr_wvl), where
+    any leading axes index independent columns. inputs.mu_not can be a scalar or a
+    1D array of cosines of the solar zenith; in the latter case inputs.Fs, inputs.Fd
+    and inputs.flx_slr have shape (len(mu_not), nbr_wvl) and every output has a
+    leading zenith axis.
+
+    The terms that do not depend on the solar zenith (delta scaling, gamma1, gamma2,
+    lam, GAMMA, e1-e4 and the A, B, D diagonals and their Thomas factorisation)
+    are calculated once and shared by all zeniths. Only the direct beam terms (the
+    C-functions, the right hand side E and the back-substitution) are evaluated
+    per zenith.
+
+    Setting inputs.TRUNCATE to a transmission tolerance (e.g. 1e-5) removes the
+    layers below the depth that less than TRUNCATE of the direct and diffuse
+    radiation reaches at every wavelength, zenith and column (estimated by
+    truncation_depth()) and replaces them with a reflecting boundary with the
+    two-stream reflectivity of the first removed layer extended to the optical
+    depth of all removed layers. The removed layers are returned with zero
+    absorption and heating rate, and the absorption of the boundary is counted
+    with the underlying surface.
+
+    If inputs.layer_repeats is set (by SNICAR_feeder.solve_layers()), each layer of
+    tau, SSA and g stands for layer_repeats identical layers. The matrix is solved
+    for one layer per run with the total optical depth of the run, and the net
+    flux at the base of each original layer inside a run is found from the
+    analytic two-stream solution within the layer (Toon et al. eq 31 and 32), so
+    the absorption and heating rate are returned for every original layer.
+
+    Setting inputs.SINGLE_PRECISION solves the matrix in float32, which halves the
+    memory and bandwidth of the layer, matrix and right hand side arrays. The
+    net fluxes are converted to float64 before the absorption, heating rate,
+    albedo and energy conservation check are calculated.
+
+    """
+
+    import numpy as np
+
+    dtype = np.float32 if getattr(inputs, 'SINGLE_PRECISION', False) else np.float64
+
+    # inputs.JIT selects the numba-compiled tridiagonal solver (jit_kernels.py)
+    if getattr(inputs, 'JIT', False):
+        from jit_kernels import tridiagonal_factor, tridiagonal_solve
+    else:
+        from Toon_RT_solver import tridiagonal_factor, tridiagonal_solve
+
+    tau=np.asarray(inputs.tau, dtype=dtype)
+    SSA=np.asarray(inputs.SSA, dtype=dtype)
+    g=np.asarray(inputs.g, dtype=dtype)
+    wvl=inputs.wvl
+    nbr_lyr=inputs.nbr_lyr
+    nbr_trunc=inputs.nbr_lyr
+    repeats=getattr(inputs, 'layer_repeats', None)
+    R_sfc=np.asarray(inputs.R_sfc, dtype=dtype)
+    L_snw=np.asarray(inputs.L_snw)
+    DELTA=inputs.DELTA
+    APRX_TYP=inputs.APRX_TYP
+
+    # zenith dependent arrays get a leading zenith axis of length nbr_zen and are
+    # reshaped so that they broadcast against the column axes of tau
+    single_zenith = np.ndim(inputs.mu_not) == 0
+    mu_not = np.atleast_1d(inputs.mu_not).astype(dtype)
+    nbr_zen = len(mu_not)
+    nbr_wvl = tau.shape[-1]
+    batch_ndim = tau.ndim - 2
+
+    mu_lyr = mu_not.reshape((nbr_zen,) + (1,)*(batch_ndim+2))
+    mu_clm = mu_not.reshape((nbr_zen,) + (1,)*(batch_ndim+1))
+    Fs = np.asarray(inputs.Fs, dtype=dtype).reshape((nbr_zen,) + (1,)*batch_ndim + (nbr_wvl,))
+    Fd = np.asarray(inputs.Fd, dtype=dtype).reshape((nbr_zen,) + (1,)*batch_ndim + (nbr_wvl,))
+    flx_slr = np.asarray(inputs.flx_slr, dtype=float).reshape((nbr_zen,) + (1,)*batch_ndim + (nbr_wvl,))
+
+    # merged runs of identical layers are solved as one layer with the optical
+    # depth of the whole run
+    if repeats is not None:
+        repeats = np.asarray(repeats)
+        tau = tau*repeats[:, np.newaxis].astype(dtype)
+        nbr_trunc = int(np.sum(repeats))
+
+    # no direct-beam flux: C-functions are set to zero as in toon_solver()
+    has_direct = (np.sum(Fs, axis=-1, keepdims=True) > 0.0)[..., np.newaxis, :]
+
+    ############################################
+    # ZENITH INDEPENDENT TERMS
+    ############################################
+
+    if DELTA:
+        g_star = g/(1+g)
+        SSA_star = ((1-(g**2))*SSA)/(1-(SSA*(g**2)))
+        tau_star = (1-(SSA*(g**2)))*tau
+
+    else:
+        g_star = g
+        SSA_star = SSA
+        tau_star = tau
+
+    # cumulative optical depth above the upper boundary of each layer
+    tau_clm = np.zeros(tau_star.shape, dtype=dtype)
+    tau_clm[..., 1:, :] = np.cumsum(tau_star[..., :-1, :], axis=-2)
+
+    if APRX_TYP == 1:
+        gamma1 = (7-(SSA_star * (4+(3*g_star))))/4
+        gamma2 = -(1-(SSA_star*(4-(3*g_star))))/4
+        gamma3 = (2-(3*g_star*mu_lyr))/4
+        mu_one = 0.5
+
+    elif APRX_TYP == 2:
+        gamma1 = dtype(np.sqrt(3))*(2-(SSA_star*(1+g_star)))/2
+        gamma2 = SSA_star * dtype(np.sqrt(3))*(1-g_star)/2
+        gamma3 = (1-(dtype(np.sqrt(3))*g_star*mu_lyr))/2
+        mu_one = 1/np.sqrt(3)
+
+    elif APRX_TYP == 3:
+        gamma1 = 2 - (SSA_star*(1+g_star))
+        gamma2 = SSA_star*(1-g_star)
+        gamma3 = (1-(dtype(np.sqrt(3)) * g_star*mu_lyr))/2
+        mu_one = 0.5
+
+    gamma4 = 1-gamma3
+
+    lam = np.sqrt(abs((gamma1**2)-(gamma2**2)))
+    GAMMA = gamma2/(gamma1+lam)
+
+    exp_lam = np.exp(-lam*tau_star)
+
+    if getattr(inputs, 'TRUNCATE', 0) > 0:
+
+        nbr_kept = int(np.max(truncation_depth(exp_lam, GAMMA, np.exp(-tau_clm/mu_lyr), inputs.TRUNCATE)))
+
+        # keep at least two layers because C_pls_top uses lam of the second layer
+        nbr_kept = min(max(nbr_kept, 2), nbr_lyr)
+
+        if nbr_kept < nbr_lyr:
+
+            # two-stream reflectivity of the removed layers as one layer (Toon et al. 1989)
+            exp_bnd = np.exp(-lam[..., nbr_kept, :]*np.sum(tau_star[..., nbr_kept:, :], axis=-2))
+            R_sfc = GAMMA[..., nbr_kept, :]*(1-exp_bnd**2)/(1-(GAMMA[..., nbr_kept, :]*exp_bnd)**2)
+
+            nbr_lyr = nbr_kept
+            tau, tau_star, SSA_star, tau_clm = tau[..., :nbr_lyr, :], tau_star[..., :nbr_lyr, :],\
+                SSA_star[..., :nbr_lyr, :], tau_clm[..., :nbr_lyr, :]
+            gamma1, gamma2, gamma3, gamma4 = gamma1[..., :nbr_lyr, :], gamma2[..., :nbr_lyr, :],\
+                gamma3[..., :nbr_lyr, :], gamma4[..., :nbr_lyr, :]
+            lam, GAMMA, exp_lam = lam[..., :nbr_lyr, :], GAMMA[..., :nbr_lyr, :], exp_lam[..., :nbr_lyr, :]
+            if repeats is not None:
+                repeats = repeats[:nbr_lyr]
+
+    e1 = 1+(GAMMA*exp_lam)
+    e2 = 1-(GAMMA*exp_lam)
+    e3 = GAMMA+exp_lam
+    e4 = GAMMA-exp_lam
+
+    # tridiagonal matrix diagonals, Toon et al equations 41-43. Rows 0, 2, 4...
+    # are the "even" rows and 1, 3, 5... the "odd" rows of toon_solver()
+    shape2 = tau.shape[:-2] + (2*nbr_lyr, nbr_wvl)
+    A = np.zeros(shape2, dtype=dtype)
+    B = np.zeros(shape2, dtype=dtype)
+    D = np.zeros(shape2, dtype=dtype)
+
+    B[..., 0, :] = e1[..., 0, :]
+    D[..., 0, :] = -e2[..., 0, :]
+
+    A[..., 2::2, :] = (e2[..., :-1, :] * e3[..., :-1, :])-(e4[..., :-1, :] * e1[..., :-1, :])
+    B[..., 2::2, :] = (e1[..., :-1, :] * e1[..., 1:, :])-(e3[..., :-1, :] * e3[..., 1:, :])
+    D[..., 2::2, :] = (e3[..., :-1, :] * e4[..., 1:, :])-(e1[..., :-1, :] * e2[..., 1:, :])
+
+    A[..., 1:-1:2, :] = (e2[..., 1:, :] * e1[..., :-1, :])-(e3[..., :-1, :] * e4[..., 1:, :])
+    B[..., 1:-1:2, :] = (e2[..., :-1, :] * e2[..., 1:, :])-(e4[..., :-1, :] * e4[..., 1:, :])
+    D[..., 1:-1:2, :] = (e1[..., 1:, :] * e4[..., 1:, :])-(e2[..., 1:, :] * e3[..., 1:, :])
+
+    A[..., -1, :] = e1[..., -1, :]-(R_sfc * e3[..., -1, :])
+    B[..., -1, :] = e2[..., -1, :]-(R_sfc * e4[..., -1, :])
+
+    # Thomas factorisation of the matrix (Toon et al Eq 45 and 46)
+    AS, X = tridiagonal_factor(A, B, D)
+
+    ############################################
+    # ZENITH DEPENDENT TERMS
+    ############################################
+
+    # direct beam attenuated to the top and bottom of each layer
+    exp_top = np.exp(-tau_clm/mu_lyr)
+    exp_btm = np.exp(-(tau_clm+tau_star)/mu_lyr)
+
+    C_denom = (lam**2)-(1/(mu_lyr**2))
+    C_pls = (((gamma1-(1/mu_lyr))*gamma3)+(gamma4*gamma2))
+    C_mns = (((gamma1+(1/mu_lyr))*gamma4)+(gamma2*gamma3))
+
+    C_pls_btm = np.where(has_direct, (SSA_star*np.pi*Fs[..., np.newaxis, :]*exp_btm*C_pls)/C_denom, 0)
+    C_mns_btm = np.where(has_direct, (SSA_star*np.pi*Fs[..., np.newaxis, :]*exp_btm*C_mns)/C_denom, 0)
+    C_mns_top = np.where(has_direct, (SSA_star*np.pi*Fs[..., np.newaxis, :]*exp_top*C_mns)/C_denom, 0)
+
+    # as in toon_solver(), C_pls_top uses lam of the second layer for every layer
+    C_pls_top = np.where(has_direct, (SSA_star*np.pi*Fs[..., np.newaxis, :]*exp_top*C_pls)\
+        /((lam[..., 1:2, :]**2)-(1/mu_lyr**2)), 0)
+
+    S_sfc = R_sfc * mu_clm * exp_btm[..., -1, :] * np.pi * Fs
+
+    E = np.zeros((nbr_zen,) + shape2, dtype=dtype)
+    E[..., 0, :] = Fd-C_mns_top[..., 0, :]
+    E[..., 2::2, :] = (e3[..., :-1, :] * (C_pls_top[..., 1:, :] - C_pls_btm[..., :-1, :]))\
+        + (e1[..., :-1, :] * (C_mns_btm[..., :-1, :] - C_mns_top[..., 1:, :]))
+    E[..., 1:-1:2, :] = (e2[..., 1:, :] * (C_pls_top[..., 1:, :] - C_pls_btm[..., :-1, :]))\
+        + (e4[..., 1:, :] * (C_mns_top[..., 1:, :] - C_mns_btm[..., :-1, :]))
+    E[..., -1, :] = S_sfc - C_pls_btm[..., -1, :] + (R_sfc * C_mns_btm[..., -1, :])
+
+    # back substitution (Toon et al Eq 46 and 47)
+    Y = tridiagonal_solve(AS, X, B, D, E)
+
+    # direct beam flux and net flux at the base of each layer (Toon et al. eq 48 and 50)
+    direct = mu_lyr * np.pi * Fs[..., np.newaxis, :] * exp_btm
+    F_net = (Y[..., 0::2, :] * (e1-e3)) + (Y[..., 1::2, :] * (e2-e4)) + C_pls_btm - C_mns_btm - direct
+
+    # upward flux at upper model boundary (Toon et al Eq 31)
+    F_top_pls = (Y[..., 0, :] * (exp_lam[..., 0, :] + GAMMA[..., 0, :])) + (Y[..., 1, :] * (exp_lam[..., 0, :]-GAMMA[..., 0, :])) + C_pls_top[..., 0, :]
+
+    # everything from here on, including the energy conservation check, is
+    # calculated in float64
+    F_net, F_top_pls, Fs, Fd, mu_clm = (np.asarray(x, dtype=np.float64) for x in (F_net, F_top_pls, Fs, Fd, mu_clm))
+
+    F_btm_net = -F_net[..., -1, :]
+
+    incident = (mu_clm * np.pi * Fs) + Fd
+    albedo = F_top_pls/incident
+    F_top_net = F_top_pls - incident
+
+    if repeats is not None:
+        F_net = interior_net_flux(repeats, Y, F_net, lam, GAMMA, tau_clm, tau_star, mu_lyr,\
+            has_direct, SSA_star*np.pi*Fs[..., np.newaxis, :]*C_pls/C_denom,\
+            SSA_star*np.pi*Fs[..., np.newaxis, :]*C_mns/C_denom, np.pi*Fs[..., np.newaxis, :])
+
+    F_abs = np.zeros(F_net.shape)
+    F_abs[..., 0, :] = F_net[..., 0, :]-F_top_net
+    F_abs[..., 1:, :] = F_net[..., 1:, :] - F_net[..., :-1, :]
+
+    vis_max_idx = 39
+
+    abs_slr = np.sum(F_abs,axis=-1)
+
+    heat_rt = abs_slr / (L_snw[..., :abs_slr.shape[-1]] * 2117) # [K / s]
+    heat_rt = heat_rt * 3600 # [K / hr]
+
+    if abs_slr.shape[-1] < nbr_trunc:
+        pad = [(0, 0)]*(abs_slr.ndim-1) + [(0, nbr_trunc-abs_slr.shape[-1])]
+        abs_slr = np.pad(abs_slr, pad)
+        heat_rt = np.pad(heat_rt, pad)
+
+    # energy conservation check, per column
+    energy_sum = incident - (np.sum(F_abs, axis=-2) + F_btm_net + F_top_pls)
+    energy_error = abs(np.sum(energy_sum, axis=-1))
+
+    if np.any(energy_error > 1e-10):
+        energy_conservation_error = np.max(np.sum(abs(energy_sum), axis=-1))
+        print(f"CONSERVATION OF ENERGY ERROR OF {energy_conservation_error}")
+
+    BBA = np.sum(flx_slr * albedo, axis=-1) / np.sum(flx_slr, axis=-1)
+    BBAVIS = np.sum(flx_slr[..., 0:vis_max_idx]*albedo[..., 0:vis_max_idx], axis=-1)\
+        / np.sum(flx_slr[..., 0:vis_max_idx], axis=-1)
+    BBANIR = np.sum(flx_slr[..., vis_max_idx:]*albedo[..., vis_max_idx:], axis=-1)\
+        / np.sum(flx_slr[..., vis_max_idx:], axis=-1)
+
+    if single_zenith:
+        albedo, BBA, BBAVIS, BBANIR, abs_slr, heat_rt = albedo[0], BBA[0], BBAVIS[0], BBANIR[0], abs_slr[0], heat_rt[0]
+
+    return wvl, albedo, BBA, BBAVIS, BBANIR, abs_slr, heat_rt
+
+
+
+def interior_net_flux(repeats, Y, F_net, lam, GAMMA, tau_clm, tau_star, mu_lyr, has_direct, C_pls, C_mns, S):
+
+    """
+    net flux at the base of every original layer of a column whose runs of
+    identical layers were solved as single layers by toon_solver_batch().
+    Within a merged layer the upward and downward fluxes at delta-scaled optical
+    depth t below its top are (Toon et al. eq 31 and 32)
+
+        F+ = Y1(exp(-lam(tau*-t)) + GAMMA exp(-lam t)) + Y2(exp(-lam(tau*-t)) - GAMMA exp(-lam t)) + C+(t)
+        F- = Y1(GAMMA exp(-lam(tau*-t)) + exp(-lam t)) + Y2(GAMMA exp(-lam(tau*-t)) - exp(-lam t)) + C-(t)
+
+    with C+(t) and C-(t) the direct beam terms at t. C_pls and C_mns are the
+    direct beam terms without the attenuation exp(-(tau_clm+t)/mu) and S is
+    pi*Fs. The original layers divide each run into repeats equal parts.
+    returns the net flux at the base of each original layer
+
+    """
+
+    import numpy as np
+
+    run = np.repeat(np.arange(len(repeats)), repeats)
+    last = np.cumsum(repeats)-1
+
+    # fraction of the run above the base of each original layer
+    frac = (np.arange(len(run)) - (last-repeats+1)[run] + 1) / repeats[run]
+    frac = frac[:, np.newaxis]
+
+    lam_tau = lam[..., run, :]*tau_star[..., run, :]
+    a = np.exp(-lam_tau*(1-frac))
+    b = np.exp(-lam_tau*frac)
+    t = tau_star[..., run, :]*frac
+
+    Y1 = Y[..., 0::2, :][..., run, :]
+    Y2 = Y[..., 1::2, :][..., run, :]
+    G = GAMMA[..., run, :]
+    exp_dir = np.exp(-(tau_clm[..., run, :]+t)/mu_lyr)
+
+    F_pls = Y1*(a+G*b) + Y2*(a-G*b) + np.where(has_direct, C_pls[..., run, :]*exp_dir, 0)
+    F_mns = Y1*(G*a+b) + Y2*(G*a-b) + np.where(has_direct, C_mns[..., run, :]*exp_dir, 0)
+
+    F_sub = F_pls - F_mns - mu_lyr*S*exp_dir
+
+    # the base of each run is exactly the solution of the merged layer
+    F_sub[..., last, :] = F_net
+
+    return F_sub
+
+
+def truncation_depth(exp_lam, GAMMA, exp_top, tol):
+
+    """
+    estimates, for each column and wavelength, the number of layers from the top
+    above the first interface that receives less than tol of the incident radiation
+    for every zenith. The direct beam transmission is exp_top and the diffuse
+    transmission is found by adding the two-stream reflectivity and
+    transmissivity of each layer (calculated from GAMMA and exp_lam as in Toon et
+    al. 1989) from the top down.
+
+    """
+
+    import numpy as np
+
+    R = GAMMA*(1-exp_lam**2)/(1-(GAMMA*exp_lam)**2)
+    T = (1-GAMMA**2)*exp_lam/(1-(GAMMA*exp_lam)**2)
+
+    nbr_lyr = exp_lam.shape[-2]
+    depth = np.full(exp_lam.shape[:-2] + exp_lam.shape[-1:], nbr_lyr)
+    trndif = np.ones(depth.shape)
+    rdndif = np.zeros(depth.shape)
+    found = np.zeros(depth.shape, dtype=bool)
+
+    for lyr in np.arange(1, nbr_lyr, 1):
+
+        refk = 1/(1-rdndif*R[..., lyr-1, :])
+        rdndif = R[..., lyr-1, :] + T[..., lyr-1, :]**2*rdndif*refk
+        trndif = trndif*T[..., lyr-1, :]*refk
+
+        deep = (np.maximum(np.max(exp_top[..., lyr, :], axis=0), trndif) < tol) & ~found
+        depth[deep] = lyr
+        found |= deep
+
+        if np.all(found):
+            break
+
+    return depth
+
+
+def tridiagonal_factor(A, B, D):
+
+    """
+    Thomas factorisation of the tridiagonal matrix with sub-diagonal A, diagonal B
+    and super-diagonal D (Toon et al Eq 45 and 46), working from the bottom row
+    up along axis -2. Only depends on the layer properties, so it can be shared
+    by all solar zeniths.
+    returns AS, X
+
+    """
+
+    import numpy as np
+
+    np.seterr(divide='ignore',invalid='ignore')
+    AS = np.zeros(A.shape, dtype=A.dtype)
+    X = np.zeros(A.shape, dtype=A.dtype)
+    AS[..., -1, :] = np.nan_to_num(A[..., -1, :]/B[..., -1, :])
+
+    for i in np.arange(A.shape[-2]-2,-1, -1):
+        X[..., i, :] = 1/(B[..., i, :]-(D[..., i, :] * AS[..., i+1, :]))
+        AS[..., i, :] = np.nan_to_num(A[..., i, :]*X[..., i, :])
+
+    return AS, X
+
+
+def tridiagonal_solve(AS, X, B, D, E):
+
+    """
+    back substitution for the right hand side E (Toon et al Eq 46 and 47) using
+    the factorisation from tridiagonal_factor(). E can have extra leading axes
+    (e.g. one per solar zenith).
+    returns Y
+
+    """
+
+    import numpy as np
+
+    DS = np.zeros(E.shape, dtype=E.dtype)
+    DS[..., -1, :] = np.nan_to_num(E[..., -1, :]/B[..., -1, :])
+
+    for i in np.arange(E.shape[-2]-2,-1, -1):
+        DS[..., i, :] = np.nan_to_num((E[..., i, :]-(D[..., i, :]*DS[..., i+1, :]))*X[..., i, :])
+
+    Y = np.zeros(E.shape, dtype=E.dtype)
+    Y[..., 0, :] = DS[..., 0, :]
+
+    for i in np.arange(1,E.shape[-2],1):
+        Y[..., i, :] = DS[..., i, :] - (AS[..., i, :]*Y[..., i-1, :])
+
+    return Y
@@ -16,7 +16,6 @@ def adding_doubling_solver(inputs):
     """
     
     import numpy as np
-    import xarray as xr
     
     #load variables from input table
     tau=inputs.tau
@@ -109,35 +108,14 @@ def adding_doubling_solver(inputs):
     # the interface just above a given layer is less than trmin, then no
     # Delta-Eddington computation for that layer is done.
     
-    Fresnel_Diffuse_File = xr.open_dataset(dir_RI_ice+'FL_reflection_diffuse.nc')
+    # refractive indices and diffuse Fresnel reflectivities, read once (from the
+    # shared optical library if one is attached, see optical_library.py)
+    refidx_re, refidx_im, FL_r_dif_a, FL_r_dif_b = load_ice_refractive_index(dir_base, rf_ice)
 
     for wl in np.arange(0,nbr_wvl,1): # loop through wavelengths
         
         for lyr in np.arange(0,nbr_lyr,1):   # loop through layers
 
-            # open refractive index file and grab real and imaginary parts
-            refidx_file = xr.open_dataset(dir_RI_ice+'rfidx_ice.nc')
-
-            if rf_ice == 0:
-
-                refidx_re = refidx_file['re_Wrn84'].values
-                refidx_im = refidx_file['im_Wrn84'].values 
-                FL_r_dif_a = Fresnel_Diffuse_File['R_dif_fa_ice_Wrn84'].values
-                FL_r_dif_b = Fresnel_Diffuse_File['R_dif_fb_ice_Wrn84'].values
-
-            elif rf_ice == 1:
-                refidx_re = refidx_file['re_Wrn08'].values
-                refidx_im = refidx_file['im_Wrn08'].values 
-                FL_r_dif_a = Fresnel_Diffuse_File['R_dif_fa_ice_Wrn08'].values
-                FL_r_dif_b = Fresnel_Diffuse_File['R_dif_fb_ice_Wrn08'].values
-
-            elif rf_ice == 2:
-                refidx_re = refidx_file['re_Pic16'].values
-                refidx_im = refidx_file['im_Pic16'].values
-                FL_r_dif_a = Fresnel_Diffuse_File['R_dif_fa_ice_Pic16'].values
-                FL_r_dif_b = Fresnel_Diffuse_File['R_dif_fb_ice_Pic16'].values 
-
-
             refindx = refidx_re[wl]+refidx_im[wl]  # combine real and imaginary parts into one var
             
             temp1 = refidx_re[wl]**2 - refidx_im[wl]**2 + np.sin(np.arccos(mu_not))**2
@@ -552,3 +530,792 @@ def adding_doubling_solver(inputs):
 
 
     return wvl, albedo, alb_bb, alb_vis, alb_nir, F_abs_slr, heat_rt
+
+
+
+def load_ice_refractive_index(dir_base, rf_ice):
+
+    """
+    returns the real and imaginary refractive index of ice and the precalculated
+    diffuse Fresnel reflectivities from above and below (FL_r_dif_a, FL_r_dif_b)
+    for the refractive index dataset selected by rf_ice (0 = Warren 84,
+    1 = Warren 08, 2 = Picard 16).
+
+    """
+
+    from optical_library import read_optical_variable
+
+    dir_RI_ice = str(dir_base + 'Data/')
+    name = {0: 'Wrn84', 1: 'Wrn08', 2: 'Pic16'}[rf_ice]
+
+    refidx_re = read_optical_variable(dir_RI_ice+'rfidx_ice.nc', 're_'+name)
+    refidx_im = read_optical_variable(dir_RI_ice+'rfidx_ice.nc', 'im_'+name)
+
+    FL_r_dif_a = read_optical_variable(dir_RI_ice+'FL_reflection_diffuse.nc', 'R_dif_fa_ice_'+name)
+    FL_r_dif_b = read_optical_variable(dir_RI_ice+'FL_reflection_diffuse.nc', 'R_dif_fb_ice_'+name)
+
+    return refidx_re, refidx_im, FL_r_dif_a, FL_r_dif_b
+
+
+def delta_eddington_layer(tau, SSA, g, exp_min=1e-5):
+
+    """
+    delta-scales the layer optical properties and calculates the Delta-Eddington
+    reflectivity (R1) and transmissivity (T1) to diffuse radiation
+    (Eq. 50: Briegleb and Light 2007). None of these depend on the solar zenith.
+    returns ts, ws, gs, lm, R1, T1
+
+    """
+
+    import numpy as np
+
+    ftot = g * g
+    ts = (1-(SSA * ftot)) * tau
+    ws = ((1-ftot) * SSA) / (1-(SSA * ftot))
+    gs = (g-ftot)/(1-ftot)
+    lm = np.sqrt(3 * (1-ws) * (1-ws * gs))
+    ue = 1.5 * (1-ws * gs) / lm
+
+    # the exponential is evaluated in float64 even for float32 inputs
+    extins = np.maximum(exp_min, np.exp(-np.multiply(lm, ts, dtype=np.float64))).astype(ts.dtype, copy=False)
+    ne = (ue+1)**2 / extins - (ue-1)**2 * extins
+
+    R1 = (ue**2-1) * (1/extins - extins)/ne
+    T1 = 4*ue/ne
+
+    return ts, ws, gs, lm, R1, T1
+
+
+def direct_beam_layer(ts, ws, gs, lm, R1, T1, mu0n, epsilon=1e-5, exp_min=1e-5):
+
+    """
+    layer reflectivity (rdir) and transmissivity (tdir) to a beam with cosine
+    zenith mu0n, and the transmission of the unscattered beam (trnlay).
+    mu0n broadcasts against the layer arrays so several beam angles can be
+    evaluated at once.
+
+    """
+
+    import numpy as np
+
+    trnlay = np.maximum(exp_min, np.exp(-np.divide(ts, mu0n, dtype=np.float64))).astype(ts.dtype, copy=False)
+
+    alp = (0.75 * ws * mu0n) * ((1 + gs * (1-ws)) / (1 - lm**2 * mu0n**2 + epsilon))
+    gam = (0.5 * ws) * ((1 + 3 * gs * mu0n**2 * (1-ws)) / (1-lm**2 * mu0n**2 + epsilon))
+
+    apg = alp + gam
+    amg = alp - gam
+
+    rdir = apg*R1 + amg*(T1*trnlay - 1)
+    tdir = apg*T1 + (amg*R1-apg+1)*trnlay
+
+    return rdir, tdir, trnlay
+
+
+def gaussian_diffuse_layer(ts, ws, gs, lm, R1, T1):
+
+    """
+    recalculates the layer reflectivity and transmissivity to diffuse radiation
+    by gaussian integration of the direct beam solution over 8 angles, because the
+    Delta-Eddington diffuse formulae are biased low.
+    returns rdif, tdif
+
+    """
+
+    gauspt = [0.9894009, 0.9445750, 0.8656312, 0.7554044, 0.6178762, 0.4580168, 0.2816036, 0.0950125]
+    gauswt = [0.0271525, 0.0622535, 0.0951585, 0.1246290, 0.1495960, 0.1691565, 0.1826034, 0.1894506]
+
+    swt = 0
+    smr = 0
+    smt = 0
+
+    for mu, gwt in zip(gauspt, gauswt):
+        rdr, tdr, _ = direct_beam_layer(ts, ws, gs, lm, R1, T1, mu)
+        swt = swt + mu*gwt
+        smr = smr + mu*rdr*gwt
+        smt = smt + mu*tdr*gwt
+
+    return smr/swt, smt/swt
+
+
+def refracted_beam(mu_not, refidx_re, refidx_im):
+
+    """
+    real refractive index adjusted for absorption (nr) and cosine of the beam
+    refracted into the ice (mu0n) (Eq. 20: Briegleb & Light 2007). mu_not
+    broadcasts against the refractive index arrays.
+    returns nr, mu0n
+
+    """
+
+    import numpy as np
+
+    temp1 = refidx_re**2 - refidx_im**2 + np.sin(np.arccos(mu_not))**2
+    temp2 = refidx_re**2 - refidx_im**2 - np.sin(np.arccos(mu_not))**2
+    nr = (np.sqrt(2)/2) * (temp1 + (temp2**2 + 4*refidx_re**2*refidx_im**2)**0.5)**0.5
+
+    mu0n = np.cos(np.arcsin(np.sin(np.arccos(mu_not))/nr))
+
+    return nr, mu0n
+
+
+def fresnel_direct(mu0, mu0n, nr, refidx_re, refidx_im):
+
+    """
+    Fresnel reflectivity and transmissivity of the Fresnel layer to the direct
+    beam (Eq. 21 and 22: Briegleb & Light 2007), with total internal reflection
+    beyond the critical angle.
+    returns Rf_dir_a, Tf_dir_a
+
+    """
+
+    import numpy as np
+
+    R1 = (mu0-nr*mu0n) / (mu0 + nr*mu0n)
+    R2 = (nr*mu0 - mu0n) / (nr*mu0 + mu0n)
+    T1 = 2*mu0 / (mu0 + nr*mu0n)
+    T2 = 2 * mu0 / (nr * mu0 + mu0n)
+
+    critical_angle = np.real(np.arcsin(refidx_re + 1j*refidx_im))
+    no_tir = np.arccos(mu0) < critical_angle
+
+    Rf_dir_a = np.where(no_tir, 0.5 * (R1**2 + R2**2), 1)
+    Tf_dir_a = np.where(no_tir, 0.5 * (T1**2 + T2**2) * nr * mu0n / mu0, 0)
+
+    return Rf_dir_a, Tf_dir_a
+
+
+def adding_doubling_solver_batch(inputs):
+
+    """
+    Vectorised version of adding_doubling_solver() that solves many columns and/or
+    solar zeniths in one call.
+
+    inputs.tau, inputs.SSA and inputs.g have shape (..., nbr_lyr, nbr_wvl), where
+    any leading axes index independent columns that share layer_type and rf_ice.
+    inputs.mu_not can be a scalar or a 1D array of cosines of the solar zenith;
+    in the latter case inputs.Fs, inputs.Fd and inputs.flx_slr have shape
+    (len(mu_not), nbr_wvl) and every output has a leading zenith axis.
+
+    The delta-scaled layer properties, the diffuse reflectivities and
+    transmissivities (including the 8 point gaussian integration and the diffuse
+    Fresnel terms) and the diffuse parts of the adding calculation are computed
+    once and shared by all zeniths. Only the direct beam terms are evaluated per
+    zenith. The refractive index and diffuse Fresnel files are read once per call
+    instead of once per wavelength and layer.
+
+    Unlike adding_doubling_solver(), every layer is calculated even where less than
+    trmin of the direct beam reaches it, so results can differ from the loop version
+    in the 5th decimal place for very optically thick columns.
+
+    Setting inputs.TRUNCATE to a transmission tolerance (e.g. 1e-5) truncates the
+    column separately at each wavelength below the depth that less than TRUNCATE
+    of the direct and diffuse radiation reaches (see truncated_adding()). The
+    spectral albedo then differs from the full solution by at most about
+    TRUNCATE. The absorption below the truncation depth is assigned to the first
+    truncated layer at each wavelength, so the column total is unchanged and the
+    layers below it have zero absorption.
+
+    If inputs.layer_repeats is set (by SNICAR_feeder.solve_layers()), each layer of
+    tau, SSA and g stands for layer_repeats identical layers. The layer
+    properties are calculated once per run (also with TRUNCATE) and the outputs
+    are returned for every original layer. The adding passes and the fluxes are
+    still calculated at every original interface, so only the cost of the layer
+    properties scales with the number of runs.
+
+    Setting inputs.SINGLE_PRECISION stores the layer and interface arrays in
+    float32, which halves their memory and bandwidth. The layer exponentials
+    (see delta_eddington_layer()), the interface terms refkm1 and refkp1 and the
+    fluxes, albedo and energy conservation check (solver_outputs()) are still
+    calculated in float64.
+
+    """
+
+    import numpy as np
+
+    dtype = np.float32 if getattr(inputs, 'SINGLE_PRECISION', False) else np.float64
+
+    tau=np.asarray(inputs.tau, dtype=dtype)
+    SSA=np.asarray(inputs.SSA, dtype=dtype)
+    g=np.asarray(inputs.g, dtype=dtype)
+    nbr_lyr=inputs.nbr_lyr
+
+    single_zenith = np.ndim(inputs.mu_not) == 0
+    mu_clm, Fs, Fd, flx_slr = zenith_axes(inputs, tau.ndim-2, tau.shape[-1])
+    lyrfrsnl = first_fresnel_layer(inputs.layer_type)
+    fresnel = load_ice_refractive_index(inputs.dir_base, inputs.rf_ice)
+
+    # reduced spectral bands (spectral_bands.solve_reduced_bands()): band averaged
+    # refractive indices and diffuse Fresnel reflectivities
+    if getattr(inputs, 'band_matrix', None) is not None:
+        fresnel = tuple(inputs.band_matrix @ np.asarray(x)[:inputs.band_matrix.shape[1]] for x in fresnel)
+
+    # merged runs of identical layers (SNICAR_feeder.solve_layers()): tau, SSA and
+    # g describe one of the identical layers of each run, and layer_repeats gives
+    # the number of original layers in each run
+    repeats = getattr(inputs, 'layer_repeats', None)
+
+    if repeats is not None:
+        nbr_lyr = int(np.sum(repeats))
+
+    if getattr(inputs, 'TRUNCATE', 0) > 0:
+
+        # merged runs: the layer properties are calculated once per run and
+        # repeated, and tau, SSA and g are only expanded for the boundary layer
+        layers = None
+        if repeats is not None:
+            layers = layer_properties(tau, SSA, g, np.arange(tau.shape[-2]), lyrfrsnl, mu_clm, fresnel,\
+                jit=getattr(inputs, 'JIT', False))
+            layers = {key: np.repeat(value, repeats, axis=-2) for key, value in layers.items()}
+            tau, SSA, g = (np.repeat(x, repeats, axis=-2) for x in (tau, SSA, g))
+            lyrfrsnl = first_fresnel_layer(np.repeat(inputs.layer_type, repeats))
+
+        interfaces, _ = truncated_adding(tau, SSA, g, lyrfrsnl, mu_clm, fresnel, inputs.R_sfc, inputs.TRUNCATE,\
+            jit=getattr(inputs, 'JIT', False), layers=layers)
+
+    else:
+
+        layers = layer_properties(tau, SSA, g, np.arange(tau.shape[-2]), lyrfrsnl, mu_clm, fresnel,\
+            jit=getattr(inputs, 'JIT', False))
+
+        # the layer properties are only calculated once per run and the original
+        # layers are added one by one, so the results are the same as without merging
+        if repeats is not None:
+            layers = {key: np.repeat(value, repeats, axis=-2) for key, value in layers.items()}
+            tau = np.repeat(tau, repeats, axis=-2)
+
+        interfaces = empty_interfaces(mu_clm, tau.shape, dtype)
+        adding_down(layers, interfaces, 0)
+        adding_up(layers, interfaces, nbr_lyr, inputs.R_sfc)
+
+    return solver_outputs(inputs, interfaces, mu_clm, Fs, Fd, flx_slr, single_zenith)
+
+
+def truncated_adding(tau, SSA, g, lyrfrsnl, mu_clm, fresnel, R_sfc, tol, jit=False, block=8, layers=None):
+
+    """
+    adding calculation for adding_doubling_solver_batch() that stops adding layers
+    at a wavelength once less than tol of the direct (trntdr) and diffuse (trndif)
+    radiation reaches the next interface, for every column and zenith. The layers
+    below that interface are replaced by a reflecting boundary: one layer with the
+    optical properties of the first truncated layer and the total optical depth of
+    all the layers it replaces, which for these optical depths is effectively
+    semi-infinite. Because less than tol of the radiation reaches the boundary,
+    the change in albedo is at most about tol.
+
+    Layer properties are calculated in blocks of block layers and only for the
+    wavelengths that have not yet been truncated, so strongly absorbing near
+    infrared wavelengths stop after a few layers of a thick snowpack. layers
+    optionally gives the properties of every layer (layer_properties()),
+    calculated beforehand, e.g. once per run of merged layers.
+
+    returns the interfaces dict, with zero transmission below the boundary, and
+    the number of layers kept at each wavelength
+
+    """
+
+    import numpy as np
+
+    nbr_lyr, nbr_wvl = tau.shape[-2:]
+    shape_dir = (mu_clm.shape[0],) + tau.shape
+
+    interfaces = empty_interfaces(mu_clm, tau.shape, tau.dtype)
+
+    precomputed = layers is not None
+    if not precomputed:
+        layers = dict(rdir=np.zeros(shape_dir, tau.dtype), tdir=np.zeros(shape_dir, tau.dtype),\
+            trnlay=np.zeros(shape_dir, tau.dtype), rdif_a=np.zeros(tau.shape, tau.dtype),\
+            rdif_b=np.zeros(tau.shape, tau.dtype), tdif_a=np.zeros(tau.shape, tau.dtype),\
+            tdif_b=np.zeros(tau.shape, tau.dtype))
+
+    depth = np.full(nbr_wvl, nbr_lyr)
+    active = np.arange(nbr_wvl)
+
+    for start in np.arange(0, nbr_lyr, block):
+
+        if active.size == 0:
+            break
+
+        stop = min(start+block, nbr_lyr)
+        lyr_idx = np.arange(start, stop)
+
+        if not precomputed:
+            new = layer_properties(tau[..., start:stop, :][..., active], SSA[..., start:stop, :][..., active],\
+                g[..., start:stop, :][..., active], lyr_idx, lyrfrsnl, mu_clm, tuple(x[active] for x in fresnel),\
+                jit=jit)
+
+            for key in layers:
+                layers[key][..., start:stop, active] = new[key]
+
+        for lyr in lyr_idx:
+
+            adding_down(layers, interfaces, lyr, lyr+1, active)
+
+            if lyr+1 == nbr_lyr:
+                break
+
+            trans = np.maximum(interfaces['trntdr'][..., lyr+1, active], interfaces['trndif'][..., lyr+1, active])
+            deep = np.all(trans < tol, axis=tuple(range(trans.ndim-1)))
+            depth[active[deep]] = lyr+1
+            active = active[~deep]
+
+            if active.size == 0:
+                break
+
+    # underlying surface for the wavelengths that reach the bottom, then the
+    # reflecting boundary for the others
+    interfaces['rupdir'][..., nbr_lyr, :] = np.asarray(R_sfc)[:nbr_wvl]
+    interfaces['rupdif'][..., nbr_lyr, :] = np.asarray(R_sfc)[:nbr_wvl]
+
+    truncated = np.nonzero(depth < nbr_lyr)[0]
+
+    if truncated.size:
+
+        # optical depth from the top of each layer to the bottom of the column, and
+        # the properties of the boundary layer at each truncated wavelength
+        tau_below = np.cumsum(tau[..., ::-1, :], axis=-2)[..., ::-1, :]
+        k = depth[truncated]
+        tau_bnd = tau_below[..., k, truncated][..., np.newaxis, :]
+        SSA_bnd = SSA[..., k, truncated][..., np.newaxis, :]
+        g_bnd = g[..., k, truncated][..., np.newaxis, :]
+
+        rdir_bnd = np.zeros((mu_clm.shape[0],) + tau_bnd.shape)
+        rdif_bnd = np.zeros(tau_bnd.shape)
+
+        # the refraction of the beam depends on the position of the boundary
+        # relative to the Fresnel layer
+        for group in (k < lyrfrsnl, k == lyrfrsnl, k > lyrfrsnl):
+            if np.any(group):
+                w = truncated[group]
+                boundary = layer_properties(tau_bnd[..., group], SSA_bnd[..., group], g_bnd[..., group],\
+                    k[group][:1], lyrfrsnl, mu_clm, tuple(x[w] for x in fresnel), jit=jit)
+                rdir_bnd[..., group] = boundary['rdir']
+                rdif_bnd[..., group] = boundary['rdif_a']
+
+        below = np.arange(nbr_lyr+1)[:, np.newaxis] >= k
+        interfaces['rupdir'][..., truncated] = np.where(below, rdir_bnd, interfaces['rupdir'][..., truncated])
+        interfaces['rupdif'][..., truncated] = np.where(below, rdif_bnd, interfaces['rupdif'][..., truncated])
+
+        for key in ('trndir', 'trntdr', 'trndif', 'rdndif'):
+            interfaces[key][..., truncated] = np.where(below & (np.arange(nbr_lyr+1)[:, np.newaxis] > k),\
+                0, interfaces[key][..., truncated])
+
+    for lyr in np.arange(np.max(depth)-1, -1, -1):
+        adding_up(layers, interfaces, lyr+1, R_sfc, start=lyr, wvl=np.nonzero(depth > lyr)[0])
+
+    return interfaces, depth
+
+
+def zenith_axes(inputs, batch_ndim, nbr_wvl):
+
+    """
+    returns mu_not, Fs, Fd and flx_slr with a leading zenith axis, reshaped so that
+    they broadcast against the column axes of the batched solver arrays:
+    mu_clm has shape (nbr_zen, 1, ..., 1) and the others (nbr_zen, 1, ..., nbr_wvl)
+
+    """
+
+    import numpy as np
+
+    mu_not = np.atleast_1d(inputs.mu_not).astype(float)
+    nbr_zen = len(mu_not)
+
+    mu_clm = mu_not.reshape((nbr_zen,) + (1,)*(batch_ndim+1))
+    Fs = np.asarray(inputs.Fs, dtype=float).reshape((nbr_zen,) + (1,)*batch_ndim + (nbr_wvl,))
+    Fd = np.asarray(inputs.Fd, dtype=float).reshape((nbr_zen,) + (1,)*batch_ndim + (nbr_wvl,))
+    flx_slr = np.asarray(inputs.flx_slr, dtype=float).reshape((nbr_zen,) + (1,)*batch_ndim + (nbr_wvl,))
+
+    return mu_clm, Fs, Fd, flx_slr
+
+
+def first_fresnel_layer(layer_type):
+
+    """
+    index of the first solid ice (Fresnel) layer, or 999999999 if there is none
+
+    """
+
+    if sum(layer_type) > 0:
+        return list(layer_type).index(1)
+
+    return 999999999
+
+
+def layer_properties(tau, SSA, g, lyr_idx, lyrfrsnl, mu_clm, fresnel, jit=False):
+
+    """
+    reflectivities and transmissivities of the layers numbered lyr_idx, whose
+    optical properties are tau, SSA and g (..., len(lyr_idx), nbr_wvl). mu_clm is
+    the zenith array from zenith_axes() and fresnel is the tuple returned by
+    load_ice_refractive_index(). If jit is True, the delta-Eddington and gaussian
+    integration kernels from jit_kernels.py are used.
+
+    returns a dict with the zenith independent diffuse terms rdif_a, rdif_b,
+    tdif_a and tdif_b and the zenith dependent direct terms rdir, tdir and trnlay
+    (which have a leading zenith axis)
+
+    """
+
+    import numpy as np
+
+    if jit:
+        from jit_kernels import delta_eddington_layer, gaussian_diffuse_layer
+    else:
+        from adding_doubling_solver import delta_eddington_layer, gaussian_diffuse_layer
+
+    refidx_re, refidx_im, FL_r_dif_a, FL_r_dif_b = fresnel
+    nbr_wvl = tau.shape[-1]
+    refidx_re = refidx_re[:nbr_wvl]
+    refidx_im = refidx_im[:nbr_wvl]
+
+    # zenith independent
+    ts, ws, gs, lm, R1, T1 = delta_eddington_layer(tau, SSA, g)
+    rdif_a, tdif_a = gaussian_diffuse_layer(ts, ws, gs, lm, R1, T1)
+    rdif_b = rdif_a.copy()
+    tdif_b = tdif_a.copy()
+
+    # zenith dependent: the beam is refracted in and below the Fresnel layer unless
+    # the top layer is the Fresnel layer, as in adding_doubling_solver()
+    nr, mu0n_refr = refracted_beam(mu_clm, refidx_re, refidx_im)
+    refracted = (np.asarray(lyr_idx) >= lyrfrsnl) & (lyrfrsnl != 0)
+    mu0n = np.where(refracted[:, np.newaxis], mu0n_refr[..., np.newaxis, :], mu_clm[..., np.newaxis, :]).astype(tau.dtype, copy=False)
+    rdir, tdir, trnlay = direct_beam_layer(ts, ws, gs, lm, R1, T1, mu0n)
+
+    if lyrfrsnl in lyr_idx:
+
+        f = list(lyr_idx).index(lyrfrsnl)
+
+        Rf_dir_a, Tf_dir_a = fresnel_direct(mu_clm, mu0n[..., f, :], nr, refidx_re, refidx_im)
+
+        Rf_dif_a = FL_r_dif_a[:nbr_wvl]
+        Tf_dif_a = 1 - Rf_dif_a
+        Rf_dif_b = FL_r_dif_b[:nbr_wvl]
+        Tf_dif_b = 1 - Rf_dif_b
+
+        R_lyr = rdif_a[..., f, :].copy()
+        T_lyr = tdif_a[..., f, :].copy()
+        rintfc = 1 / (1-Rf_dif_b*R_lyr)
+
+        # Eq. B7  Briegleb & Light 2007
+        tdir[..., f, :] = Tf_dir_a * tdir[..., f, :] + Tf_dir_a*rdir[..., f, :] * Rf_dif_b*rintfc*T_lyr
+        rdir[..., f, :] = Rf_dir_a + Tf_dir_a*rdir[..., f, :] * rintfc * Tf_dif_b
+        trnlay[..., f, :] = Tf_dir_a*trnlay[..., f, :]
+
+        # Eq. B9 and B10  Briegleb & Light 2007
+        rdif_a[..., f, :] = Rf_dif_a + Tf_dif_a*R_lyr * rintfc * Tf_dif_b
+        rdif_b[..., f, :] = rdif_b[..., f, :] + tdif_b[..., f, :] * Rf_dif_b * rintfc * T_lyr
+        tdif_a[..., f, :] = T_lyr * rintfc * Tf_dif_a
+        tdif_b[..., f, :] = tdif_b[..., f, :] * rintfc * Tf_dif_b
+
+    layers = dict(rdir=rdir, tdir=tdir, trnlay=trnlay, rdif_a=rdif_a, rdif_b=rdif_b, tdif_a=tdif_a, tdif_b=tdif_b)
+
+    # stored with the precision of the inputs
+    return {key: value.astype(tau.dtype, copy=False) for key, value in layers.items()}
+
+
+def empty_interfaces(mu_clm, shape, dtype=float):
+
+    """
+    allocates the cumulative interface quantities (of the given dtype) for
+    columns of the given (..., nbr_lyr, nbr_wvl) shape. Interfaces are numbered
+    0 (top) to nbr_lyr (bottom). Diffuse terms have the shape of the column,
+    direct terms have an extra leading zenith axis.
+
+    """
+
+    import numpy as np
+
+    shape_dif = tuple(shape[:-2]) + (shape[-2]+1, shape[-1])
+    shape_dir = (mu_clm.shape[0],) + shape_dif
+
+    interfaces = dict(trndir=np.zeros(shape_dir, dtype), trntdr=np.zeros(shape_dir, dtype),\
+        rupdir=np.zeros(shape_dir, dtype), trndif=np.zeros(shape_dif, dtype), rdndif=np.zeros(shape_dif, dtype),\
+        rupdif=np.zeros(shape_dif, dtype))
+
+    interfaces['trndir'][..., 0, :] = 1
+    interfaces['trntdr'][..., 0, :] = 1
+    interfaces['trndif'][..., 0, :] = 1
+
+    return interfaces
+
+
+def adding_down(layers, interfaces, start, stop=None, wvl=slice(None)):
+
+    """
+    adds layers from the top down (Eq. 51 and B4  Briegleb and Light 2007),
+    updating the transmissivities and reflectivity from above at every interface
+    below interface start (down to interface stop, default the bottom) in place.
+    wvl optionally selects the wavelengths to update.
+
+    """
+
+    import numpy as np
+
+    trndir = interfaces['trndir']
+    trntdr = interfaces['trntdr']
+    trndif = interfaces['trndif']
+    rdndif = interfaces['rdndif']
+    rdir, tdir, trnlay = layers['rdir'], layers['tdir'], layers['trnlay']
+    rdif_a, rdif_b, tdif_a, tdif_b = layers['rdif_a'], layers['rdif_b'], layers['tdif_a'], layers['tdif_b']
+
+    if stop is None:
+        stop = trndir.shape[-2]-1
+
+    for lyr in np.arange(start,stop,1):
+
+        refkm1 = 1/(1 - np.multiply(rdndif[..., lyr, wvl], rdif_a[..., lyr, wvl], dtype=np.float64))
+        tdrrdir = trndir[..., lyr, wvl]*rdir[..., lyr, wvl]
+        tdndif = trntdr[..., lyr, wvl] - trndir[..., lyr, wvl]
+
+        trndir[..., lyr+1, wvl] = trndir[..., lyr, wvl]*trnlay[..., lyr, wvl]
+        trntdr[..., lyr+1, wvl] = trndir[..., lyr, wvl]*tdir[..., lyr, wvl]\
+            + (tdndif + tdrrdir*rdndif[..., lyr, wvl])*refkm1*tdif_a[..., lyr, wvl]
+        rdndif[..., lyr+1, wvl] = rdif_b[..., lyr, wvl] + (tdif_b[..., lyr, wvl]*rdndif[..., lyr, wvl]*refkm1*tdif_a[..., lyr, wvl])
+        trndif[..., lyr+1, wvl] = trndif[..., lyr, wvl]*refkm1*tdif_a[..., lyr, wvl]
+
+    return
+
+
+def adding_up(layers, interfaces, stop, R_sfc, start=0, wvl=slice(None)):
+
+    """
+    adds layers from the underlying surface upwards (Eq. B5  Briegleb and Light 2007),
+    updating the reflectivities from below at every interface above interface
+    stop (up to interface start, default the top) in place. If stop is the bottom
+    interface, the surface albedo R_sfc is set there first. wvl optionally selects
+    the wavelengths to update.
+
+    """
+
+    import numpy as np
+
+    rupdir = interfaces['rupdir']
+    rupdif = interfaces['rupdif']
+    rdir, tdir, trnlay = layers['rdir'], layers['tdir'], layers['trnlay']
+    rdif_a, rdif_b, tdif_a, tdif_b = layers['rdif_a'], layers['rdif_b'], layers['tdif_a'], layers['tdif_b']
+
+    if stop == rupdif.shape[-2]-1:
+        rupdir[..., stop, wvl] = np.asarray(R_sfc)[:rupdif.shape[-1]][wvl]
+        rupdif[..., stop, wvl] = np.asarray(R_sfc)[:rupdif.shape[-1]][wvl]
+
+    for lyr in np.arange(stop-1,start-1,-1):
+
+        refkp1 = 1/( 1 - np.multiply(rdif_b[..., lyr, wvl], rupdif[..., lyr+1, wvl], dtype=np.float64))
+        rupdir[..., lyr, wvl] = rdir[..., lyr, wvl] + (trnlay[..., lyr, wvl] * rupdir[..., lyr+1, wvl]\
+            + (tdir[..., lyr, wvl]-trnlay[..., lyr, wvl])* rupdif[..., lyr+1, wvl])*refkp1*tdif_b[..., lyr, wvl]
+        rupdif[..., lyr, wvl] = rdif_a[..., lyr, wvl] + tdif_a[..., lyr, wvl]*rupdif[..., lyr+1, wvl]*refkp1*tdif_b[..., lyr, wvl]
+
+    return
+
+
+def solver_outputs(inputs, interfaces, mu_clm, Fs, Fd, flx_slr, single_zenith):
+
+    """
+    calculates the fluxes at each interface (Eq. 52  Briegleb and Light 2007) and
+    returns the same outputs as adding_doubling_solver()
+
+    """
+
+    import numpy as np
+
+    trndir, trntdr, rupdir = interfaces['trndir'], interfaces['trntdr'], interfaces['rupdir']
+    trndif, rdndif, rupdif = interfaces['trndif'], interfaces['rdndif'], interfaces['rupdif']
+    L_snw = np.asarray(inputs.L_snw)
+
+    vis_max_idx = 50
+    nir_max_idx = 480
+
+    F_dir = Fs*mu_clm*np.pi
+    F_dif = Fd
+
+    # the fluxes are calculated one interface at a time, in float64 whatever the
+    # precision of the interfaces, so only the net flux is held for the column
+    F_net = np.empty(trndir.shape)
+
+    for i in np.arange(trndir.shape[-2]):
+
+        tdr, ttdr, rdir_up, tdif, rdif_dn, rdif_up = (np.asarray(x[..., i, :], dtype=np.float64)\
+            for x in (trndir, trntdr, rupdir, trndif, rdndif, rupdif))
+
+        refk = 1/(1 - rdif_dn*rdif_up)
+        fdirup = (tdr*rdir_up + (ttdr-tdr) * rdif_up)*refk
+        fdirdn = tdr + (ttdr- tdr + tdr * rdir_up * rdif_dn)*refk
+        fdifup = tdif*rdif_up*refk
+        fdifdn = tdif*refk
+
+        F_up = fdirup*F_dir + fdifup*F_dif
+        F_dwn = fdirdn*F_dir + fdifdn*F_dif
+        F_net[..., i, :] = F_up - F_dwn
+
+        if i == 0:
+            albedo = F_up/F_dwn
+            F_top_pls = F_up
+
+    F_abs = F_net[..., 1:, :]-F_net[..., :-1, :]
+
+    F_btm_net = -F_net[..., -1, :]
+
+    F_abs_slr = np.sum(F_abs,axis=-1)
+
+    heat_rt = F_abs_slr/(L_snw*2117)    #[K/s]
+    heat_rt = heat_rt*3600               #[K/hr]
+
+    # energy conservation check, per column
+    energy_sum = (mu_clm*np.pi*Fs)+Fd - (np.sum(F_abs,axis=-2) + F_btm_net + F_top_pls)
+    energy_conservation_error = np.sum(abs(energy_sum), axis=-1)
+
+    if np.any(energy_conservation_error > 1e-10):
+        print('energy conservation error: {}'.format(np.max(energy_conservation_error)))
+
+    alb_bb = np.sum(flx_slr*albedo, axis=-1)/np.sum(flx_slr, axis=-1)
+    alb_vis = np.sum(flx_slr[..., 0:vis_max_idx] * albedo[..., 0:vis_max_idx], axis=-1)\
+        / np.sum(flx_slr[..., 0:vis_max_idx], axis=-1)
+    alb_nir = np.sum(flx_slr[..., vis_max_idx:nir_max_idx] * albedo[..., vis_max_idx:nir_max_idx], axis=-1)\
+        / np.sum(flx_slr[..., vis_max_idx:nir_max_idx], axis=-1)
+
+    if single_zenith:
+        albedo, alb_bb, alb_vis, alb_nir, F_abs_slr, heat_rt = albedo[0], alb_bb[0], alb_vis[0], alb_nir[0], F_abs_slr[0], heat_rt[0]
+
+    return inputs.wvl, albedo, alb_bb, alb_vis, alb_nir, F_abs_slr, heat_rt
+
+
+class IncrementalAddingDoubling:
+
+    """
+    Stateful adding-doubling solver for repeated solves of the same column where
+    only some layers change between calls (e.g. iterative retrievals, or sweeps
+    over the algae or density of the surface layer of a deep column).
+
+    The solver is set up once from inputs (wavelengths, irradiance, layer_type,
+    rf_ice, R_sfc and mu_not, which may be a list of zeniths as for
+    adding_doubling_solver_batch()). Each call to solve() compares the new tau,
+    SSA and g with those of the previous call and only recomputes:
+
+    - the reflectivities and transmissivities of the layers that changed
+    - the reflectivities from below (rupdir, rupdif) at the interfaces above the
+      deepest changed layer
+    - the transmissivities and reflectivities from above (trndir, trntdr, trndif,
+      rdndif) at the interfaces below the shallowest changed layer
+
+    Everything else is reused from the cache. The cached direct beam terms
+    depend on the zenith, so if inputs.mu_not, Fs, Fd, R_sfc, layer_type or
+    rf_ice differ from the previous call every layer is recomputed. The results
+    are identical to adding_doubling_solver_batch() for the same inputs, tau,
+    SSA and g. inputs.SINGLE_PRECISION stores the layer and interface arrays in
+    float32 as in adding_doubling_solver_batch(), and the caller's inputs are
+    not modified.
+
+    usage:
+        solver = IncrementalAddingDoubling(inputs)
+        outputs = solver.solve(tau, SSA, g, L_snw)
+
+    """
+
+    def __init__(self, inputs):
+
+        import numpy as np
+
+        self.inputs = inputs
+        self.jit = getattr(inputs, 'JIT', False)
+        self.dtype = np.float32 if getattr(inputs, 'SINGLE_PRECISION', False) else np.float64
+
+        self.settings = None # inputs the cache was calculated for (see column_settings())
+        self.tau = None
+        self.SSA = None
+        self.g = None
+        self.layers = None
+        self.interfaces = None
+        self.nbr_recomputed = 0 # number of layers recomputed in the last call to solve()
+
+        self.update_settings()
+
+    def column_settings(self):
+
+        """
+        copies of the inputs the cached layers and interfaces depend on
+
+        """
+
+        import numpy as np
+
+        return [np.array(getattr(self.inputs, name), dtype=float) for name in ('mu_not', 'Fs', 'Fd', 'R_sfc')]\
+            + [list(self.inputs.layer_type), self.inputs.rf_ice]
+
+    def update_settings(self):
+
+        """
+        reads the zenith, irradiance, surface and ice settings from inputs and
+        returns True if they differ from those the cache was calculated for
+
+        """
+
+        import numpy as np
+
+        settings = self.column_settings()
+
+        if self.settings is not None and all(np.array_equal(new, old) for new, old in zip(settings, self.settings)):
+            return False
+
+        self.settings = settings
+        self.single_zenith = np.ndim(self.inputs.mu_not) == 0
+        self.lyrfrsnl = first_fresnel_layer(self.inputs.layer_type)
+        self.fresnel = load_ice_refractive_index(self.inputs.dir_base, self.inputs.rf_ice)
+        self.R_sfc = np.asarray(self.inputs.R_sfc)
+
+        return True
+
+    def solve(self, tau, SSA, g, L_snw):
+
+        """
+        solves the column with layer optical properties tau, SSA and g
+        (nbr_lyr, nbr_wvl) and layer mass L_snw, returning the same outputs as
+        adding_doubling_solver()
+
+        """
+
+        import copy
+        import numpy as np
+
+        tau = np.array(tau, dtype=self.dtype)
+        SSA = np.array(SSA, dtype=self.dtype)
+        g = np.array(g, dtype=self.dtype)
+        nbr_lyr = tau.shape[-2]
+
+        inputs = copy.copy(self.inputs)
+        inputs.L_snw = L_snw
+
+        mu_clm, Fs, Fd, flx_slr = zenith_axes(inputs, tau.ndim-2, tau.shape[-1])
+
+        if self.update_settings() or self.tau is None or self.tau.shape != tau.shape:
+            changed = np.arange(nbr_lyr)
+        else:
+            same = (tau == self.tau) & (SSA == self.SSA) & (g == self.g)
+            changed = np.flatnonzero(~np.all(same.reshape(-1, nbr_lyr, tau.shape[-1]), axis=(0, 2)))
+
+        self.nbr_recomputed = len(changed)
+
+        if self.layers is None or len(changed) == nbr_lyr:
+
+            self.layers = layer_properties(tau, SSA, g, np.arange(nbr_lyr), self.lyrfrsnl, mu_clm, self.fresnel,\
+                jit=self.jit)
+            self.interfaces = empty_interfaces(mu_clm, tau.shape, self.dtype)
+            adding_down(self.layers, self.interfaces, 0)
+            adding_up(self.layers, self.interfaces, nbr_lyr, self.R_sfc)
+
+        elif len(changed) > 0:
+
+            new = layer_properties(tau[..., changed, :], SSA[..., changed, :], g[..., changed, :], changed,\
+                self.lyrfrsnl, mu_clm, self.fresnel, jit=self.jit)
+
+            for key in self.layers:
+                self.layers[key][..., changed, :] = new[key]
+
+            adding_down(self.layers, self.interfaces, changed[0])
+
+            # reflectivities from below are unchanged at and below the interface
+            # under the deepest changed layer
+            adding_up(self.layers, self.interfaces, changed[-1]+1, self.R_sfc)
+
+        self.tau, self.SSA, self.g = tau, SSA, g
+
+        return solver_outputs(inputs, self.interfaces, mu_clm, Fs, Fd, flx_slr, self.single_zenith)
@@ -0,0 +1,494 @@
+"""
+Long-lived local albedo query service.
+
+Short jobs that need a few SNICAR albedos otherwise pay for the python start-up,
+the xarray import and reading every optical property file on each run. This
+module keeps one process warm instead: at start-up it loads the optical
+property and irradiance files into memory (optical_library.load_optical_library(),
+which needs no shared memory and so runs on any python version) and then
+answers requests over local HTTP.
+
+A request is a JSON object
+
+    {"columns": [{"dz": [0.001, 0.2], "rho_layers": [650, 650], ...}, ...],
+     "solzen": 50, "spectral": false}
+
+where each column gives the inputs attributes (as set in SNICAR_driver.py) that
+differ from the service's template inputs. The response has, for each column,
+BBA, BBAVIS, BBANIR, abs_slr and (if spectral is true) the spectral albedo.
+
+Requests that arrive while a solve is running are coalesced: the batcher thread
+collects everything queued within window seconds, groups the columns of all
+those requests that can share a solver call (same solver, layer types, zenith,
+irradiance, surface and refractive index settings) and solves each group with
+one call to the batched solvers.
+
+GET /metrics returns the request, column and batch counts, the latency
+percentiles of recent requests and the throughput since start-up.
+
+usage:
+
+    service = start_service(inputs, port=8765)       # or serve(inputs) to block
+    client = AlbedoClient(service.url)
+    client.albedo([{'rho_layers': [600, 600]}, {'rho_layers': [800, 800]}], solzen=50)
+    client.metrics()
+    service.shutdown()
+
+"""
+
+import json
+import threading
+import time
+import numpy as np
+
+# inputs attributes that must be the same for all columns solved together
+SHARED_ATTRIBUTES = ['dir_base', 'solzen', 'DIRECT', 'incoming_i', 'TOON', 'ADD_DOUBLE', 'APRX_TYP', 'DELTA',\
+    'rf_ice', 'nbr_lyr', 'layer_type']
+
+
+class AlbedoService:
+
+    """
+    queue, batcher and metrics of the service. template is the inputs used for
+    every attribute a request does not set. submit() is thread-safe, raises a
+    ValueError for malformed requests and returns a concurrent.futures.Future
+    for the list of column results. HTTP requests wait at most timeout seconds
+    for their result.
+
+    """
+
+    def __init__(self, template, window=0.005, max_columns=2000, load_library=True, timeout=300):
+
+        import collections
+        from raster_driver import column_template
+
+        self.template = column_template(template)
+        self.window = window
+        self.max_columns = max_columns
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self.ready = threading.Condition()
+        self.running = True
+
+        self.started = time.time()
+        self.latencies = collections.deque(maxlen=10000)
+        self.counts = dict(requests=0, columns=0, batches=0, solves=0, errors=0)
+
+        # the service solves in this process, so the files are cached in process
+        # memory rather than published to shared memory
+        self.load_library = load_library
+        if load_library:
+            from optical_library import load_optical_library
+            load_optical_library(self.template.dir_base)
+
+        self.batcher = threading.Thread(target=self.run_batcher, daemon=True)
+        self.batcher.start()
+
+
+    def submit(self, request):
+
+        from concurrent.futures import Future
+
+        validate_request(request)
+
+        future = Future()
+
+        with self.ready:
+            self.queue.append((time.perf_counter(), request, future))
+            self.ready.notify()
+
+        return future
+
+
+    def run_batcher(self):
+
+        while self.running:
+
+            with self.ready:
+                while self.running and not self.queue:
+                    self.ready.wait(0.5)
+
+            if not self.running:
+                break
+
+            # coalesce the requests that arrive within the window
+            time.sleep(self.window)
+
+            batch = []
+
+            # an unexpected error fails the requests of this batch only, so the
+            # batcher keeps serving later requests
+            try:
+                with self.ready:
+                    columns = 0
+                    while self.queue and (columns < self.max_columns or not batch):
+                        item = self.queue.popleft()
+                        batch.append(item)
+                        columns += len(item[1]['columns'])
+
+                self.solve_requests(batch)
+
+            except Exception as error:
+                for _, _, future in batch:
+                    if not future.done():
+                        self.counts['errors'] += 1
+                        future.set_exception(RuntimeError("solving the batch failed: {!r}".format(error)))
+
+        return
+
+
+    def solve_requests(self, batch):
+
+        """
+        solves all the columns of the requests in batch, grouped into as few
+        batched solver calls as possible, and resolves their futures
+
+        """
+
+        groups = {}
+        results = {}
+
+        for r, (_, request, future) in enumerate(batch):
+
+            try:
+                columns = [self.column_inputs(request, column) for column in request['columns']]
+            except Exception as error:
+                future.set_exception(error)
+                continue
+
+            results[r] = [None]*len(columns)
+
+            for c, inputs in enumerate(columns):
+                key = tuple(repr(getattr(inputs, name, None)) for name in SHARED_ATTRIBUTES)\
+                    + (np.asarray(inputs.R_sfc).tobytes(),)
+                groups.setdefault(key, []).append((r, c, inputs))
+
+        failed = {}
+
+        for members in groups.values():
+            try:
+                outputs = solve_columns([inputs for _, _, inputs in members])
+                self.counts['solves'] += 1
+            except Exception as error:
+                # a failure of the solver is a server error, whatever its type
+                for r, _, _ in members:
+                    failed[r] = RuntimeError("solving the columns failed: {!r}".format(error))
+                continue
+
+            for i, (r, c, _) in enumerate(members):
+                results[r][c] = dict(BBA=float(outputs.BBA[i]), BBAVIS=float(outputs.BBAVIS[i]),\
+                    BBANIR=float(outputs.BBANIR[i]), abs_slr=np.asarray(outputs.abs_slr[i]).tolist(),\
+                    albedo=np.asarray(outputs.albedo[i]))
+
+        now = time.perf_counter()
+        self.counts['batches'] += 1
+
+        for r, (received, request, future) in enumerate(batch):
+
+            if future.done():
+                self.counts['errors'] += 1
+                continue
+
+            if r in failed:
+                self.counts['errors'] += 1
+                future.set_exception(failed[r])
+                continue
+
+            for result in results[r]:
+                if request.get('spectral', False):
+                    result['albedo'] = result['albedo'].tolist()
+                else:
+                    del result['albedo']
+
+            self.counts['requests'] += 1
+            self.counts['columns'] += len(results[r])
+            self.latencies.append(now-received)
+            future.set_result(results[r])
+
+        return
+
+
+    def column_inputs(self, request, column):
+
+        """
+        returns a copy of the template with the attributes of column (and the
+        request's solzen) set
+
+        """
+
+        import copy
+
+        inputs = copy.copy(self.template)
+
+        if 'solzen' in request:
+            inputs.solzen = request['solzen']
+
+        for name, value in column.items():
+            if not hasattr(self.template, name):
+                raise ValueError("unknown input {}".format(name))
+            setattr(inputs, name, value)
+
+        if 'dz' in column and 'nbr_lyr' not in column:
+            inputs.nbr_lyr = len(column['dz'])
+
+        return inputs
+
+
+    def metrics(self):
+
+        """
+        returns a dict of the request, column, batch and solver call counts,
+        latency percentiles (ms) of the last 10000 requests and the throughput
+        (per second) since start-up
+
+        """
+
+        uptime = time.time()-self.started
+        latencies = np.array(self.latencies)*1000
+
+        metrics = dict(self.counts)
+        metrics['uptime_s'] = uptime
+        metrics['requests_per_s'] = self.counts['requests']/uptime
+        metrics['columns_per_s'] = self.counts['columns']/uptime
+        metrics['columns_per_solve'] = self.counts['columns']/max(self.counts['solves'], 1)
+
+        for p in (50, 95, 99):
+            metrics['latency_p{}_ms'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else None
+
+        return metrics
+
+
+    def close(self):
+
+        self.running = False
+
+        with self.ready:
+            self.ready.notify_all()
+
+        self.batcher.join()
+
+        if self.load_library:
+            from optical_library import detach_optical_library
+            detach_optical_library()
+            self.load_library = False
+
+        return
+
+
+def validate_request(request):
+
+    """
+    raises a ValueError unless request is a dict with a list of column dicts
+    under 'columns'
+
+    """
+
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+
+    if not isinstance(request.get('columns'), list):
+        raise ValueError("request must have a list of columns")
+
+    if not all(isinstance(column, dict) for column in request['columns']):
+        raise ValueError("each column must be a JSON object of inputs attributes")
+
+    return
+
+
+def solve_columns(columns):
+
+    """
+    solves a list of column inputs that share SHARED_ATTRIBUTES in one call to
+    the batched solvers: the optical properties of each column are calculated
+    separately and stacked along a leading column axis.
+    returns the outputs of SNICAR_feeder.solve_batch()
+
+    """
+
+    from SNICAR_feeder import get_wavelengths, get_irradiance, get_ice_optics, get_impurity_optics,\
+        mix_optical_properties, solve_batch
+
+    inputs = columns[0]
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance(inputs, inputs.solzen)
+
+    optics = []
+    for column in columns:
+        column.wvl, column.nbr_wvl = inputs.wvl, inputs.nbr_wvl
+        SSA_snw, MAC_snw, g_snw = get_ice_optics(column)
+        SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(column)
+        optics.append(mix_optical_properties(column, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer))
+
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw = (np.stack(x) for x in zip(*optics))
+
+    return solve_batch(inputs)
+
+
+def make_handler(service):
+
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, service.metrics())
+            else:
+                self.send_json(404, dict(error='unknown path'))
+
+        def do_POST(self):
+            if self.path != '/albedo':
+                self.send_json(404, dict(error='unknown path'))
+                return
+            from concurrent.futures import TimeoutError
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                future = service.submit(request)
+            except Exception as error:
+                self.send_json(400, dict(error=str(error)))
+                return
+            # invalid column inputs raise a ValueError, failures of the solver
+            # a RuntimeError (solve_requests())
+            try:
+                results = future.result(timeout=service.timeout)
+            except TimeoutError:
+                self.send_json(504, dict(error='no result within {} s'.format(service.timeout)))
+                return
+            except ValueError as error:
+                self.send_json(400, dict(error=str(error)))
+                return
+            except Exception as error:
+                self.send_json(500, dict(error=str(error)))
+                return
+            self.send_json(200, dict(columns=results))
+
+        def log_message(self, format, *args):
+            return
+
+    return Handler
+
+
+class RunningService:
+
+    """
+    a service answering HTTP requests on a background thread (start_service())
+
+    """
+
+    def __init__(self, service, server):
+
+        self.service = service
+        self.server = server
+        self.url = 'http://{}:{}'.format(*server.server_address[:2])
+        self.thread = threading.Thread(target=server.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def shutdown(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+        return
+
+
+def make_server(template, host='127.0.0.1', port=8765, **kwargs):
+
+    import socketserver
+    from http.server import HTTPServer
+
+    class ThreadingServer(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    service = AlbedoService(template, **kwargs)
+
+    return service, ThreadingServer((host, port), make_handler(service))
+
+
+def start_service(template, host='127.0.0.1', port=0, **kwargs):
+
+    """
+    starts the service on a background thread (port 0 picks a free port) and
+    returns a RunningService with the url and shutdown()
+
+    """
+
+    service, server = make_server(template, host, port, **kwargs)
+
+    return RunningService(service, server)
+
+
+def serve(template, host='127.0.0.1', port=8765, **kwargs):
+
+    """
+    runs the service in the foreground until interrupted
+
+    """
+
+    service, server = make_server(template, host, port, **kwargs)
+    print("albedo service listening on http://{}:{}".format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+    return
+
+
+class AlbedoClient:
+
+    """
+    minimal client for the service using only the standard library
+
+    """
+
+    def __init__(self, url):
+
+        self.url = url.rstrip('/')
+
+
+    def post(self, path, body):
+
+        from urllib import request
+
+        req = request.Request(self.url+path, data=json.dumps(body).encode(),\
+            headers={'Content-Type': 'application/json'})
+
+        with request.urlopen(req) as response:
+            return json.loads(response.read())
+
+
+    def albedo(self, columns, solzen=None, spectral=False):
+
+        """
+        returns a list with a dict of results for each column
+
+        """
+
+        body = dict(columns=columns, spectral=spectral)
+        if solzen is not None:
+            body['solzen'] = solzen
+
+        return self.post('/albedo', body)['columns']
+
+
+    def metrics(self):
+
+        from urllib import request
+
+        with request.urlopen(self.url+'/metrics') as response:
+            return json.loads(response.read())
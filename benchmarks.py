@@ -0,0 +1,359 @@
+"""
+Benchmarks for the parameterisation runtime and the snicar solvers.
+
+Run as a script to print the results to the terminal:
+
+    python benchmarks.py
+
+"""
+
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+def benchmark_import_time(modules, repeats=5):
+
+    """
+    measures the wall-clock time taken to import each module in a fresh python
+    interpreter. The interpreter start-up time (measured by running an empty
+    command) is subtracted so that the numbers reflect the import itself.
+    returns a dict of {module: median import time in seconds}
+
+    """
+
+    def run(cmd):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', cmd], check=True)
+            times.append(time.perf_counter() - start)
+        return np.median(times)
+
+    startup = run('pass')
+    results = {}
+
+    for module in modules:
+        results[module] = run(f'import {module}') - startup
+
+    return results
+
+
+def benchmark_jit_kernels(nbr_col=50, nbr_lyr=20, nbr_wvl=480, nbr_zen=4, repeats=5, seed=0):
+
+    """
+    parity check and timing of the JIT kernels in jit_kernels.py against the
+    numpy kernels used by the batched solvers, on random but physically
+    plausible layer properties for nbr_col columns of nbr_lyr layers.
+    returns a dict of {kernel: (max abs difference, numpy time, jit time)}
+    with times in seconds (median of repeats, excluding compilation)
+
+    """
+
+    import jit_kernels
+    import adding_doubling_solver as ad
+    import Toon_RT_solver as toon
+
+    rng = np.random.default_rng(seed)
+    shape = (nbr_col, nbr_lyr, nbr_wvl)
+    tau = 10**rng.uniform(-3, 3, shape)
+    SSA = rng.uniform(0.5, 0.99999, shape)
+    g = rng.uniform(0.7, 0.95, shape)
+
+    # diagonally dominant tridiagonal system as in the Toon solver
+    rows = (nbr_col, 2*nbr_lyr, nbr_wvl)
+    A = rng.uniform(-0.5, 0.5, rows)
+    D = rng.uniform(-0.5, 0.5, rows)
+    B = 1.5 + rng.uniform(0, 1, rows)
+    E = rng.uniform(-1, 1, (nbr_zen,) + rows)
+
+    def timed(func, *args):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = func(*args)
+            times.append(time.perf_counter() - start)
+        return out, np.median(times)
+
+    def max_diff(a, b):
+        return max(np.max(np.abs(x - y)) for x, y in zip(a, b))
+
+    # compile once before timing
+    jit_kernels.delta_eddington_layer(tau[:1, :1], SSA[:1, :1], g[:1, :1])
+    jit_kernels.gaussian_diffuse_layer(*ad.delta_eddington_layer(tau[:1, :1], SSA[:1, :1], g[:1, :1]))
+    AS, X = jit_kernels.tridiagonal_factor(A[:1], B[:1], D[:1])
+    jit_kernels.tridiagonal_solve(AS, X, B[:1], D[:1], E[:, :1])
+
+    results = {}
+
+    ref, t_ref = timed(ad.delta_eddington_layer, tau, SSA, g)
+    out, t_out = timed(jit_kernels.delta_eddington_layer, tau, SSA, g)
+    results['delta_eddington_layer'] = (max_diff(ref, out), t_ref, t_out)
+
+    ref, t_ref = timed(ad.gaussian_diffuse_layer, *ref)
+    out, t_out = timed(jit_kernels.gaussian_diffuse_layer, *ad.delta_eddington_layer(tau, SSA, g))
+    results['gaussian_diffuse_layer'] = (max_diff(ref, out), t_ref, t_out)
+
+    ref, t_ref = timed(toon.tridiagonal_factor, A, B, D)
+    out, t_out = timed(jit_kernels.tridiagonal_factor, A, B, D)
+    results['tridiagonal_factor'] = (max_diff(ref, out), t_ref, t_out)
+
+    AS, X = ref
+    ref, t_ref = timed(toon.tridiagonal_solve, AS, X, B, D, E)
+    out, t_out = timed(jit_kernels.tridiagonal_solve, AS, X, B, D, E)
+    results['tridiagonal_solve'] = (max_diff([ref], [out]), t_ref, t_out)
+
+    return results
+
+
+def worker_memory(keys):
+
+    """
+    reads every (path, variable) in keys through read_optical_variable() and
+    returns the proportional set size (PSS) and private memory of this process
+    in MB, from /proc/self/smaps_rollup (linux only)
+
+    """
+
+    from optical_library import read_optical_variable
+
+    arrays = [read_optical_variable(path, var) for path, var in keys]
+    checksum = sum(float(np.sum(a)) for a in arrays)
+
+    memory = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            field = line.split(':')[0]
+            if field in ('Pss', 'Private_Clean', 'Private_Dirty'):
+                memory[field] = int(line.split()[1]) / 1024
+
+    return memory['Pss'], memory['Private_Clean'] + memory['Private_Dirty'], checksum
+
+
+def benchmark_optical_library_memory(dir_base, worker_counts=(1, 2, 4, 8)):
+
+    """
+    compares the memory used by process pools whose workers each read the whole
+    optical property library from file with pools attached to one shared copy
+    published by optical_library.publish_optical_library().
+    returns a dict of {worker count: (total PSS from files, total PSS shared)}
+    in MB. PSS divides shared pages between the processes mapping them, so the
+    shared total stays roughly constant as the worker count grows.
+
+    """
+
+    import multiprocessing
+    from optical_library import publish_optical_library, optical_library_pool
+
+    shm, index = publish_optical_library(dir_base)
+    keys = [tuple(key.rsplit('::', 1)) for key in index['entries']]
+    print('optical library: {} variables, {:.1f} MB'.format(len(keys), index['size'] / 1024**2))
+
+    results = {}
+
+    try:
+        for n in worker_counts:
+            with multiprocessing.Pool(n) as pool:
+                from_files = pool.map(worker_memory, [keys] * n, chunksize=1)
+            with optical_library_pool(index, n) as pool:
+                shared = pool.map(worker_memory, [keys] * n, chunksize=1)
+            results[n] = (sum(m[0] for m in from_files), sum(m[0] for m in shared))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
+
+
+def benchmark_single_precision(inputs, densities=(400, 500, 600, 700, 800, 850, 900),\
+    dzs=(0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 0.6, 0.7, 1), algs=(0, 5000, 7000, 11000, 13000, 15000, 20000),\
+    zeniths=(30, 40, 50, 60, 70, 80)):
+
+    """
+    accuracy report for inputs.SINGLE_PRECISION: solves every column of the
+    parameterisation sweep grid (ParameterisationDriver.py: density, weathering
+    crust thickness and surface algae, columns built as in raster_driver.py) at
+    every zenith with both batched solvers, in float64 and in float32, and
+    compares the outputs. inputs gives everything else (impurity files,
+    irradiance, refractive index etc.) as for snicar_feeder().
+
+    The Toon solver is ill-conditioned for some thick columns under direct
+    illumination, where even the float64 albedo leaves [0, 1] at some
+    wavelengths. Those columns are left out of the deviations, since neither
+    precision is meaningful there, and their number and largest spectral
+    albedo and BBA deviations are reported separately.
+
+    returns a dict of {solver: dict of the maximum and mean absolute deviation
+    of BBA, of the total absorbed flux (W m-2) and of the flux absorbed by
+    the surface layer (W m-2), the number of ill-conditioned columns and their
+    maximum albedo and BBA deviations (nan if there are none), and the time
+    (s) and peak traced memory (MB) of both solves}
+
+    """
+
+    import itertools
+    import tracemalloc
+    from raster_driver import column_template, pixel_optics
+    from SNICAR_feeder import get_wavelengths, get_irradiance_batch, solve_batch
+
+    inputs = column_template(inputs)
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.solzen = list(zeniths)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_batch(inputs)
+
+    grid = np.array(list(itertools.product(densities, dzs, algs)), dtype=float)
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw = pixel_optics(inputs, grid[:, 0], grid[:, 1], grid[:, 2])
+
+    def solve(single):
+        inputs.SINGLE_PRECISION = single
+        tracemalloc.start()
+        start = time.perf_counter()
+        outputs = solve_batch(inputs)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        return outputs, elapsed, peak
+
+    results = {}
+
+    for solver in ('toon', 'add_double'):
+
+        inputs.TOON, inputs.ADD_DOUBLE = solver == 'toon', solver == 'add_double'
+
+        ref, t_ref, m_ref = solve(False)
+        out, t_out, m_out = solve(True)
+
+        albedo = np.asarray(ref.albedo)
+        valid = np.all((albedo >= 0) & (albedo <= 1), axis=-1)
+
+        dBBA = np.abs(np.asarray(out.BBA) - np.asarray(ref.BBA))[valid]
+        dabs = np.abs(np.sum(out.abs_slr, axis=-1) - np.sum(ref.abs_slr, axis=-1))[valid]
+        dsfc = np.abs(np.asarray(out.abs_slr)[..., 0] - np.asarray(ref.abs_slr)[..., 0])[valid]
+
+        ill = ~valid
+        ill_albedo = float(np.max(np.abs(np.asarray(out.albedo) - albedo)[ill])) if np.any(ill) else np.nan
+        ill_BBA = float(np.max(np.abs(np.asarray(out.BBA) - np.asarray(ref.BBA))[ill])) if np.any(ill) else np.nan
+
+        results[solver] = dict(BBA_max=float(np.max(dBBA)), BBA_mean=float(np.mean(dBBA)),\
+            abs_max=float(np.max(dabs)), abs_mean=float(np.mean(dabs)), abs_sfc_max=float(np.max(dsfc)),\
+            ill_conditioned=int(np.sum(ill)), ill_conditioned_albedo_max=ill_albedo, ill_conditioned_BBA_max=ill_BBA,\
+            time_float64=t_ref, time_float32=t_out,\
+            memory_float64=m_ref, memory_float32=m_out)
+
+        print('{}: {} columns x {} zeniths ({} ill-conditioned, albedo deviation max {:.1e}, BBA deviation max {:.1e}),'\
+            ' BBA deviation max {:.1e} mean {:.1e}, absorbed flux deviation max {:.1e} W m-2 (surface layer {:.1e}),'\
+            ' time {:.2f} -> {:.2f} s, peak memory {:.0f} -> {:.0f} MB'\
+            .format(solver, len(grid), len(zeniths), np.sum(ill), ill_albedo, ill_BBA, results[solver]['BBA_max'],\
+            results[solver]['BBA_mean'], results[solver]['abs_max'], results[solver]['abs_sfc_max'], t_ref, t_out,\
+            m_ref, m_out))
+
+    inputs.SINGLE_PRECISION = False
+
+    return results
+
+
+def benchmark_emulator(inputs, emulator, nbr_columns=200, zeniths=(32, 47, 58, 73), nbr_feeder=20,\
+    nbr_predict=100000, seed=1):
+
+    """
+    accuracy and throughput of an emulator (emulator.py) trained for inputs:
+    nbr_columns new random columns are solved at zeniths (by default between
+    the whole-degree zeniths of the training set) with the batched solver and
+    compared with the emulator. The cost per column is timed for snicar_feeder()
+    (on nbr_feeder of the columns, one call each), for the batched solver and
+    for the emulator (nbr_predict columns, with and without the spectra).
+
+    returns a dict of the spectral albedo RMSE, 99th percentile and maximum
+    absolute error, the maximum and mean absolute BBA error, the maximum
+    BBAVIS and BBANIR errors, and the time per column (s) of each method
+
+    """
+
+    import contextlib
+    import copy
+    import io
+    from emulator import generate_emulator_dataset, predict_albedo, solve_columns
+    from raster_driver import column_template
+    from SNICAR_feeder import snicar_feeder, get_wavelengths, get_irradiance_batch
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        data = generate_emulator_dataset(inputs, nbr_columns, zeniths, seed=seed)
+
+    albedo = data['albedo']
+    out = predict_albedo(emulator, data['density'], data['dz'], data['zenith'], data['algae'])
+
+    # reference broadband albedos as returned by the solver
+    BBA, BBAVIS, BBANIR = data['BBA'], data['BBAVIS'], data['BBANIR']
+
+    error = np.abs(out.albedo-albedo)
+    results = dict(albedo_rmse=float(np.sqrt(np.mean(error**2))), albedo_p99=float(np.percentile(error, 99)),\
+        albedo_max=float(np.max(error)), BBA_max=float(np.max(np.abs(out.BBA-BBA))),\
+        BBA_mean=float(np.mean(np.abs(out.BBA-BBA))), BBAVIS_max=float(np.max(np.abs(out.BBAVIS-BBAVIS))),\
+        BBANIR_max=float(np.max(np.abs(out.BBANIR-BBANIR))))
+
+    # snicar_feeder, one column per call
+    column = column_template(inputs)
+    column.nbr_lyr = 2
+    column.layer_type = [1, 1]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(nbr_feeder):
+            rho = data['density'][i]
+            column.rho_layers = [rho, rho]
+            column.grain_rds = [int(round(10000-(rho*10)))]*2
+            column.dz = [0.001, data['dz'][i]]
+            column.mss_cnc_glacier_algae = [data['algae'][i], 0]
+            column.solzen = int(data['zenith'][i])
+            snicar_feeder(copy.copy(column))
+    results['time_feeder'] = (time.perf_counter()-start) / nbr_feeder
+
+    # batched solver, all columns at one zenith
+    column.wvl = get_wavelengths(column)
+    column.nbr_wvl = len(column.wvl)
+    column.solzen = int(zeniths[0])
+    rows = data['zenith'] == zeniths[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        column.mu_not, column.flx_slr, column.Fs, column.Fd = get_irradiance_batch(column)
+        start = time.perf_counter()
+        solve_columns(column, data['density'][rows], data['dz'][rows], data['algae'][rows])
+    results['time_batch'] = (time.perf_counter()-start) / np.sum(rows)
+
+    idx = np.arange(nbr_predict) % len(albedo)
+    args = (data['density'][idx], data['dz'][idx], data['zenith'][idx], data['algae'][idx])
+    # the first call projects the irradiance onto the components
+    predict_albedo(emulator, *(a[:1] for a in args))
+    for name, spectral in (('time_emulator', True), ('time_emulator_broadband', False)):
+        start = time.perf_counter()
+        predict_albedo(emulator, *args, spectral=spectral)
+        results[name] = (time.perf_counter()-start) / nbr_predict
+
+    print('emulator: {} columns, spectral albedo RMSE {:.1e} (99th percentile {:.1e}, max {:.1e}), BBA error max'\
+        ' {:.1e} mean {:.1e}, BBAVIS max {:.1e}, BBANIR max {:.1e}'.format(len(albedo), results['albedo_rmse'],\
+        results['albedo_p99'], results['albedo_max'], results['BBA_max'], results['BBA_mean'],\
+        results['BBAVIS_max'], results['BBANIR_max']))
+    print('time per column: snicar_feeder {:.2e} s, batched solver {:.2e} s, emulator {:.2e} s'\
+        ' (broadband only {:.2e} s)'.format(results['time_feeder'], results['time_batch'],\
+        results['time_emulator'], results['time_emulator_broadband']))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import_times = benchmark_import_time(['ParameterisationRuntime', 'ParameterisationFuncs',\
+        'SNICAR_feeder', 'Toon_RT_solver', 'adding_doubling_solver'])
+
+    print('\nIMPORT TIME (s)')
+    for module, t in import_times.items():
+        print(f'{module}: {t:.3f}')
+
+    print('\nJIT KERNELS (max abs difference, numpy time (s), jit time (s))')
+    for kernel, (diff, t_ref, t_out) in benchmark_jit_kernels().items():
+        print(f'{kernel}: {diff:.2e}, {t_ref:.4f}, {t_out:.4f}')
+
+    if len(sys.argv) > 1:
+        print('\nOPTICAL LIBRARY MEMORY (workers: total PSS reading files (MB), total PSS shared (MB))')
+        for n, (pss_files, pss_shared) in benchmark_optical_library_memory(sys.argv[1]).items():
+            print(f'{n}: {pss_files:.0f}, {pss_shared:.0f}')
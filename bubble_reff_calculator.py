@@ -1,6 +1,5 @@
+import collections
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 
 
 """
@@ -11,55 +10,126 @@ The reason this is required is that the well-known conversion between SSA and r_
 
 r_eff = 3/(P_i * SSA) where P_i is density of ice (917 kg m-3)
 
-gives the effective radius of a discrete grain of given SSA, for a collection of bubbles in a 
+gives the effective radius of a discrete grain of given SSA, for a collection of bubbles in a
 bulk medium of ice a more nuanced calculation is required.
 
-The derivation of the calculations are explained in the pdf ./Assets/SSA_derivation.pdf 
+The derivation of the calculations are explained in the pdf ./Assets/SSA_derivation.pdf
 from Chloe Whicker (UMich).
 
-For initial experiments in simulating GrIS glacier ice beneath the weathered crust 
+For initial experiments in simulating GrIS glacier ice beneath the weathered crust
 I have taken SSA values measured in ice cores of bubbly glacier ice from the Allan Hills (Antarctica)
-by CT-scanning by Dadic et al (2013), in the absence of data from Greenland.  
+by CT-scanning by Dadic et al (2013), in the absence of data from Greenland.
 
+bubble_effective_radius() converts whole arrays of density and SSA at once (the
+number of bubbles is computed from the air fraction of each sample).
+bubble_radius_index() lists the radii of the bbl_XXXX.nc files in the bubbly ice
+directory once, as a sorted array, and nearest_bubble_radius() maps any array of
+effective radii onto it with one binary search, giving values that can be used
+directly as grain_rds of layer_type 1 layers in snicar_feeder.
+
+usage:
+
+    radii = bubble_radius_index(inputs.dir_base + 'Data/bubbly_ice_files/')
+    bubbles = bubble_effective_radius(density, ssa)
+    grain_rds = nearest_bubble_radius(bubbles.r_eff, radii)
 
 """
 
 # SET CONSTANTS
 rho_ice = 917   # density of pure ice
 rho_air = 1.025  # density of air
-sigma_g = 1.5 # unitless 
+sigma_g = 1.5 # unitless
 sigma_tilde_g = np.log(sigma_g)
 
+# anything with a density smaller than this is represented as snow
+rho_snow = 550
+
+
+def bubble_effective_radius(rho, ssa):
+
+    """
+    rho:    density (kg m-3)
+    ssa:    specific surface area (m2 kg-1)
+
+    rho and ssa are broadcast against each other. returns a namedtuple of the
+    effective radius (microns), effective diameter (m), volume fraction of air
+    and number of bubbles, each with the broadcast shape. Samples below
+    rho_snow are treated as snow grains, so their air fraction and number of
+    bubbles are nan.
+
+    """
+
+    rho, ssa = np.broadcast_arrays(np.asarray(rho, dtype=float), np.asarray(ssa, dtype=float))
+
+    snow = rho < rho_snow
+
+    V_air = np.where(snow, np.nan, (rho - rho_ice) / (-rho_ice + rho_air)) # unitless volume fraction
+    D_eff = np.where(snow, 6/(rho_ice*ssa), (6*V_air)/(rho*ssa)) # D_eff in meters
+
+    # Number of bubbles
+    No = (6*V_air)/(np.pi*D_eff**3)*np.exp(3*sigma_tilde_g**2)
+
+    # convert effective diameter in meters to effective radius in microns
+    r_eff_micron = D_eff/2 * 1e6
+
+    bubbles = collections.namedtuple('bubbles', ['r_eff', 'D_eff', 'V_air', 'No'])
+
+    return bubbles(r_eff_micron, D_eff, V_air, No)
+
+
+def bubble_radius_index(dir_bubbly_ice):
+
+    """
+    returns the sorted array of the radii (microns) of the bbl_XXXX.nc files in
+    dir_bubbly_ice
+
+    """
+
+    import glob
+    import os
+
+    names = [os.path.basename(path) for path in glob.glob(os.path.join(dir_bubbly_ice, 'bbl_*.nc'))]
+    radii = np.array(sorted(int(name[4:-3]) for name in names if name[4:-3].isdigit()))
+
+    if len(radii) == 0:
+        raise ValueError("no bbl_XXXX.nc files in {}".format(dir_bubbly_ice))
+
+    return radii
+
+
+def nearest_bubble_radius(r_eff, radii):
+
+    """
+    maps each effective radius in r_eff to the nearest radius in radii (sorted,
+    from bubble_radius_index()). Radii outside the range of the files are
+    clamped to the smallest or largest file. Returns integers with the shape of
+    r_eff.
 
-# SET VARIABLES
-# Dadic et al. densities from calliper measurements
-#rho = [460, 668, 777, 864, 894] # kg / m3
-# Dadic et al. densities from Micro-CT
-rho = [460, 737, 820, 891, 894] # kg / m3
-# Dadic et al. speciic surface area from Micro-CT
-#ssa = [15.4, 3.8, 1.9, 0.39, 0.16]
-# Dadic et al. specific surface area from RT model
-ssa = [15.4, 7.8, 3.9, 0.65, 0.16] # Specific Surface Area units: m2/kg
+    """
 
+    r_eff = np.asarray(r_eff, dtype=float)
 
-# SETUP EMPTY ARRAYS
-D_eff = np.zeros(len(rho))
+    upper = np.clip(np.searchsorted(radii, r_eff), 1, len(radii)-1) if len(radii) > 1 else np.zeros(r_eff.shape, int)
+    lower = np.maximum(upper - 1, 0)
 
-# CALCULATE D_eff IN LOOP
-for i in np.arange(0,len(rho),1):
+    nearest = np.where(np.abs(r_eff - radii[lower]) <= np.abs(radii[upper] - r_eff), radii[lower], radii[upper])
 
-    if rho[i] < 550: # anything with a density smaller than 550 is represented as snow 
+    return nearest.astype(int)
 
-        D_eff[i] = 6/(rho_ice*ssa[i]) # D_eff in meters
 
-    else:
-        V_air= (rho[i] - rho_ice) / (-rho_ice + rho_air) # unitless volume fraction
-        D_eff[i] = (6*V_air)/(rho[i]*ssa[i]) # D_eff in meters
+if __name__ == '__main__':
 
-# Number of bubbles
-No = (6*V_air)/(np.pi*D_eff**3)*np.exp(3*sigma_tilde_g**2)
+    # SET VARIABLES
+    # Dadic et al. densities from calliper measurements
+    #rho = [460, 668, 777, 864, 894] # kg / m3
+    # Dadic et al. densities from Micro-CT
+    rho = [460, 737, 820, 891, 894] # kg / m3
+    # Dadic et al. speciic surface area from Micro-CT
+    #ssa = [15.4, 3.8, 1.9, 0.39, 0.16]
+    # Dadic et al. specific surface area from RT model
+    ssa = [15.4, 7.8, 3.9, 0.65, 0.16] # Specific Surface Area units: m2/kg
 
-# convert effective diameter in meters to effective radius in microns
-r_eff_micron = D_eff/2 * 1e6
+    bubbles = bubble_effective_radius(rho, ssa)
 
-print(np.round(r_eff_micron,0))
\ No newline at end of file
+    print(np.round(bubbles.r_eff, 0))
+    print(bubbles.No)
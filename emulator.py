@@ -0,0 +1,339 @@
+"""
+Compact emulator of the spectral albedo of the parameterisation columns.
+
+The linear parameterisation only predicts BBA and absorbed flux, and solving
+SNICAR for every pixel is too slow for large grids. The emulator predicts the
+full 480-band albedo of the single-layer columns of the parameterisation (a
+1 mm surface layer with glacier algae above a weathering crust of thickness dz,
+built as in raster_driver.pixel_optics()) from density, dz, solar zenith and
+algae, using only numpy matrix multiplies.
+
+- generate_emulator_dataset() solves random columns within the range of the
+  parameterisation sweep at a set of whole-degree zeniths with the batched
+  solvers
+- train_emulator() compresses the spectra to their leading principal
+  components and trains a small tanh MLP from the (scaled) inputs to the
+  component weights with Adam
+- predict_albedo() runs the MLP for any number of columns at once. BBA, BBAVIS
+  and BBANIR are linear in the spectrum, so they are calculated directly from
+  the component weights with the irradiance of each zenith projected onto the
+  components, and the spectra are only reconstructed when asked for
+
+The emulator is a dict of arrays saved with save_emulator() as a .npz file,
+including the index of the first near-infrared band of the solver it was
+trained with (spectral_bands.VIS_MAX_IDX), which splits BBAVIS and BBANIR. It
+is only valid for the settings of the inputs it was trained with (solver,
+irradiance, impurities other than algae, refractive index) and within the
+ranges of the training set.
+
+usage:
+
+    data = generate_emulator_dataset(inputs, nbr_columns=2000)
+    emulator = train_emulator(data)
+    save_emulator(emulator, 'albedo_emulator.npz')
+
+    emulator = load_emulator('albedo_emulator.npz')
+    outputs = predict_albedo(emulator, density, dz, zenith, algae)
+
+"""
+
+import collections
+import numpy as np
+
+
+def emulator_features(density, dz, zenith, algae):
+
+    """
+    returns the (columns, 4) unscaled inputs of the MLP: density, ln(dz),
+    cosine of the solar zenith and ln(1 + algae)
+
+    """
+
+    density, dz, zenith, algae = np.broadcast_arrays(*(np.asarray(x, dtype=float)\
+        for x in (density, dz, zenith, algae)))
+
+    return np.stack([density, np.log(dz), np.cos(np.radians(zenith)), np.log1p(algae)], axis=-1).reshape(-1, 4)
+
+
+def generate_emulator_dataset(inputs, nbr_columns=2000, zeniths=tuple(range(30, 81, 5)),\
+    density_range=(400, 900), dz_range=(0.05, 1), algae_range=(0, 20000), batch_size=500, seed=0):
+
+    """
+    solves nbr_columns random columns (density and algae uniform, dz
+    log-uniform within the given ranges, density rounded to 5 kg m-3) at every whole-degree zenith in
+    zeniths. inputs gives the solver and all other settings as for
+    snicar_feeder(). Columns whose albedo leaves [0, 1] (ill-conditioned Toon
+    solutions) are dropped.
+    returns a dict with density, dz, zenith, algae, the solver's BBA, BBAVIS
+    and BBANIR (rows) and albedo (rows, nbr_wvl), the irradiance flx_slr
+    (zeniths, nbr_wvl) of every whole degree flx_zenith from min(zeniths) to
+    max(zeniths) and the solver's first near-infrared band vis_max_idx
+
+    """
+
+    from raster_driver import column_template
+    from SNICAR_feeder import get_wavelengths, get_irradiance_batch
+    from spectral_bands import VIS_MAX_IDX
+
+    inputs = column_template(inputs)
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    zeniths = [int(z) for z in zeniths]
+
+    rng = np.random.default_rng(seed)
+    # bubble radius 10000 - 10 * density must match a bubbly ice file (steps of
+    # 50 microns), so densities are drawn on a 5 kg m-3 grid
+    density = 5*np.round(rng.uniform(*density_range, nbr_columns)/5)
+    dz = np.exp(rng.uniform(np.log(dz_range[0]), np.log(dz_range[1]), nbr_columns))
+    algae = rng.uniform(*algae_range, nbr_columns)
+
+    inputs.solzen = zeniths
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_batch(inputs)
+
+    albedo = np.empty((len(zeniths), nbr_columns, inputs.nbr_wvl))
+    broadband = np.empty((3, len(zeniths), nbr_columns))
+
+    for start in np.arange(0, nbr_columns, batch_size):
+        batch = slice(start, start+batch_size)
+        albedo[:, batch], broadband[:, :, batch] = solve_columns(inputs, density[batch], dz[batch], algae[batch],\
+            broadband=True)
+
+    data = dict(density=np.tile(density, len(zeniths)), dz=np.tile(dz, len(zeniths)),\
+        zenith=np.repeat(np.array(zeniths, dtype=float), nbr_columns), algae=np.tile(algae, len(zeniths)),\
+        albedo=albedo.reshape(-1, inputs.nbr_wvl), BBA=broadband[0].ravel(), BBAVIS=broadband[1].ravel(),\
+        BBANIR=broadband[2].ravel())
+
+    valid = np.all((data['albedo'] >= 0) & (data['albedo'] <= 1), axis=-1)
+    if not np.all(valid):
+        print("dropping {} ill-conditioned columns".format(np.sum(~valid)))
+        data = {name: value[valid] for name, value in data.items()}
+
+    inputs.solzen = list(range(min(zeniths), max(zeniths)+1))
+    data['flx_zenith'] = np.array(inputs.solzen, dtype=float)
+    data['flx_slr'] = get_irradiance_batch(inputs)[1]
+    data['vis_max_idx'] = VIS_MAX_IDX['toon' if inputs.TOON else 'add_double']
+
+    return data
+
+
+def solve_columns(inputs, density, dz, algae, broadband=False):
+
+    """
+    albedo (zeniths, columns, nbr_wvl) of the parameterisation columns for the
+    irradiance already set on inputs and, if broadband is True, the solver's
+    BBA, BBAVIS and BBANIR (3, zeniths, columns)
+
+    """
+
+    from raster_driver import pixel_optics
+    from SNICAR_feeder import solve_batch
+
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw = pixel_optics(inputs, density, dz, algae)
+
+    outputs = solve_batch(inputs)
+    albedo = np.asarray(outputs.albedo).reshape(-1, len(density), inputs.nbr_wvl)
+
+    if not broadband:
+        return albedo
+
+    return albedo, np.array([np.reshape(x, (-1, len(density))) for x in (outputs.BBA, outputs.BBAVIS, outputs.BBANIR)])
+
+
+def train_emulator(data, nbr_components=12, hidden=(64, 64), epochs=1000, batch_size=512,\
+    learning_rate=3e-3, validation=0.1, seed=0):
+
+    """
+    fits the emulator to a dataset from generate_emulator_dataset(): the
+    albedo spectra are projected onto their first nbr_components principal
+    components, and an MLP with tanh hidden layers of the given widths is
+    trained on a random (1 - validation) fraction of the rows to predict the
+    scaled component weights from the standardised features, using Adam
+    with a cosine-decaying learning rate.
+    returns the emulator dict and prints the validation errors
+
+    """
+
+    rng = np.random.default_rng(seed)
+
+    X = emulator_features(data['density'], data['dz'], data['zenith'], data['algae'])
+    albedo = np.asarray(data['albedo'], dtype=float)
+
+    rows = rng.permutation(len(X))
+    nbr_valid = int(round(validation*len(X)))
+    valid, train = rows[:nbr_valid], rows[nbr_valid:]
+
+    # principal components of the training spectra
+    mean = albedo[train].mean(axis=0)
+    components = np.linalg.svd(albedo[train]-mean, full_matrices=False)[2][:nbr_components]
+    weights = (albedo-mean) @ components.T
+
+    emulator = dict(x_mean=X[train].mean(axis=0), x_scale=X[train].std(axis=0),\
+        y_mean=weights[train].mean(axis=0), y_scale=np.full(nbr_components, weights[train].std()),\
+        albedo_mean=mean, components=components, flx_zenith=np.asarray(data['flx_zenith'], dtype=float),\
+        flx_slr=np.asarray(data['flx_slr'], dtype=float), vis_max_idx=np.asarray(data['vis_max_idx']))
+    emulator['x_scale'][emulator['x_scale'] == 0] = 1
+
+    # the component weights share one scale, so that the loss is proportional
+    # to the mean squared error of the reconstructed spectra
+    Xs = (X-emulator['x_mean'])/emulator['x_scale']
+    Ys = (weights-emulator['y_mean'])/emulator['y_scale']
+
+    # Glorot initialisation
+    sizes = [X.shape[1]] + list(hidden) + [nbr_components]
+    params = []
+    for n_in, n_out in zip(sizes[:-1], sizes[1:]):
+        params.append(rng.normal(0, np.sqrt(2/(n_in+n_out)), (n_in, n_out)))
+        params.append(np.zeros(n_out))
+
+    m = [np.zeros(p.shape) for p in params]
+    v = [np.zeros(p.shape) for p in params]
+    step = 0
+    total_steps = epochs*int(np.ceil(len(train)/batch_size))
+
+    for epoch in range(epochs):
+
+        order = rng.permutation(train)
+
+        for start in np.arange(0, len(train), batch_size):
+
+            batch = order[start:start+batch_size]
+
+            # forward pass, keeping the activations for the backward pass
+            activations = [Xs[batch]]
+            for i in range(0, len(params)-2, 2):
+                activations.append(np.tanh(activations[-1] @ params[i] + params[i+1]))
+            residual = activations[-1] @ params[-2] + params[-1] - Ys[batch]
+
+            # backward pass of the mean squared error
+            grads = [None]*len(params)
+            delta = 2*residual/residual.size
+            for i in range(len(params)-2, -1, -2):
+                grads[i] = activations[i//2].T @ delta
+                grads[i+1] = delta.sum(axis=0)
+                if i > 0:
+                    delta = (delta @ params[i].T) * (1-activations[i//2]**2)
+
+            step += 1
+            rate = learning_rate*0.5*(1+np.cos(np.pi*step/total_steps))
+            for p, g, m_p, v_p in zip(params, grads, m, v):
+                m_p *= 0.9
+                m_p += 0.1*g
+                v_p *= 0.999
+                v_p += 0.001*g**2
+                p -= rate*(m_p/(1-0.9**step)) / (np.sqrt(v_p/(1-0.999**step))+1e-8)
+
+    for i in range(0, len(params), 2):
+        emulator['W{}'.format(i//2)] = params[i]
+        emulator['b{}'.format(i//2)] = params[i+1]
+
+    if nbr_valid:
+        outputs = predict_albedo(emulator, data['density'][valid], data['dz'][valid], data['zenith'][valid],\
+            data['algae'][valid])
+        BBA = broadband_albedo(emulator, albedo[valid], data['zenith'][valid])
+        print("validation ({} rows): spectral albedo RMSE {:.2e}, max error {:.2e}, BBA max error {:.2e}"\
+            .format(nbr_valid, np.sqrt(np.mean((outputs.albedo-albedo[valid])**2)),\
+            np.max(np.abs(outputs.albedo-albedo[valid])), np.max(np.abs(outputs.BBA-BBA))))
+
+    return emulator
+
+
+def zenith_weights(emulator, zenith):
+
+    """
+    indices of the whole-degree zeniths of the emulator's irradiance either
+    side of zenith and the interpolation weight of the upper one, as in
+    SNICAR_feeder.get_irradiance_interpolated()
+
+    """
+
+    flx_zenith = emulator['flx_zenith']
+    position = np.interp(np.asarray(zenith, dtype=float), flx_zenith, np.arange(len(flx_zenith)))
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower+1, len(flx_zenith)-1)
+
+    return lower, upper, position-lower
+
+
+def broadband_albedo(emulator, albedo, zenith):
+
+    """
+    BBA of albedo spectra (columns, nbr_wvl) weighted by the emulator's
+    irradiance at zenith
+
+    """
+
+    lower, upper, frac = zenith_weights(emulator, np.broadcast_to(zenith, np.shape(albedo)[:-1]))
+    flx_slr = (1-frac[..., np.newaxis])*emulator['flx_slr'][lower] + frac[..., np.newaxis]*emulator['flx_slr'][upper]
+
+    return np.sum(flx_slr*albedo, axis=-1) / np.sum(flx_slr, axis=-1)
+
+
+def predict_albedo(emulator, density, dz, zenith, algae, spectral=True):
+
+    """
+    emulated albedo of the columns with the given density (kg m-3), weathering
+    crust thickness dz (m), solar zenith (degrees) and surface algae (as
+    inputs.mss_cnc_glacier_algae), which are broadcast against each other.
+    returns a namedtuple of albedo (columns, nbr_wvl, None unless spectral),
+    BBA, BBAVIS and BBANIR (columns)
+
+    """
+
+    X = emulator_features(density, dz, zenith, algae)
+
+    layer = (X-emulator['x_mean'])/emulator['x_scale']
+    nbr_layers = sum(1 for name in emulator if name.startswith('W'))
+    for i in range(nbr_layers-1):
+        layer = np.tanh(layer @ emulator['W{}'.format(i)] + emulator['b{}'.format(i)])
+    weights = (layer @ emulator['W{}'.format(nbr_layers-1)] + emulator['b{}'.format(nbr_layers-1)])\
+        * emulator['y_scale'] + emulator['y_mean']
+
+    # broadband albedos from the component weights: the irradiance of each
+    # whole-degree zenith is projected onto the components once, and the
+    # projections and irradiance sums are interpolated linearly in zenith
+    if 'flx_projection' not in emulator:
+        flx = np.stack([emulator['flx_slr']*band for band in band_masks(emulator)], axis=1)
+        emulator['flx_projection'] = np.concatenate([flx @ emulator['components'].T,\
+            (flx @ emulator['albedo_mean'])[..., np.newaxis], np.sum(flx, axis=-1)[..., np.newaxis]], axis=-1)
+
+    lower, upper, frac = zenith_weights(emulator, np.degrees(np.arccos(X[:, 2])))
+    frac = frac[:, np.newaxis, np.newaxis]
+
+    projection = (1-frac)*emulator['flx_projection'][lower] + frac*emulator['flx_projection'][upper]
+    broadband = (np.einsum('cbk,ck->cb', projection[..., :-2], weights) + projection[..., -2]) / projection[..., -1]
+
+    albedo = weights @ emulator['components'] + emulator['albedo_mean'] if spectral else None
+
+    outputs = collections.namedtuple('outputs', ['albedo', 'BBA', 'BBAVIS', 'BBANIR'])
+
+    return outputs(albedo, broadband[:, 0], broadband[:, 1], broadband[:, 2])
+
+
+def band_masks(emulator):
+
+    """
+    weights of the whole spectrum, the visible and the near-infrared bands,
+    split at the first near-infrared band of the solver the emulator was
+    trained with (emulators saved without vis_max_idx used the Toon split)
+
+    """
+
+    from spectral_bands import VIS_MAX_IDX
+
+    nbr_wvl = emulator['flx_slr'].shape[-1]
+    visible = np.arange(nbr_wvl) < int(emulator.get('vis_max_idx', VIS_MAX_IDX['toon']))
+
+    return np.ones(nbr_wvl), visible.astype(float), (~visible).astype(float)
+
+
+def save_emulator(emulator, path):
+
+    np.savez(path, **{name: value for name, value in emulator.items() if name != 'flx_projection'})
+
+    return
+
+
+def load_emulator(path):
+
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
@@ -1,61 +1,154 @@
-import xarray as xr
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-
 """
 
-Script calculates the spectral extinction coefficient for ice with varying 
+Script calculates the spectral extinction coefficient for ice with varying
 algal concentrations. The weighted average depends on the spectral distribution
-of incoming irradiance, so we provide two datasets, one for clear skies and 
+of incoming irradiance, so we provide two datasets, one for clear skies and
 one for cloiudy skies.
 
+The absorption coefficient of the ice/algae mixture is the volume-weighted sum
+of the absorption coefficients of ice (from the imaginary part of its
+refractive index) and algae (mass extinction coefficient * 650 kg m-3). The
+broadband value is its mean over bands 15:100 weighted by the spectral
+irradiance at the surface. Because the mixture is linear in the two volume
+fractions, the broadband coefficient is the same volume-weighted sum of the
+broadband coefficients of ice and algae, which are computed once per sky
+condition by load_ext_coeff_data(). ext_coeff() then evaluates whole arrays of
+algal concentration, crust density and sky condition in one pass, cheaply
+enough to call inside a melt model time loop. Plotting is a separate step
+(plot_ext_coeff()).
+
+usage:
+
+    data = load_ext_coeff_data(dir_base)
+    BBcoeff = ext_coeff(data, algae, density_WC, cloudy)
+    BBcoeff, abs_coeff = ext_coeff(data, algae, density_WC, cloudy, spectral=True)
+
 """
 
+import numpy as np
+
+# bands over which the broadband coefficient is averaged
+BB_BANDS = slice(15, 100)
+
+
+def load_ext_coeff_data(dir_base, wvl=np.arange(0.2, 4.999, 0.01)):
+
+    """
+    reads the refractive index of ice, the mass extinction coefficient of
+    glacier algae and the clear (SZA 45) and cloudy sky surface irradiance
+    once. returns a dict with the wavelengths, the spectral absorption
+    coefficients (m-1) of ice and algae, the irradiance weights of each sky
+    and the broadband coefficients of ice and algae for each sky (index 0
+    clear, 1 cloudy)
+
+    """
+
+    import xarray as xr
+
+    with xr.open_dataset(dir_base+'Data/rfidx_ice.nc') as refidx_file:
+        abs_ice = 4*np.pi*refidx_file['im_Pic16'].values/(wvl*1e-6)
+
+    with xr.open_dataset(dir_base+'Data/Mie_files/480band/lap/Cook2020_glacier_algae_4_40.nc') as alg_file:
+        abs_algae = alg_file['ext_cff_mss'].values*650 #m2/kg *kg /m3 = m-1
+
+    flx_frc_sfc = []
+    for irr_name in ['swnb_480bnd_smm_clr_SZA45.nc', 'swnb_480bnd_smm_cld.nc']:
+        with xr.open_dataset(dir_base+'Data/Mie_files/480band/fsds/'+irr_name) as irr_file:
+            flx_frc_sfc.append(irr_file['flx_frc_sfc'].values)
+
+    flx_frc_sfc = np.array(flx_frc_sfc)
+    weights = flx_frc_sfc[:, BB_BANDS]/np.sum(flx_frc_sfc[:, BB_BANDS], axis=-1, keepdims=True)
+
+    return dict(wvl=wvl, abs_ice=abs_ice, abs_algae=abs_algae, weights=weights,\
+        BB_ice=weights @ abs_ice[BB_BANDS], BB_algae=weights @ abs_algae[BB_BANDS])
+
+
+def ext_coeff(data, algae, density_WC, cloudy, density_algae=1450, density_ice=917, spectral=False):
+
+    """
+    data:           dict from load_ext_coeff_data()
+    algae:          mass concentration of algae (kg alg/kg ice)
+    density_WC:     density of the weathering crust (kg m-3)
+    cloudy:         True for cloudy (100%) and False for clear skies
+
+    the arguments are broadcast against each other, so any of them can be
+    arrays. The volume fractions of algae (algae*density_WC/density_algae) and
+    ice (density_WC/density_ice) are normalised by their sum, so density_WC
+    cancels out of the coefficient; it is kept to match calculate_ext_coeff().
+
+    returns the irradiance-weighted broadband coefficient (m-1) with the
+    broadcast shape of the arguments and, if spectral is True, the spectral
+    coefficient with an extra trailing wavelength axis
+
+    """
+
+    algae, density_WC, cloudy = np.broadcast_arrays(np.asarray(algae, dtype=float),\
+        np.asarray(density_WC, dtype=float), np.asarray(cloudy, dtype=bool))
+
+    vol_algae = algae*density_WC/density_algae #(m3 alg/m3 ice)
+    vol_ice = density_WC/density_ice #m3 ice/m3 total
+    vol_tot = vol_algae+vol_ice
+
+    frac_ice = vol_ice/vol_tot
+    frac_algae = vol_algae/vol_tot
+
+    sky = cloudy.astype(int)
+    BBcoeff = frac_ice*data['BB_ice'][sky] + frac_algae*data['BB_algae'][sky]
+
+    if not spectral:
+        return BBcoeff
+
+    abs_coeff = frac_ice[..., np.newaxis]*data['abs_ice'] + frac_algae[..., np.newaxis]*data['abs_algae']
+
+    return BBcoeff, abs_coeff
+
+
 def calculate_ext_coeff(dir_base, alg_list, cloudy, wvl, density_WC, density_algae, density_ice):
-    
-    BBcoeff = []
-    # read in files depending on user-selected cloud cover (0 or 100%)
-    if cloudy:
-        irr_file = xr.open_dataset(dir_base\
-        +'Data/Mie_files/480band/fsds/swnb_480bnd_smm_cld.nc')
-    else:
-        irr_file = xr.open_dataset(dir_base\
-        +'Data/Mie_files/480band/fsds/swnb_480bnd_smm_clr_SZA45.nc')
-
-    refidx_file = xr.open_dataset(dir_base+'Data/rfidx_ice.nc')
-    alg_file = xr.open_dataset(dir_base\
-    +'Data/Mie_files/480band/lap/Cook2020_glacier_algae_4_40.nc')
-
-
-    for alg in alg_list:
-        mass_conc_algae=alg #kg alg/kg ice, variable
-        abs_ice=4*np.pi*refidx_file['im_Pic16'].values/(wvl*1e-6)
-        abs_algae=(alg_file['ext_cff_mss'].values*650)#m2/kg *kg /m3 = m-1
-        vol_algae=mass_conc_algae*density_WC/density_algae #(m3 alg/m3 ice)
-        vol_ice=density_WC/density_ice #m3 ice/m3 total
-        vol_tot=vol_algae+vol_ice
-        abs_coeff=(abs_ice*vol_ice/vol_tot)+(abs_algae*vol_algae/vol_tot)
-
-        # weighted av
-        abs_coeff_weighted =\
-            np.sum(abs_coeff[15:100]*irr_file['flx_frc_sfc'].values[15:100])\
-                /np.sum(irr_file['flx_frc_sfc'].values[15:100])
-        
-        # plot spectral coeff inside loop
-        plt.figure(1)
-        plt.plot(wvl[15:100]*1000, abs_coeff[15:100])
-        
-        # append BB value to list
-        BBcoeff.append(abs_coeff_weighted)
-
-    return abs_coeff, BBcoeff
 
+    """
+    spectral coefficient for the last concentration in alg_list and the list of
+    broadband coefficients for every concentration (see ext_coeff())
+
+    """
+
+    data = load_ext_coeff_data(dir_base, wvl)
+    BBcoeff, abs_coeff = ext_coeff(data, alg_list, density_WC, cloudy, density_algae, density_ice, spectral=True)
+
+    return abs_coeff[-1], list(BBcoeff)
+
+
+def plot_ext_coeff(data, alg_list, abs_coeff, BBcoeff, path_spectral="WVL_SPECTRALEXT.jpg",\
+    path_broadband="ALG_BBEXT.jpg"):
+
+    """
+    plots the spectral coefficients abs_coeff (one row per concentration in
+    alg_list) over the broadband bands and the broadband coefficients against
+    concentration (ppb), and saves the figures to path_spectral and
+    path_broadband
+
+    """
+
+    import matplotlib.pyplot as plt
+
+    wvl = data['wvl']
+
+    plt.figure(1)
+    plt.plot(wvl[BB_BANDS]*1000, np.atleast_2d(abs_coeff)[:, BB_BANDS].T)
+    plt.xlabel("Wavelength (nm)"), plt.ylabel("ext_cff (m-1)")
+    plt.savefig(path_spectral)
+
+    plt.figure(2)
+    alg_list_labels = [i*1e9 for i in alg_list]
+    plt.plot(alg_list_labels, BBcoeff), plt.xticks(rotation=45)
+    plt.ylabel("ext_cff (m-1)"), plt.xlabel("Algal concentration ppb")
+    plt.savefig(path_broadband)
+
+    return
 
 
 def regression(alg_list, BBcoeff):
 
-    import statsmodels.api as sm  
+    import statsmodels.api as sm
     X = np.array(alg_list)
     X = sm.add_constant(X)
 
@@ -66,39 +159,33 @@ def regression(alg_list, BBcoeff):
     return model
 
 
+if __name__ == '__main__':
 
-out = pd.DataFrame()
-out['Malg (ppb)'] = [i * 1e9 for i in alg_list]
+    import pandas as pd
 
-dir_base = '/home/joe/Code/BioSNICAR_GO_PY/'
-wvl = np.arange(0.2, 4.999, 0.01)
-density_WC=350 #variable
-density_ice = 917 # constant
-density_algae=1450 # constant
+    dir_base = '/home/joe/Code/BioSNICAR_GO_PY/'
+    wvl = np.arange(0.2, 4.999, 0.01)
+    density_WC=350 #variable
+    density_ice = 917 # constant
+    density_algae=1450 # constant
 
-alg_list = [0, 1000e-9, 2000e-9, 5000e-9, 7500e-9, 10000e-9,\
-    12500e-9, 15000e-9, 17500e-9, 20000e-9, 22500e-9, 25000e-9]
+    alg_list = [0, 1000e-9, 2000e-9, 5000e-9, 7500e-9, 10000e-9,\
+        12500e-9, 15000e-9, 17500e-9, 20000e-9, 22500e-9, 25000e-9]
 
-for cloudy in [True, False]:
+    out = pd.DataFrame()
+    out['Malg (ppb)'] = [i * 1e9 for i in alg_list]
 
-    abs_coeff, BBcoeff = calculate_ext_coeff(dir_base,\
-        alg_list, cloudy, wvl, density_WC, density_algae,\
-            density_ice)
-    
-    if cloudy:
-        out['ext_coeff (m-1) (cloudy sky)'] =BBcoeff
-    else:
-        out['ext_coeff (m-1) (clear sky)'] =BBcoeff
+    data = load_ext_coeff_data(dir_base, wvl)
 
-    model = regression(alg_list, BBcoeff)
-    print(BBcoeff)
+    # rows: cloudy, clear sky; columns: alg_list
+    cloudy = np.array([True, False])[:, np.newaxis]
+    BBcoeff, abs_coeff = ext_coeff(data, alg_list, density_WC, cloudy, density_algae, density_ice, spectral=True)
 
+    out['ext_coeff (m-1) (cloudy sky)'] = BBcoeff[0]
+    out['ext_coeff (m-1) (clear sky)'] = BBcoeff[1]
 
-plt.xlabel("Wavelength (nm)"), plt.ylabel("ext_cff (m-1)")
-plt.savefig("WVL_SPECTRALEXT.jpg")
+    for sky_BBcoeff in BBcoeff:
+        model = regression(alg_list, sky_BBcoeff)
+        print(list(sky_BBcoeff))
 
-plt.figure(2)
-alg_list_labels = [i*1e9 for i in alg_list]
-plt.plot(alg_list_labels,BBcoeff),plt.xticks(rotation=45)
-plt.ylabel("ext_cff (m-1)"), plt.xlabel("Algal concentration ppb")
-plt.savefig("ALG_BBEXT.jpg")
\ No newline at end of file
+    plot_ext_coeff(data, alg_list, abs_coeff.reshape(-1, len(wvl)), BBcoeff[1])
@@ -0,0 +1,252 @@
+"""
+Optional JIT-compiled kernels for the batched radiative transfer solvers.
+
+The solvers in Toon_RT_solver.py and adding_doubling_solver.py were ported from
+MATLAB/Fortran loops. The batched versions (toon_solver_batch() and
+adding_doubling_solver_batch()) use numpy array operations by default; setting
+inputs.JIT = True swaps their innermost kernels for the numba-compiled loops in
+this module:
+
+- delta_eddington_layer(): delta scaling and Delta-Eddington diffuse terms
+- gaussian_diffuse_layer(): 8 point gaussian integration of the diffuse terms
+- tridiagonal_factor() / tridiagonal_solve(): Thomas algorithm for the Toon
+  tridiagonal matrix
+
+Each function has the same signature and returns the same values as its numpy
+counterpart. numba is optional: if it is not installed the numpy versions are
+used instead and a message is printed once. The first call compiles the kernels
+(cached to disk by numba), so only repeated solves benefit.
+
+benchmarks.benchmark_jit_kernels() checks parity with the numpy kernels and
+times both.
+
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+available = numba is not None
+warned = False
+
+
+def warn_unavailable():
+
+    global warned
+
+    if not warned:
+        print("numba is not installed: using the numpy kernels instead of the JIT kernels")
+        warned = True
+
+    return
+
+
+if available:
+
+    @numba.njit(cache=True)
+    def nan_to_num(x):
+        # scalar equivalent of np.nan_to_num
+        if np.isnan(x):
+            return 0.0
+        if np.isinf(x):
+            return np.finfo(np.float64).max if x > 0 else -np.finfo(np.float64).max
+        return x
+
+
+    @numba.njit(cache=True)
+    def delta_eddington_kernel(tau, SSA, g, exp_min):
+
+        n = tau.shape[0]
+        ts = np.empty(n)
+        ws = np.empty(n)
+        gs = np.empty(n)
+        lm = np.empty(n)
+        R1 = np.empty(n)
+        T1 = np.empty(n)
+
+        for i in range(n):
+            ftot = g[i] * g[i]
+            ts[i] = (1-(SSA[i] * ftot)) * tau[i]
+            ws[i] = ((1-ftot) * SSA[i]) / (1-(SSA[i] * ftot))
+            gs[i] = (g[i]-ftot)/(1-ftot)
+            lm[i] = np.sqrt(3 * (1-ws[i]) * (1-ws[i] * gs[i]))
+            ue = 1.5 * (1-ws[i] * gs[i]) / lm[i]
+
+            extins = max(exp_min, np.exp(-lm[i] * ts[i]))
+            ne = (ue+1)**2 / extins - (ue-1)**2 * extins
+
+            R1[i] = (ue**2-1) * (1/extins - extins)/ne
+            T1[i] = 4*ue/ne
+
+        return ts, ws, gs, lm, R1, T1
+
+
+    @numba.njit(cache=True)
+    def gaussian_diffuse_kernel(ts, ws, gs, lm, R1, T1, gauspt, gauswt, epsilon, exp_min):
+
+        n = ts.shape[0]
+        rdif = np.empty(n)
+        tdif = np.empty(n)
+
+        for i in range(n):
+            swt = 0.0
+            smr = 0.0
+            smt = 0.0
+
+            for ng in range(gauspt.shape[0]):
+                mu = gauspt[ng]
+                gwt = gauswt[ng]
+                swt = swt + mu*gwt
+                trn = max(exp_min, np.exp(-ts[i]/mu))
+
+                alp = (0.75 * ws[i] * mu) * ((1 + gs[i] * (1-ws[i])) / (1 - lm[i]**2 * mu**2 + epsilon))
+                gam = (0.5 * ws[i]) * ((1 + 3 * gs[i] * mu**2 * (1-ws[i])) / (1-lm[i]**2 * mu**2 + epsilon))
+
+                apg = alp + gam
+                amg = alp - gam
+                rdr = apg*R1[i] + amg*(T1[i]*trn - 1)
+                tdr = apg*T1[i] + (amg*R1[i]-apg+1)*trn
+                smr = smr + mu*rdr*gwt
+                smt = smt + mu*tdr*gwt
+
+            rdif[i] = smr/swt
+            tdif[i] = smt/swt
+
+        return rdif, tdif
+
+
+    @numba.njit(cache=True)
+    def tridiagonal_factor_kernel(A, B, D):
+
+        # A, B, D have shape (columns, rows, wavelengths)
+        ncol, nrow, nwvl = A.shape
+        AS = np.zeros(A.shape)
+        X = np.zeros(A.shape)
+
+        # wavelengths are the innermost (contiguous) loop
+        for c in range(ncol):
+            for w in range(nwvl):
+                AS[c, nrow-1, w] = nan_to_num(A[c, nrow-1, w]/B[c, nrow-1, w])
+
+            for i in range(nrow-2, -1, -1):
+                for w in range(nwvl):
+                    X[c, i, w] = 1/(B[c, i, w]-(D[c, i, w] * AS[c, i+1, w]))
+                    AS[c, i, w] = nan_to_num(A[c, i, w]*X[c, i, w])
+
+        return AS, X
+
+
+    @numba.njit(cache=True)
+    def tridiagonal_solve_kernel(AS, X, B, D, E):
+
+        # AS, X, B, D have shape (columns, rows, wavelengths) and E has shape
+        # (zeniths, columns, rows, wavelengths)
+        nzen, ncol, nrow, nwvl = E.shape
+        DS = np.zeros(E.shape)
+        Y = np.zeros(E.shape)
+
+        for z in range(nzen):
+            for c in range(ncol):
+                for w in range(nwvl):
+                    DS[z, c, nrow-1, w] = nan_to_num(E[z, c, nrow-1, w]/B[c, nrow-1, w])
+
+                for i in range(nrow-2, -1, -1):
+                    for w in range(nwvl):
+                        DS[z, c, i, w] = nan_to_num((E[z, c, i, w]-(D[c, i, w]*DS[z, c, i+1, w]))*X[c, i, w])
+
+                for w in range(nwvl):
+                    Y[z, c, 0, w] = DS[z, c, 0, w]
+
+                for i in range(1, nrow):
+                    for w in range(nwvl):
+                        Y[z, c, i, w] = DS[z, c, i, w] - (AS[c, i, w]*Y[z, c, i-1, w])
+
+        return Y
+
+
+def flat(x):
+
+    return np.ascontiguousarray(x, dtype=np.float64).ravel()
+
+
+def delta_eddington_layer(tau, SSA, g, exp_min=1e-5):
+
+    """
+    JIT version of adding_doubling_solver.delta_eddington_layer()
+
+    """
+
+    if not available:
+        warn_unavailable()
+        from adding_doubling_solver import delta_eddington_layer as numpy_kernel
+        return numpy_kernel(tau, SSA, g, exp_min)
+
+    tau, SSA, g = np.broadcast_arrays(tau, SSA, g)
+    out = delta_eddington_kernel(flat(tau), flat(SSA), flat(g), exp_min)
+
+    return tuple(x.reshape(tau.shape) for x in out)
+
+
+def gaussian_diffuse_layer(ts, ws, gs, lm, R1, T1):
+
+    """
+    JIT version of adding_doubling_solver.gaussian_diffuse_layer()
+
+    """
+
+    if not available:
+        warn_unavailable()
+        from adding_doubling_solver import gaussian_diffuse_layer as numpy_kernel
+        return numpy_kernel(ts, ws, gs, lm, R1, T1)
+
+    gauspt = np.array([0.9894009, 0.9445750, 0.8656312, 0.7554044, 0.6178762, 0.4580168, 0.2816036, 0.0950125])
+    gauswt = np.array([0.0271525, 0.0622535, 0.0951585, 0.1246290, 0.1495960, 0.1691565, 0.1826034, 0.1894506])
+
+    shape = np.shape(ts)
+    rdif, tdif = gaussian_diffuse_kernel(flat(ts), flat(ws), flat(gs), flat(lm), flat(R1), flat(T1),\
+        gauspt, gauswt, 1e-5, 1e-5)
+
+    return rdif.reshape(shape), tdif.reshape(shape)
+
+
+def tridiagonal_factor(A, B, D):
+
+    """
+    JIT version of Toon_RT_solver.tridiagonal_factor()
+
+    """
+
+    if not available:
+        warn_unavailable()
+        from Toon_RT_solver import tridiagonal_factor as numpy_kernel
+        return numpy_kernel(A, B, D)
+
+    shape = A.shape
+    cols = (-1,) + shape[-2:]
+    AS, X = tridiagonal_factor_kernel(np.ascontiguousarray(A.reshape(cols)),\
+        np.ascontiguousarray(B.reshape(cols)), np.ascontiguousarray(D.reshape(cols)))
+
+    return AS.reshape(shape), X.reshape(shape)
+
+
+def tridiagonal_solve(AS, X, B, D, E):
+
+    """
+    JIT version of Toon_RT_solver.tridiagonal_solve()
+
+    """
+
+    if not available:
+        warn_unavailable()
+        from Toon_RT_solver import tridiagonal_solve as numpy_kernel
+        return numpy_kernel(AS, X, B, D, E)
+
+    cols = (-1,) + AS.shape[-2:]
+    Y = tridiagonal_solve_kernel(np.ascontiguousarray(AS.reshape(cols)), np.ascontiguousarray(X.reshape(cols)),\
+        np.ascontiguousarray(B.reshape(cols)), np.ascontiguousarray(D.reshape(cols)),\
+        np.ascontiguousarray(E.reshape((E.shape[0],) + cols)))
+
+    return Y.reshape(E.shape)
@@ -0,0 +1,328 @@
+"""
+Cross-validated model selection for the parameterisation.
+
+The parameterisation is a first-order least-squares fit of BBA (or abs) to
+density, dz, zenith and algae. This module compares candidate model forms on
+the sweep dataset written by generate_snicar_dataset_single_layer():
+
+- polynomial degree (powers and interactions of the predictors, see
+  streaming_regression.polynomial_terms())
+- ln(1 + algae) instead of algae and ln(dz) instead of dz
+  (ParameterisationRuntime.TRANSFORMS)
+- one submodel per solar zenith in the sweep instead of zenith as a predictor,
+  interpolated linearly in zenith by ParameterisationRuntime.predict()
+
+Each candidate is scored by cross-validation (RMSE, mean and maximum absolute
+error on the held-out rows) in a process pool, one candidate per task. Random
+folds would leave rows of every zenith in the training set, so per-zenith
+candidates would never be scored on the interpolation between their
+submodels. All candidates are therefore scored on the same leave-one-zenith-out
+folds: every zenith of the sweep except the lowest and highest is held out in
+turn and predicted from the remaining zeniths (by interpolating the submodels,
+or through zenith as a predictor). Sweeps with fewer than three zeniths fall
+back to k shuffled folds for every candidate. The evaluation cost of each
+candidate is then measured as the time ParameterisationRuntime.predict() takes
+per million predictions, together with the number of coefficients. The report marks the candidates on the
+accuracy-versus-cost front, i.e. those that no other candidate beats on both.
+
+The selected model is the cheapest candidate whose cross-validated RMSE is
+within tolerance (relative) of the best. It is refitted on the whole dataset and
+saved in the coefficient format read by ParameterisationRuntime.load_coefficients().
+
+usage:
+
+    results, best, coefs = select_parameterisation('snicar_data_single_layer.csv', 'BBA',
+        tolerance=0.05, path_out='parameterisation_coefs_BBA.csv')
+
+"""
+
+import numpy as np
+
+# sweep data of this worker process (set by init_selection_worker())
+worker_data = None
+
+
+def candidate_models(degrees=(1, 2, 3), log_algae=(False, True), log_dz=(False, True), per_zenith=(False, True)):
+
+    """
+    returns a list of candidate model specifications (dicts of degree,
+    log_algae, log_dz and per_zenith) for every combination of the options
+
+    """
+
+    import itertools
+
+    return [dict(degree=int(degree), log_algae=la, log_dz=ld, per_zenith=pz)\
+        for degree, la, ld, pz in itertools.product(degrees, log_algae, log_dz, per_zenith)]
+
+
+def candidate_name(candidate):
+
+    options = ['log algae' if candidate['log_algae'] else '', 'log dz' if candidate['log_dz'] else '',\
+        'per zenith' if candidate['per_zenith'] else '']
+
+    return ', '.join(['degree {}'.format(candidate['degree'])] + [o for o in options if o])
+
+
+def candidate_terms(candidate):
+
+    """
+    model terms of a candidate, in the format of ParameterisationRuntime.py
+
+    """
+
+    from streaming_regression import polynomial_terms
+
+    predictors = ['density', 'log_dz' if candidate['log_dz'] else 'dz', 'zenith',\
+        'log_algae' if candidate['log_algae'] else 'algae']
+
+    if candidate['per_zenith']:
+        predictors.remove('zenith')
+
+    return polynomial_terms(tuple(predictors), candidate['degree'])
+
+
+def fit_candidate(candidate, data, var, rows=None):
+
+    """
+    least-squares fit of var with the terms of candidate to the rows (index
+    array or boolean mask, default all) of data ({column: array}).
+    returns the coefficients as {term: coefficient}, or as
+    {zenith: {term: coefficient}} for per-zenith candidates
+
+    """
+
+    from ParameterisationRuntime import PREDICTORS
+    from streaming_regression import StreamingLeastSquares, design_matrix
+
+    terms = candidate_terms(candidate)
+    rows = np.arange(len(data[var])) if rows is None else np.asarray(rows)
+    if rows.dtype == bool:
+        rows = np.nonzero(rows)[0]
+
+    def fit(subset):
+        model = StreamingLeastSquares(terms)
+        model.update(design_matrix(terms, {name: data[name][subset] for name in PREDICTORS}), data[var][subset])
+        return dict(zip(terms, model.solve()[0]))
+
+    if not candidate['per_zenith']:
+        return fit(rows)
+
+    zenith = data['zenith'][rows]
+
+    return {float(z): fit(rows[zenith == z]) for z in np.unique(zenith)}
+
+
+def predict_rows(coefs, data, rows):
+
+    from ParameterisationRuntime import predict
+
+    return predict(coefs, data['density'][rows], data['dz'][rows], data['zenith'][rows], data['algae'][rows])
+
+
+def init_selection_worker(data):
+
+    global worker_data
+
+    worker_data = data
+
+    return
+
+
+def zenith_folds(zenith):
+
+    """
+    returns one fold of row indices for each zenith in zenith except the lowest
+    and highest, which stay in the training set of every fold so that the
+    held-out zenith is interpolated rather than extrapolated
+
+    """
+
+    zeniths = np.unique(zenith)
+
+    return [np.nonzero(zenith == z)[0] for z in zeniths[1:-1]]
+
+
+def cross_validate(candidate, var, folds, data=None):
+
+    """
+    cross-validation of candidate: each fold of row indices in folds is
+    predicted by the model fitted to all other rows.
+    returns a dict with the candidate, its name, the RMSE, mean and maximum
+    absolute error over all held-out rows, and the coefficients fitted to all
+    rows
+
+    """
+
+    data = worker_data if data is None else data
+
+    errors = []
+
+    for k, test in enumerate(folds):
+        train = np.setdiff1d(np.arange(len(data[var])), test)
+        coefs = fit_candidate(candidate, data, var, train)
+        errors.append(predict_rows(coefs, data, test) - data[var][test])
+
+    errors = np.concatenate(errors)
+
+    return dict(candidate=candidate, name=candidate_name(candidate), rmse=float(np.sqrt(np.mean(errors**2))),\
+        mae=float(np.mean(np.abs(errors))), max_error=float(np.max(np.abs(errors))),\
+        coefs=fit_candidate(candidate, data, var))
+
+
+def evaluation_cost(coefs, size=20000, repeats=5):
+
+    """
+    returns the number of coefficients of a model and the time (s) that
+    ParameterisationRuntime.predict() takes per million predictions (median of
+    repeats, on random inputs within the range of the sweep)
+
+    """
+
+    import time
+    from ParameterisationRuntime import predict
+
+    rng = np.random.default_rng(0)
+    inputs = (rng.uniform(400, 900, size), rng.uniform(0.05, 1, size), rng.uniform(30, 80, size),\
+        rng.uniform(0, 20000, size))
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(coefs, *inputs)
+        times.append(time.perf_counter() - start)
+
+    nbr_coefs = sum(len(c) for c in coefs.values()) if isinstance(next(iter(coefs.values())), dict) else len(coefs)
+
+    return nbr_coefs, float(np.median(times)) * 1e6 / size
+
+
+def save_model_coefficients(coefs, path):
+
+    """
+    writes coefficients from fit_candidate() (single or per-zenith) with
+    ParameterisationRuntime.save_coefficients()
+
+    """
+
+    from ParameterisationRuntime import save_coefficients
+
+    if isinstance(next(iter(coefs.values())), dict):
+        rows = [(term, value, zenith) for zenith, submodel in coefs.items() for term, value in submodel.items()]
+        terms, values, zeniths = zip(*rows)
+        save_coefficients(terms, values, path, zeniths)
+    else:
+        save_coefficients(coefs.keys(), coefs.values(), path)
+
+    return
+
+
+def select_parameterisation(path_to_data, var, candidates=None, k=5, processes=None, tolerance=0.0,\
+    path_out=None, seed=0):
+
+    """
+    cross-validates candidates (default candidate_models()) for var ('BBA' or
+    'abs') on the sweep csv at path_to_data, all on the same folds
+    (zenith_folds() if the sweep has at least three zeniths, otherwise k
+    shuffled folds), in a process pool of processes workers (serially if
+    processes is 1), prints the accuracy
+    versus cost report and selects the cheapest candidate whose RMSE is within
+    tolerance (relative) of the best. If path_out is given the selected model,
+    refitted to all rows, is saved there.
+    returns the list of results (see cross_validate(), with nbr_coefs, eval_time
+    and pareto added), the selected result and its coefficients
+
+    """
+
+    import multiprocessing
+    import pandas as pd
+    from ParameterisationRuntime import PREDICTORS
+
+    df = pd.read_csv(path_to_data, usecols=list(PREDICTORS) + [var])
+    data = {name: df[name].to_numpy(dtype=float) for name in df.columns}
+
+    candidates = candidate_models() if candidates is None else candidates
+    # every candidate is scored on the same folds, so that their errors can be ranked
+    folds = zenith_folds(data['zenith'])
+    if folds:
+        scheme = 'leave-one-zenith-out cross-validation, {} held-out zeniths'.format(len(folds))
+    else:
+        print("WARNING: fewer than three zeniths in the sweep, candidates are scored with shuffled folds and"\
+            " per-zenith candidates are not scored on interpolation in zenith")
+        folds = np.array_split(np.random.default_rng(seed).permutation(len(df)), k)
+        scheme = '{}-fold cross-validation'.format(k)
+
+    tasks = [(candidate, var, folds) for candidate in candidates]
+
+    if processes == 1:
+        results = [cross_validate(*task, data=data) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer=init_selection_worker, initargs=(data,)) as pool:
+            results = pool.starmap(cross_validate, tasks, chunksize=1)
+
+    # evaluation cost is timed here, one model at a time
+    for result in results:
+        result['nbr_coefs'], result['eval_time'] = evaluation_cost(result['coefs'])
+
+    for result in results:
+        result['pareto'] = not any((other['rmse'] < result['rmse'] and other['eval_time'] <= result['eval_time'])\
+            or (other['rmse'] <= result['rmse'] and other['eval_time'] < result['eval_time']) for other in results)
+
+    results.sort(key=lambda result: result['rmse'])
+
+    best_rmse = results[0]['rmse']
+    selected = min([r for r in results if r['rmse'] <= best_rmse*(1+tolerance)], key=lambda r: r['eval_time'])
+
+    print(f"\n{var} MODEL SELECTION ({scheme}, {len(df)} rows)\n")
+    print('{:<40}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('model', 'coefs', 'RMSE', 'MAE', 'max error', 's / 1e6'))
+    for r in results:
+        flag = (' *' if r['pareto'] else '  ') + ('<' if r is selected else '')
+        print('{:<40}{:>8}{:>12.3e}{:>12.3e}{:>12.3e}{:>12.4f}{}'.format(r['name'], r['nbr_coefs'], r['rmse'],\
+            r['mae'], r['max_error'], r['eval_time'], flag))
+    print("\n* accuracy-versus-cost front, < selected model")
+
+    if path_out is not None:
+        save_model_coefficients(selected['coefs'], path_out)
+
+    return results, selected, selected['coefs']
+
+
+def check_common_folds(size=3000, seed=0):
+
+    """
+    checks on a synthetic sweep (BBA with a narrow peak in zenith at 55
+    degrees, six zeniths from 30 to 80) that the selection depends on scoring
+    every candidate on the same folds: a degree 2 global candidate scored on
+    shuffled folds beats the per-zenith candidate scored on zenith folds,
+    although it predicts the held-out zeniths worse once both are scored on
+    zenith_folds(). Prints the RMSE of both candidates on both kinds of folds.
+    returns the name of the winner on common folds, the name of the winner on
+    mixed folds, and whether the winner on common folds is the per-zenith
+    candidate and differs from the other
+
+    """
+
+    rng = np.random.default_rng(seed)
+    data = dict(density=rng.uniform(400, 900, size), dz=rng.uniform(0.05, 1, size),\
+        zenith=rng.choice([30., 40., 50., 60., 70., 80.], size), algae=rng.uniform(0, 20000, size))
+    data['BBA'] = 0.9 - 3e-4*(data['density']-400) + 0.02*np.log(data['dz']) - 1e-5*data['algae']\
+        + 0.05*np.exp(-((data['zenith']-55)/6)**2) + rng.normal(0, 1e-3, size)
+
+    candidates = [dict(degree=2, log_algae=False, log_dz=True, per_zenith=False),\
+        dict(degree=1, log_algae=False, log_dz=True, per_zenith=True)]
+    shuffled = np.array_split(rng.permutation(size), 5)
+    zenith = zenith_folds(data['zenith'])
+
+    rmse = {(candidate_name(c), scheme): cross_validate(c, 'BBA', folds, data=data)['rmse']\
+        for c in candidates for scheme, folds in (('shuffled', shuffled), ('zenith', zenith))}
+
+    print('{:<40}{:>12}{:>12}'.format('model', 'shuffled', 'zenith'))
+    for c in candidates:
+        print('{:<40}{:>12.3e}{:>12.3e}'.format(candidate_name(c), rmse[(candidate_name(c), 'shuffled')],\
+            rmse[(candidate_name(c), 'zenith')]))
+
+    names = [candidate_name(c) for c in candidates]
+    common = min(names, key=lambda name: rmse[(name, 'zenith')])
+    mixed = min([(rmse[(names[0], 'shuffled')], names[0]), (rmse[(names[1], 'zenith')], names[1])])[1]
+
+    return common, mixed, common == names[1] and mixed != common
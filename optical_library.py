@@ -0,0 +1,226 @@
+"""
+Shared-memory library of the optical property files read by snicar_feeder.
+
+When the parameterisation sweeps run across a process pool, every worker would
+otherwise open and hold its own copy of the Mie, geometric optics, bubbly ice,
+impurity, irradiance (FSDS) and refractive index arrays. Instead, the parent
+process reads the files once with publish_optical_library(), which packs every
+variable into a single OS shared memory block and returns a small metadata index
+of {file::variable: (offset, shape, dtype)}. Workers call
+attach_optical_library(index) (e.g. as the pool initializer), which maps the
+block and creates read-only numpy views into it without copying. Resident memory
+therefore stays roughly constant as the number of workers grows.
+
+All optical property reads in SNICAR_feeder.py and the batched solvers go through
+read_optical_variable(), which returns the shared view when a library is
+attached and the variable was published, and otherwise reads the file with
+xarray as before. The views are read-only, so callers copy before modifying.
+
+usage:
+
+    shm, index = publish_optical_library(dir_base)
+    with optical_library_pool(index, processes=64) as pool:
+        results = pool.map(run_snicar, params)
+    shm.close()
+    shm.unlink()
+
+"""
+
+import os
+import numpy as np
+
+# files published by default, relative to dir_base
+DEFAULT_PATTERNS = ['Data/rfidx_ice.nc', 'Data/FL_reflection_diffuse.nc', 'Data/Mie_files/480band/lap/*.nc',\
+    'Data/Mie_files/480band/fsds/*.nc', 'Data/Mie_files/480band/ice_*/*.nc', 'Data/GO_files/480band/ice_*/*.nc',\
+    'Data/bubbly_ice_files/*.nc', 'Data/Mie_files/480band/coated_spheres/*.nc']
+
+# library attached in this process: (shared memory block, {key: read-only view})
+attached = None
+
+
+def import_shared_memory():
+
+    """
+    returns the multiprocessing.shared_memory module, which needs python >= 3.8
+    (BioSNICAR_py.yaml pins 3.6, where sweeps read the files in each worker)
+
+    """
+
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        import sys
+        raise ImportError("the shared optical library needs multiprocessing.shared_memory (python >= 3.8), this is"\
+            " python {}.{}; run the pool without publish_optical_library() to read the files in each worker"\
+            .format(*sys.version_info[:2]))
+
+    return shared_memory
+
+
+def library_key(path, var):
+
+    return '{}::{}'.format(os.path.normpath(os.path.abspath(path)), var)
+
+
+def read_optical_arrays(dir_base, patterns=DEFAULT_PATTERNS):
+
+    """
+    returns {file::variable: array} of every numeric variable in the netCDF files
+    matching patterns (relative to dir_base)
+
+    """
+
+    import glob
+    import xarray as xr
+
+    arrays = {}
+
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(dir_base, pattern))):
+            with xr.open_dataset(path) as ds:
+                for var in ds.variables:
+                    values = ds[var].values
+                    if np.issubdtype(values.dtype, np.number):
+                        arrays[library_key(path, var)] = values
+
+    return arrays
+
+
+def load_optical_library(dir_base, patterns=DEFAULT_PATTERNS):
+
+    """
+    reads the files matching patterns into this process only and makes them
+    available to read_optical_variable() as read-only arrays, as
+    attach_optical_library() does for a shared library. Needs no shared
+    memory, so it also works on python < 3.8, for single-process users such as
+    albedo_service.py.
+    returns a dict of {file::variable: read-only array}
+
+    """
+
+    global attached
+
+    views = read_optical_arrays(dir_base, patterns)
+    for view in views.values():
+        view.flags.writeable = False
+
+    attached = (None, views)
+
+    return views
+
+
+def publish_optical_library(dir_base, patterns=DEFAULT_PATTERNS):
+
+    """
+    reads every numeric variable in the netCDF files matching patterns (relative
+    to dir_base) and copies them into one shared memory block.
+    returns the SharedMemory object, which the caller must close() and unlink()
+    when the workers are finished, and the metadata index to pass to
+    attach_optical_library()
+
+    """
+
+    shared_memory = import_shared_memory()
+
+    arrays = read_optical_arrays(dir_base, patterns)
+
+    # 8 byte aligned offsets into a single block
+    entries = {}
+    offset = 0
+    for key, values in arrays.items():
+        entries[key] = (offset, values.shape, values.dtype.str)
+        offset += -(-values.nbytes // 8) * 8
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 8))
+
+    for key, values in arrays.items():
+        start, shape, dtype = entries[key]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = values
+
+    index = dict(name=shm.name, size=offset, entries=entries)
+
+    return shm, index
+
+
+def attach_optical_library(index):
+
+    """
+    attaches this process to the shared memory block described by index (from
+    publish_optical_library()) and makes its arrays available to
+    read_optical_variable(). No data is copied.
+    returns a dict of {file::variable: read-only array}
+
+    """
+
+    global attached
+
+    shared_memory = import_shared_memory()
+
+    try:
+        shm = shared_memory.SharedMemory(name=index['name'], track=False)
+    except TypeError:
+        # python < 3.13: multiprocessing workers share the parent's resource
+        # tracker, so the block is still only unlinked by the parent
+        shm = shared_memory.SharedMemory(name=index['name'])
+
+    views = {}
+    for key, (offset, shape, dtype) in index['entries'].items():
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        view.flags.writeable = False
+        views[key] = view
+
+    attached = (shm, views)
+
+    return views
+
+
+def detach_optical_library():
+
+    """
+    releases the views and the shared memory mapping (if any) of the attached
+    library
+
+    """
+
+    global attached
+
+    if attached is not None:
+        shm, views = attached
+        attached = None
+        views.clear()
+        if shm is not None:
+            shm.close()
+
+    return
+
+
+def read_optical_variable(path, var):
+
+    """
+    returns variable var of the netCDF file at path, from the attached shared
+    library if possible (read-only, zero-copy) or otherwise from the file
+
+    """
+
+    if attached is not None:
+        view = attached[1].get(library_key(path, var))
+        if view is not None:
+            return view
+
+    import xarray as xr
+
+    with xr.open_dataset(path) as ds:
+        return ds[var].values
+
+
+def optical_library_pool(index, processes=None):
+
+    """
+    returns a multiprocessing Pool whose workers attach to the shared optical
+    library described by index when they start
+
+    """
+
+    import multiprocessing
+
+    return multiprocessing.Pool(processes=processes, initializer=attach_optical_library, initargs=(index,))
@@ -0,0 +1,334 @@
+"""
+Chunked raster driver: spectral albedo, BBA and absorbed flux maps from
+gridded surface properties.
+
+Each pixel of the raster has its own glacier algae concentration, ice density
+and weathering crust thickness. The column of every pixel is built as in
+ParameterisationFuncs.generate_snicar_params_single_layer(): a 1 mm surface
+layer containing the algae above a crust layer of the given thickness, both
+solid ice of the given density with bubble radius 10000 - 10 * density.
+
+The inputs are read one block of rows (a chunk) at a time from any sliceable
+array-like (numpy arrays, np.memmap band stacks, netCDF4 variables etc.).
+Within a chunk:
+
+- masked pixels (mask True, NaN or masked input values, density outside
+  (0, 917) kg m-3 or zero thickness) are never solved and get NaN outputs
+- the ice optics are read once per distinct density and the impurity optics
+  once per worker, and the optical depth of every pixel is built from them by
+  broadcasting, since it is linear in layer mass and algal concentration
+- pixels are solved batch_size at a time by the batched solvers, one call per
+  distinct solar zenith
+
+Chunks are solved in parallel by a process pool. At most two chunks per worker
+are in flight at once and each finished chunk is written to the outputs
+immediately, so memory use is bounded by the chunk size rather than the raster
+size.
+
+run_raster() works with array-likes for the inputs and outputs;
+run_raster_netcdf() reads from and writes to NetCDF files.
+
+"""
+
+import numpy as np
+
+# inputs of the pixel columns in this worker process (set by init_raster_worker())
+worker_inputs = None
+
+# ice optics already read in this process:
+# {(dir_base, rf_ice, density): (SSA_snw, MAC_snw, g_snw)}
+ice_optics_cache = {}
+
+
+def column_template(inputs):
+
+    """
+    returns a picklable copy (types.SimpleNamespace) of the attributes set on
+    inputs, which can be the namedtuple class used by the driver scripts
+
+    """
+
+    import types
+
+    values = {key: value for key, value in vars(inputs).items()\
+        if not key.startswith('_') and not hasattr(value, '__get__')}
+
+    return types.SimpleNamespace(**values)
+
+
+def init_raster_worker(template, index=None):
+
+    """
+    process pool initializer: stores the column template and optionally
+    attaches the shared optical library described by index
+    (optical_library.publish_optical_library())
+
+    """
+
+    global worker_inputs
+
+    worker_inputs = template
+
+    if index is not None:
+        from optical_library import attach_optical_library
+        attach_optical_library(index)
+
+    return
+
+
+def valid_pixels(algae, density, thickness, mask=None):
+
+    """
+    returns a boolean array that is True for the pixels that should be solved
+
+    """
+
+    valid = np.isfinite(algae) & np.isfinite(density) & np.isfinite(thickness)
+    valid &= (density > 0) & (density < 917) & (thickness > 0)
+
+    for field in (algae, density, thickness):
+        valid &= ~np.ma.getmaskarray(field)
+
+    if mask is not None:
+        valid &= ~np.asarray(mask, dtype=bool)
+
+    return np.asarray(valid)
+
+
+def pixel_optics(inputs, density, thickness, algae):
+
+    """
+    tau, SSA, g (pixels, 2, nbr_wvl) and L_snw (pixels, 2) of the pixel columns.
+    The ice optics of each distinct density are read with
+    SNICAR_feeder.get_ice_optics() and the impurities of inputs are mixed in as
+    in SNICAR_feeder.mix_optical_properties(), with the glacier algae
+    concentration of each pixel in the surface layer.
+
+    """
+
+    from SNICAR_feeder import IMPURITIES, get_ice_optics, get_impurity_optics,\
+        convert_impurity_concentration, combine_optical_properties
+
+    inputs.nbr_lyr = 2
+    inputs.layer_type = [1, 1]
+
+    densities, density_idx = np.unique(density, return_inverse=True)
+    SSA_snw = np.empty((len(densities), 2, inputs.nbr_wvl))
+    MAC_snw = np.empty(SSA_snw.shape)
+    g_snw = np.empty(SSA_snw.shape)
+
+    for i, rho in enumerate(densities):
+
+        key = (inputs.dir_base, inputs.rf_ice, rho)
+
+        if key not in ice_optics_cache:
+            if len(ice_optics_cache) > 1000:
+                ice_optics_cache.clear()
+            inputs.rho_layers = [rho, rho]
+            inputs.grain_rds = [int(round(10000-(rho*10)))]*2
+            ice_optics_cache[key] = get_ice_optics(inputs)
+
+        SSA_snw[i], MAC_snw[i], g_snw[i] = ice_optics_cache[key]
+
+    SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+
+    # per pixel impurity concentrations: those of inputs, with the glacier algae
+    # of each pixel in the surface layer
+    alg = IMPURITIES.index('glacier_algae')
+    MSS = np.repeat(MSSaer[np.newaxis], len(density), axis=0)
+    MSS[:, 0, alg] = convert_impurity_concentration(inputs, inputs.FILE_glacier_algae, algae)
+    MSS[:, 1, alg] = 0
+
+    L_snw = density[:, np.newaxis] * np.stack([np.full(len(thickness), 0.001), thickness], axis=-1)
+    tau_snw = L_snw[..., np.newaxis] * MAC_snw[density_idx]
+
+    # impurities in all layers are summed and applied to every layer, as in
+    # SNICAR_feeder.sum_impurity_optics()
+    L_aer = np.einsum('pl,pla->pa', L_snw, MSS)
+    tau_sum = (L_aer @ MACaer)[:, np.newaxis, :]
+    SSA_sum = (L_aer @ (MACaer*SSAaer))[:, np.newaxis, :]
+    g_sum = (L_aer @ (MACaer*SSAaer*Gaer))[:, np.newaxis, :]
+
+    tau, SSA, g = combine_optical_properties(tau_snw, SSA_snw[density_idx], g_snw[density_idx],\
+        tau_sum, SSA_sum, g_sum)
+
+    return tau, SSA, g, L_snw
+
+
+def raster_chunk(algae, density, thickness, zenith, valid, batch_size=2000, inputs=None):
+
+    """
+    solves the valid pixels of one chunk. zenith is a scalar or an array of the
+    chunk shape (rounded to whole degrees, as the irradiance files).
+    returns albedo (chunk shape + (nbr_wvl,)), BBA and the flux absorbed by
+    the surface layer (chunk shape), NaN where not valid
+
+    """
+
+    from SNICAR_feeder import get_wavelengths, get_irradiance, solve_batch
+
+    inputs = worker_inputs if inputs is None else inputs
+
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+
+    shape = np.shape(valid)
+    albedo = np.full(shape + (inputs.nbr_wvl,), np.nan)
+    BBA = np.full(shape, np.nan)
+    abs_sfc = np.full(shape, np.nan)
+
+    zenith = np.rint(np.broadcast_to(zenith, shape)).astype(int)
+
+    for zen in np.unique(zenith[valid]):
+
+        inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance(inputs, int(zen))
+        pixels = np.nonzero(valid & (zenith == zen))
+
+        for start in np.arange(0, len(pixels[0]), batch_size):
+
+            batch = tuple(p[start:start+batch_size] for p in pixels)
+
+            inputs.tau, inputs.SSA, inputs.g, inputs.L_snw = pixel_optics(inputs, density[batch].astype(float),\
+                thickness[batch].astype(float), algae[batch].astype(float))
+
+            outputs = solve_batch(inputs)
+
+            albedo[batch] = outputs.albedo
+            BBA[batch] = outputs.BBA
+            abs_sfc[batch] = np.asarray(outputs.abs_slr)[..., 0]
+
+    return albedo, BBA, abs_sfc
+
+
+def run_raster(inputs, algae, density, thickness, zenith, out_BBA, out_abs, out_albedo=None,\
+    mask=None, chunk_rows=64, batch_size=2000, processes=None, index=None):
+
+    """
+    inputs:     column settings as for snicar_feeder() (solver, irradiance,
+                impurity files and any other impurity concentrations)
+    algae:      glacier algae concentration of the surface layer, shape (rows, cols)
+    density:    ice density (kg m-3), shape (rows, cols)
+    thickness:  weathering crust thickness (m), shape (rows, cols)
+    zenith:     solar zenith (degrees), scalar or shape (rows, cols)
+    out_BBA, out_abs: writable array-likes of shape (rows, cols) for the
+                broadband albedo and the flux absorbed by the surface layer (W m-2)
+    out_albedo: optional writable array-like of shape (rows, cols, nbr_wvl)
+    mask:       optional array-like of shape (rows, cols), True where pixels are
+                not ice and should be skipped
+    chunk_rows: number of rows read, solved and written at once
+    batch_size: number of pixels per solver call
+    processes:  number of worker processes (chunks are solved in this process
+                if None or 1)
+    index:      optional shared optical library index for the workers
+
+    """
+
+    import collections
+
+    template = column_template(inputs)
+    nrows = np.shape(density)[0]
+    scalar_zenith = np.ndim(zenith) == 0
+
+    def read(rows):
+        fields = [np.ma.asarray(field[rows]) for field in (algae, density, thickness)]
+        valid = valid_pixels(*fields, mask=None if mask is None else np.asarray(mask[rows]))
+        fields = [np.ma.getdata(field) for field in fields]
+        zen = zenith if scalar_zenith else np.asarray(zenith[rows])
+        return fields + [zen, valid]
+
+    def write(rows, result):
+        albedo, BBA, abs_sfc = result
+        out_BBA[rows] = BBA
+        out_abs[rows] = abs_sfc
+        if out_albedo is not None:
+            out_albedo[rows] = albedo
+
+    def empty(valid):
+        nan = np.full(np.shape(valid), np.nan)
+        return np.full(np.shape(valid) + (template.nbr_wvl,), np.nan), nan, nan
+
+    chunks = [slice(start, min(start+chunk_rows, nrows)) for start in range(0, nrows, chunk_rows)]
+
+    if processes is None or processes == 1:
+
+        if index is not None:
+            init_raster_worker(template, index)
+
+        for rows in chunks:
+            args = read(rows)
+            result = raster_chunk(*args, batch_size=batch_size, inputs=template) if np.any(args[-1]) else empty(args[-1])
+            write(rows, result)
+
+        return
+
+    import multiprocessing
+
+    with multiprocessing.Pool(processes, initializer=init_raster_worker, initargs=(template, index)) as pool:
+
+        pending = collections.deque()
+
+        for rows in chunks:
+
+            args = read(rows)
+
+            # chunks without any ice are written without calling the solver
+            if not np.any(args[-1]):
+                write(rows, empty(args[-1]))
+                continue
+
+            pending.append((rows, pool.apply_async(raster_chunk, args, dict(batch_size=batch_size))))
+
+            # bound the number of chunks held in memory
+            while len(pending) >= 2*processes:
+                done_rows, result = pending.popleft()
+                write(done_rows, result.get())
+
+        while pending:
+            done_rows, result = pending.popleft()
+            write(done_rows, result.get())
+
+    return
+
+
+def run_raster_netcdf(inputs, path_in, path_out, write_albedo=False, **kwargs):
+
+    """
+    reads the variables algae, density, thickness, zenith and optionally mask
+    (dimensions (y, x), zenith may be a scalar) from the NetCDF file at path_in
+    and writes BBA, abs and optionally albedo (y, x, wvl) to a new NetCDF file
+    at path_out, one chunk at a time. kwargs are passed to run_raster().
+
+    """
+
+    import netCDF4
+
+    with netCDF4.Dataset(path_in) as src, netCDF4.Dataset(path_out, 'w') as dst:
+
+        density = src['density']
+        y_dim, x_dim = density.dimensions
+
+        dst.createDimension(y_dim, density.shape[0])
+        dst.createDimension(x_dim, density.shape[1])
+        out_BBA = dst.createVariable('BBA', 'f8', (y_dim, x_dim), fill_value=np.nan)
+        out_abs = dst.createVariable('abs', 'f8', (y_dim, x_dim), fill_value=np.nan)
+        out_BBA.long_name = 'broadband albedo'
+        out_abs.long_name = 'energy absorbed in the surface layer'
+        out_abs.units = 'W m-2'
+
+        out_albedo = None
+        if write_albedo:
+            dst.createDimension('wvl', 480)
+            out_albedo = dst.createVariable('albedo', 'f4', (y_dim, x_dim, 'wvl'), fill_value=np.nan,\
+                chunksizes=(min(kwargs.get('chunk_rows', 64), density.shape[0]), density.shape[1], 480))
+            out_albedo.long_name = 'spectral albedo'
+
+        zenith = src['zenith']
+        if zenith.ndim == 0:
+            zenith = float(zenith[...])
+
+        mask = src['mask'] if 'mask' in src.variables else None
+
+        run_raster(inputs, src['algae'], density, src['thickness'], zenith, out_BBA, out_abs,\
+            out_albedo=out_albedo, mask=mask, **kwargs)
+
+    return
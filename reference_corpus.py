@@ -0,0 +1,628 @@
+"""
+Reference-output corpus and differential harness for the snicar engines.
+
+Vectorised, batched, JIT or reduced-precision versions of snicar_feeder(),
+toon_solver() and adding_doubling_solver() must still reproduce the original.
+This module stores a corpus of input configurations with the outputs of the
+original engine, and compares any other engine against it.
+
+corpus_cases() lists the configurations. They cover:
+
+- granular, solid ice and mixed columns
+- the five grain shapes and water-coated grains
+- black carbon (bare and coated), brown carbon, dust and snow and glacier algae
+  in both unit conventions, and CDOM in solid ice
+- direct and diffuse illumination
+- both solvers, all three APRX_TYP approximations of the Toon solver, with and
+  without the delta transformation, and the three refractive indices of ice
+- runs of identical layers, which inputs.MERGE_LAYERS merges: a deep
+  homogeneous column, runs below a distinct surface layer and below two
+  distinct layers, and a run of ice layers starting at the first solid ice
+  layer
+
+Each case is a dict of the inputs attributes that differ from the template
+inputs (as set in SNICAR_driver.py) given to build_reference_corpus(). The
+builder runs snicar_feeder() on every case and pickles the template, the cases
+and the albedo, BBA, BBAVIS, BBANIR, abs_slr and heat_rt of each. Cases that
+cannot run with the data directory of the template (e.g. missing geometric
+optics files) are skipped and listed in the corpus.
+
+The reference must come from the original engine, not from the refactored
+snicar_feeder() of this tree, or the harness only checks the code against
+itself. build_reference_corpus() therefore takes the source directory of
+another checkout and runs its snicar_feeder() (with its loop-based toon_solver()
+and adding_doubling_solver()) in a separate process. The original
+snicar_feeder() cannot run diffuse illumination (it never sets inputs.flx_slr,
+which both solvers read), so diffuse cases are solved by the loop-based solvers
+of the source tree on the optics of this tree (prepare_optics()). The corpus
+records which reference each case has. REFERENCE_CORPUS is built this way from
+the original commit ba4c84d and is committed with the repository;
+run_differential() compares against it by default.
+
+An engine is a picklable function that takes inputs and returns an object with
+those six outputs as attributes; ENGINES has the ones in this repository.
+run_differential() runs an engine and snicar_feeder() on every case in a
+process pool. Each output is checked against the stored reference with an
+absolute and a relative tolerance: |engine - reference| <= atol + rtol *
+|reference|. The report gives the largest deviation of each output, the cases
+that fail and the speedup of the engine over snicar_feeder() for each case.
+
+usage:
+
+    git worktree add --detach ../snicar_original ba4c84d
+    build_reference_corpus(inputs, REFERENCE_CORPUS, source='../snicar_original')
+    results = run_differential('jit', dir_base=inputs.dir_base, processes=8)
+    results = run_differential('single_precision', dir_base=inputs.dir_base,
+        tolerances=SINGLE_PRECISION_TOLERANCES)
+
+"""
+
+import numpy as np
+
+import os
+
+OUTPUTS = ['albedo', 'BBA', 'BBAVIS', 'BBANIR', 'abs_slr', 'heat_rt']
+
+# corpus built from the original engine (commit ba4c84d)
+REFERENCE_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference_corpus.pkl')
+
+# default (atol, rtol) of each output. abs_slr (W m-2) and heat_rt (K hr-1) are
+# differences of interface fluxes, so reordering the flux arithmetic (as the
+# batched adding-doubling solver does) moves them by ~1e-5 at round-off level
+TOLERANCES = dict(albedo=(1e-9, 1e-7), BBA=(1e-9, 1e-7), BBAVIS=(1e-9, 1e-7), BBANIR=(1e-9, 1e-7),\
+    abs_slr=(1e-4, 1e-7), heat_rt=(1e-4, 1e-7))
+
+# tolerances for the float32 solvers (inputs.SINGLE_PRECISION): the spectral
+# albedo of strongly absorbing bands can be off by ~1e-2, the broadband values
+# by ~1e-6
+SINGLE_PRECISION_TOLERANCES = dict(albedo=(2e-2, 0), BBA=(1e-5, 0), BBAVIS=(1e-5, 0), BBANIR=(1e-5, 0),\
+    abs_slr=(1e-2, 0), heat_rt=(1e-3, 0))
+
+# corpus of this worker process (set by init_differential_worker())
+worker_corpus = None
+
+
+def column_settings(dz, rho_layers, grain_rds, layer_type, grain_shp=None, **settings):
+
+    """
+    returns the inputs attributes of a column: the per-layer lists (grain
+    shape, water coating, shape factor, aspect ratio, CDOM and the hexagonal
+    prism dimensions default to zero in every layer), every impurity
+    concentration set to zero in every layer unless given as
+    mss_cnc_<name>, and any other settings
+
+    """
+
+    from SNICAR_feeder import IMPURITIES
+
+    nbr_lyr = len(dz)
+    zeros = [0]*nbr_lyr
+
+    column = dict(dz=list(dz), nbr_lyr=nbr_lyr, rho_layers=list(rho_layers), grain_rds=list(grain_rds),\
+        layer_type=list(layer_type), grain_shp=list(zeros if grain_shp is None else grain_shp), rwater=zeros,\
+        shp_fctr=zeros, grain_ar=zeros, cdom_layer=zeros, side_length=zeros, depth=zeros)
+
+    for name in IMPURITIES:
+        column['mss_cnc_'+name] = zeros
+
+    column.update(settings)
+
+    return column
+
+
+def corpus_cases():
+
+    """
+    returns a list of (name, settings) of the corpus configurations
+
+    """
+
+    cases = []
+
+    snow = dict(dz=[0.02, 0.05, 0.1, 0.3], rho_layers=[250, 300, 350, 400], grain_rds=[150, 300, 500, 1000],\
+        layer_type=[0, 0, 0, 0])
+    ice = dict(dz=[0.001, 0.05, 0.2, 1], rho_layers=[600, 650, 750, 850], grain_rds=[5000, 4500, 3000, 1500],\
+        layer_type=[1, 1, 1, 1])
+    mixed = dict(dz=[0.01, 0.05, 0.5], rho_layers=[350, 550, 800], grain_rds=[400, 5000, 2000],\
+        layer_type=[0, 1, 1])
+
+    # solvers, approximations and illumination
+    for direct in (1, 0):
+        sky = 'direct' if direct else 'diffuse'
+        for aprx in (1, 2, 3):
+            cases.append(('toon_snow_aprx{}_{}'.format(aprx, sky), column_settings(**snow, TOON=True,\
+                ADD_DOUBLE=False, APRX_TYP=aprx, DIRECT=direct, solzen=55)))
+        cases.append(('ad_snow_{}'.format(sky), column_settings(**snow, DIRECT=direct, solzen=55)))
+        cases.append(('ad_ice_{}'.format(sky), column_settings(**ice, DIRECT=direct, solzen=45)))
+        cases.append(('ad_mixed_{}'.format(sky), column_settings(**mixed, DIRECT=direct, solzen=65)))
+
+    cases.append(('toon_snow_no_delta', column_settings(**snow, TOON=True, ADD_DOUBLE=False, DELTA=0, solzen=40)))
+    cases.append(('toon_snow_zenith_75', column_settings(**snow, TOON=True, ADD_DOUBLE=False, APRX_TYP=2,\
+        solzen=75)))
+    cases.append(('ad_ice_zenith_30', column_settings(**ice, solzen=30)))
+    cases.append(('ad_ice_single_layer', column_settings([0.5], [700], [3000], [1], solzen=50)))
+
+    # grain shapes (He et al. 2017) and hexagonal prisms (geometric optics)
+    for shape, name in ((1, 'spheroid'), (2, 'hexagonal_plate'), (3, 'koch_snowflake')):
+        cases.append(('toon_snow_{}'.format(name), column_settings(**snow, grain_shp=[shape]*4, TOON=True,\
+            ADD_DOUBLE=False, solzen=50)))
+        cases.append(('ad_snow_{}'.format(name), column_settings(**snow, grain_shp=[shape]*4, solzen=50)))
+    cases.append(('ad_snow_spheroid_shape_factor', column_settings(**snow, grain_shp=[1]*4,\
+        shp_fctr=[0.85]*4, grain_ar=[0.7]*4, solzen=50)))
+    cases.append(('ad_hexagonal_prisms', column_settings([0.05, 0.5], [400, 500], [1000, 1000], [0, 0],\
+        grain_shp=[4, 4], side_length=[10000, 10000], depth=[10000, 10000], solzen=50)))
+    cases.append(('ad_wet_snow', column_settings([0.05, 0.5], [400, 500], [500, 1000], [0, 0],\
+        rwater=[550, 0], solzen=50)))
+
+    # impurities
+    cases.append(('ad_snow_soot', column_settings(**snow, mss_cnc_soot1=[20, 10, 0, 0],\
+        mss_cnc_soot2=[10, 0, 0, 0], solzen=50)))
+    cases.append(('toon_snow_brown_carbon_dust', column_settings(**snow, mss_cnc_brwnC1=[50, 0, 0, 0],\
+        mss_cnc_brwnC2=[20, 0, 0, 0], mss_cnc_Cook_Greenland_dust_L=[5000, 1000, 0, 0], TOON=True,\
+        ADD_DOUBLE=False, solzen=50)))
+    cases.append(('ad_snow_snow_algae_cells', column_settings(**snow, mss_cnc_snw_alg=[20000, 5000, 0, 0],\
+        SA_units=1, solzen=50)))
+    cases.append(('ad_snow_snow_algae_ppb', column_settings(**snow, mss_cnc_snw_alg=[500000, 0, 0, 0],\
+        SA_units=0, Cfactor_SA=0, solzen=50)))
+    cases.append(('ad_ice_glacier_algae_cells', column_settings(**ice, mss_cnc_glacier_algae=[20000, 0, 0, 0],\
+        GA_units=1, solzen=50)))
+    cases.append(('ad_ice_glacier_algae_ppb', column_settings(**ice, mss_cnc_glacier_algae=[100000, 0, 0, 0],\
+        GA_units=0, Cfactor_GA=0, solzen=50)))
+    cases.append(('ad_ice_dust', column_settings(**ice, mss_cnc_dust3=[50000, 10000, 0, 0],\
+        mss_cnc_GreenlandCentral2=[20000, 0, 0, 0], solzen=50)))
+    cases.append(('ad_ice_cdom', column_settings(**ice, cdom_layer=[1, 1, 0, 0], solzen=50)))
+
+    # runs of identical layers (merged by the merge_layers engine). The first two
+    # layers and the first solid ice layer are never merged, and the Toon solver
+    # only merges runs with the optical properties of the second layer
+    homogeneous = dict(dz=[0.05]*12, rho_layers=[350]*12, grain_rds=[500]*12, layer_type=[0]*12)
+    thin_top = dict(dz=[0.001]+[0.05]*7, rho_layers=[300]+[400]*7, grain_rds=[300]+[600]*7, layer_type=[0]*8)
+    distinct_top = dict(dz=[0.001, 0.03]+[0.05]*6, rho_layers=[300, 350]+[400]*6, grain_rds=[300, 450]+[600]*6,\
+        layer_type=[0]*8)
+    snow_over_ice = dict(dz=[0.01, 0.03]+[0.1]*6, rho_layers=[300, 350]+[750]*6, grain_rds=[300, 450]+[3000]*6,\
+        layer_type=[0, 0]+[1]*6)
+    for direct in (1, 0):
+        sky = 'direct' if direct else 'diffuse'
+        for name, column in (('homogeneous', homogeneous), ('thin_top', thin_top), ('distinct_top', distinct_top)):
+            cases.append(('toon_{}_{}'.format(name, sky), column_settings(**column, TOON=True, ADD_DOUBLE=False,\
+                DIRECT=direct, solzen=50)))
+            cases.append(('ad_{}_{}'.format(name, sky), column_settings(**column, DIRECT=direct, solzen=50)))
+        cases.append(('ad_snow_over_ice_{}'.format(sky), column_settings(**snow_over_ice, DIRECT=direct, solzen=50)))
+
+    # refractive index of ice
+    for rf_ice in (0, 1):
+        cases.append(('ad_mixed_rf_ice{}'.format(rf_ice), column_settings(**mixed, rf_ice=rf_ice, solzen=50)))
+        cases.append(('toon_snow_rf_ice{}'.format(rf_ice), column_settings(**snow, rf_ice=rf_ice, TOON=True,\
+            ADD_DOUBLE=False, solzen=50)))
+
+    return cases
+
+
+def case_inputs(template, settings):
+
+    """
+    returns a copy of the template (a dict of inputs attributes) with the case
+    settings applied, as a types.SimpleNamespace
+
+    """
+
+    import copy
+    import types
+
+    inputs = types.SimpleNamespace(**copy.deepcopy(template))
+    for name, value in copy.deepcopy(settings).items():
+        setattr(inputs, name, value)
+
+    return inputs
+
+
+def collect_outputs(outputs):
+
+    return {name: np.array(getattr(outputs, name), dtype=float) for name in OUTPUTS}
+
+
+def init_source_worker(source):
+
+    import sys
+
+    sys.path.insert(0, os.path.abspath(source))
+
+    return
+
+
+def reference_outputs(template, settings):
+
+    """
+    runs the snicar_feeder() found first on sys.path on a case.
+    returns the outputs (collect_outputs())
+
+    """
+
+    import contextlib
+    import io
+    from SNICAR_feeder import snicar_feeder
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return collect_outputs(snicar_feeder(case_inputs(template, settings)))
+
+
+def reference_solver_outputs(inputs):
+
+    """
+    runs the toon_solver() or adding_doubling_solver() found first on sys.path
+    on inputs with the optics already set (prepare_optics()).
+    returns the outputs (collect_outputs())
+
+    """
+
+    import contextlib
+    import io
+    import types
+    from Toon_RT_solver import toon_solver
+    from adding_doubling_solver import adding_doubling_solver
+
+    solver = toon_solver if inputs.TOON else adding_doubling_solver
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        outputs = solver(inputs)
+
+    return collect_outputs(types.SimpleNamespace(**dict(zip(['wvl']+OUTPUTS, outputs))))
+
+
+def build_reference_corpus(inputs, path=None, cases=None, source=None):
+
+    """
+    runs snicar_feeder() on every case (default corpus_cases()) on top of the
+    template inputs and pickles the corpus to path (default REFERENCE_CORPUS).
+    If source is given, the snicar_feeder() of the source tree at that
+    directory (e.g. a checkout of the original commit) is run in a fresh
+    process instead of the one of this tree, and diffuse cases are solved by
+    the solvers of the source tree on the optics of this tree.
+    returns the corpus dict
+
+    """
+
+    import contextlib
+    import io
+    import multiprocessing
+    import pickle
+    from raster_driver import column_template
+
+    template = dict(vars(column_template(inputs)))
+    for name in ('wvl', 'mu_not', 'flx_slr', 'Fs', 'Fd', 'tau', 'SSA', 'g', 'L_snw'):
+        template.pop(name, None)
+
+    path = REFERENCE_CORPUS if path is None else path
+    cases = corpus_cases() if cases is None else cases
+
+    reference = {}
+    engines = {}
+    skipped = {}
+
+    # a spawned process imports the source tree's modules, not the ones already loaded here
+    pool = None if source is None else\
+        multiprocessing.get_context('spawn').Pool(1, initializer=init_source_worker, initargs=(source,))
+
+    try:
+        for name, settings in cases:
+            try:
+                if pool is None:
+                    reference[name] = reference_outputs(template, settings)
+                    engines[name] = 'snicar_feeder'
+                elif settings.get('DIRECT', template.get('DIRECT', 1)):
+                    reference[name] = pool.apply(reference_outputs, (template, settings))
+                    engines[name] = 'snicar_feeder'
+                else:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        inputs = prepare_optics(case_inputs(template, settings))
+                    reference[name] = pool.apply(reference_solver_outputs, (inputs,))
+                    engines[name] = 'solvers'
+            except Exception as error:
+                skipped[name] = repr(error)
+                print("skipping case {}: {}".format(name, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    corpus = dict(template=template, cases=[(name, settings) for name, settings in cases if name in reference],\
+        reference=reference, engines=engines, skipped=skipped,\
+        source='this tree' if source is None else os.path.abspath(source))
+
+    with open(path, 'wb') as f:
+        pickle.dump(corpus, f)
+
+    print("reference corpus of {} cases written to {} ({} skipped)".format(len(reference), path, len(skipped)))
+
+    return corpus
+
+
+def load_corpus(path=None, dir_base=None):
+
+    """
+    returns the corpus pickled at path (default REFERENCE_CORPUS), with the
+    data directory of the template replaced by dir_base if given
+
+    """
+
+    import pickle
+
+    path = REFERENCE_CORPUS if path is None else path
+
+    with open(path, 'rb') as f:
+        corpus = pickle.load(f)
+
+    if dir_base is not None:
+        corpus['template']['dir_base'] = dir_base
+
+    return corpus
+
+
+def prepare_optics(inputs):
+
+    """
+    sets the wavelengths, irradiance and column optics of snicar_feeder() on
+    inputs, ready for a solver.
+    returns inputs
+
+    """
+
+    from SNICAR_feeder import get_wavelengths, get_irradiance, get_ice_optics, get_impurity_optics,\
+        mix_optical_properties
+
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance(inputs, inputs.solzen)
+
+    SSA_snw, MAC_snw, g_snw = get_ice_optics(inputs)
+    SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+    inputs.tau, inputs.SSA, inputs.g, inputs.L_snw =\
+        mix_optical_properties(inputs, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer)
+
+    return inputs
+
+
+def batch_engine(inputs):
+
+    """
+    the optics of snicar_feeder() followed by the batched solvers
+    (SNICAR_feeder.solve_batch())
+
+    """
+
+    from SNICAR_feeder import solve_batch
+
+    return solve_batch(prepare_optics(inputs))
+
+
+def jit_engine(inputs):
+
+    inputs.JIT = True
+
+    return batch_engine(inputs)
+
+
+def merge_layers_engine(inputs):
+
+    inputs.MERGE_LAYERS = True
+
+    return batch_engine(inputs)
+
+
+def single_precision_engine(inputs):
+
+    inputs.SINGLE_PRECISION = True
+
+    return batch_engine(inputs)
+
+
+def reference_engine(inputs):
+
+    from SNICAR_feeder import snicar_feeder
+
+    return snicar_feeder(inputs)
+
+
+ENGINES = dict(snicar_feeder=reference_engine, batch=batch_engine, jit=jit_engine,\
+    merge_layers=merge_layers_engine, single_precision=single_precision_engine)
+
+
+def init_differential_worker(corpus):
+
+    global worker_corpus
+
+    worker_corpus = corpus
+
+    return
+
+
+def compare_outputs(outputs, reference, tolerances):
+
+    """
+    returns {output: (largest absolute deviation, largest ratio of the
+    deviation to its tolerance)}; a shape mismatch counts as an infinite
+    deviation
+
+    """
+
+    deviations = {}
+
+    for name in OUTPUTS:
+
+        atol, rtol = tolerances[name]
+        value = np.atleast_1d(outputs[name])
+        ref = np.atleast_1d(reference[name])
+
+        if value.shape != ref.shape:
+            deviations[name] = (np.inf, np.inf)
+            continue
+
+        error = np.abs(value-ref)
+        error[np.isnan(value) != np.isnan(ref)] = np.inf
+        error[np.isnan(value) & np.isnan(ref)] = 0
+
+        deviations[name] = (float(np.max(error)), float(np.max(error/(atol+rtol*np.abs(np.nan_to_num(ref))))))
+
+    return deviations
+
+
+def run_case(name, engine, tolerances, repeats=2, corpus=None):
+
+    """
+    runs engine and snicar_feeder() on the case name of the corpus (repeats
+    times each, keeping the fastest, so that imports and JIT compilation in a
+    fresh worker are not timed) and compares the engine outputs with the
+    reference outputs.
+    returns a dict of the case name, passed, the deviations
+    (compare_outputs()), the engine and reference times (s) and the speedup
+
+    """
+
+    import contextlib
+    import io
+    import time
+
+    corpus = worker_corpus if corpus is None else corpus
+    engine = ENGINES[engine] if isinstance(engine, str) else engine
+    settings = dict(corpus['cases'])[name]
+
+    def timed(function):
+        best = np.inf
+        for _ in range(repeats):
+            inputs = case_inputs(corpus['template'], settings)
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                outputs = function(inputs)
+                best = min(best, time.perf_counter()-start)
+        return outputs, best
+
+    try:
+        outputs, time_engine = timed(engine)
+        deviations = compare_outputs(collect_outputs(outputs), corpus['reference'][name], tolerances)
+        error = None
+    except Exception as exception:
+        time_engine = np.nan
+        deviations = {output: (np.inf, np.inf) for output in OUTPUTS}
+        error = repr(exception)
+
+    try:
+        time_reference = timed(ENGINES['snicar_feeder'])[1]
+    except Exception:
+        time_reference = np.nan
+
+    return dict(name=name, passed=all(ratio <= 1 for _, ratio in deviations.values()), deviations=deviations,\
+        error=error, time_engine=time_engine, time_reference=time_reference,\
+        speedup=time_reference/time_engine)
+
+
+def run_differential(engine, path=None, tolerances=None, processes=None, repeats=2, dir_base=None, cases=None):
+
+    """
+    compares engine (a name in ENGINES or a picklable function) with the
+    reference outputs of every case (or the names in cases) of the corpus at
+    path (default REFERENCE_CORPUS, built from the original engine; dir_base
+    replaces its data directory), in a process pool of processes workers (in this process if
+    processes is 1). tolerances is a dict of (atol, rtol) per output (default
+    TOLERANCES). Prints the report.
+    returns the list of case results (run_case())
+
+    """
+
+    import multiprocessing
+
+    corpus = load_corpus(path, dir_base)
+    tolerances = TOLERANCES if tolerances is None else tolerances
+    names = [name for name, _ in corpus['cases'] if cases is None or name in cases]
+    tasks = [(name, engine, tolerances, repeats) for name in names]
+
+    if processes == 1:
+        results = [run_case(*task, corpus=corpus) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes, initializer=init_differential_worker, initargs=(corpus,)) as pool:
+            results = pool.starmap(run_case, tasks, chunksize=1)
+
+    engine_name = engine if isinstance(engine, str) else engine.__name__
+
+    print("\nDIFFERENTIAL TEST OF {} ({} cases, largest deviation / tolerance)".format(engine_name, len(results)))
+    engines = corpus.get('engines', {})
+    print("reference: {}, {} cases solved by the reference solvers on the optics of this tree\n".format(\
+        corpus.get('source', 'unknown'), sum(engines.get(name) == 'solvers' for name in names)))
+    print('{:<36}{:>6}'.format('case', 'pass') + ''.join('{:>10}'.format(name) for name in OUTPUTS)\
+        + '{:>10}'.format('speedup'))
+    for r in results:
+        print('{:<36}{:>6}'.format(r['name'], 'yes' if r['passed'] else 'NO')\
+            + ''.join('{:>10.2g}'.format(r['deviations'][name][1]) for name in OUTPUTS)\
+            + '{:>10.2f}'.format(r['speedup']))
+        if r['error'] is not None:
+            print('    error: {}'.format(r['error']))
+
+    print("\nlargest absolute deviation: " + ', '.join('{} {:.2e}'.format(name,\
+        max(r['deviations'][name][0] for r in results)) for name in OUTPUTS))
+    print("{} of {} cases passed, median speedup {:.2f}".format(sum(r['passed'] for r in results), len(results),\
+        np.nanmedian([r['speedup'] for r in results])))
+
+    if corpus['skipped']:
+        print("cases skipped when the corpus was built: {}".format(', '.join(corpus['skipped'])))
+
+    return results
+
+
+def check_incremental_solver(inputs, tolerances=None):
+
+    """
+    checks adding_doubling_solver.IncrementalAddingDoubling against
+    adding_doubling_solver_batch() on a deep snow column (on top of the
+    template inputs) through a sequence of calls: the first solve, a change to
+    one layer, a change of solar zenith together with one layer, and a change
+    of zenith alone. Prints the largest deviation / tolerance of each step.
+    returns a list of (step, passed, deviations (compare_outputs()))
+
+    """
+
+    import contextlib
+    import copy
+    import io
+    from adding_doubling_solver import IncrementalAddingDoubling, adding_doubling_solver_batch
+    from raster_driver import column_template
+    from SNICAR_feeder import get_irradiance
+
+    tolerances = TOLERANCES if tolerances is None else tolerances
+
+    template = dict(vars(column_template(inputs)))
+    column = case_inputs(template, column_settings([0.02]+[0.1]*9, [300]+[400]*9, [300]+[600]*9, [0]*10,\
+        TOON=False, ADD_DOUBLE=True, solzen=50))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        prepare_optics(column)
+        irradiance = {z: get_irradiance(column, z) for z in (50, 70)}
+
+    tau, SSA, g = np.array(column.tau), np.array(column.SSA), np.array(column.g)
+    solver = IncrementalAddingDoubling(column)
+    names = ['wvl'] + OUTPUTS
+
+    results = []
+
+    for step, solzen, layer in (('first solve', 50, None), ('one layer', 50, 3), ('zenith and one layer', 70, 5),\
+        ('zenith only', 50, None)):
+
+        column.mu_not, column.flx_slr, column.Fs, column.Fd = irradiance[solzen]
+        if layer is not None:
+            tau = tau.copy()
+            tau[layer] *= 1.2
+
+        outputs = dict(zip(names, solver.solve(tau, SSA, g, column.L_snw)))
+
+        fresh = copy.copy(column)
+        fresh.tau, fresh.SSA, fresh.g = tau, SSA, g
+        reference = dict(zip(names, adding_doubling_solver_batch(fresh)))
+
+        deviations = compare_outputs(outputs, reference, tolerances)
+        results.append((step, all(ratio <= 1 for _, ratio in deviations.values()), deviations))
+
+    print("\nINCREMENTAL ADDING-DOUBLING CHECK (largest deviation / tolerance)\n")
+    print('{:<28}{:>6}'.format('step', 'pass') + ''.join('{:>10}'.format(name) for name in OUTPUTS))
+    for step, passed, deviations in results:
+        print('{:<28}{:>6}'.format(step, 'yes' if passed else 'NO')\
+            + ''.join('{:>10.2g}'.format(deviations[name][1]) for name in OUTPUTS))
+
+    return results
@@ -0,0 +1,167 @@
+"""
+Convolution of modelled spectral albedo with satellite and drone sensor bands.
+
+Each sensor band is described by its centre wavelength and full width at half
+maximum (microns) and approximated by a rectangular spectral response over
+[centre - fwhm/2, centre + fwhm/2]. response_matrix() integrates these responses
+over the bins of the model wavelength grid (the 480 band grid from 0.205 to
+4.995 um, each bin 0.01 um wide) and stores them as a sparse
+(nbr_bands, nbr_wvl) matrix whose rows sum to one. The matrices are cached per
+sensor and grid, so convolve_bands() reduces any number of spectra (e.g. the
+albedo of a whole sweep, with shape (..., nbr_wvl)) to band reflectances with a
+single sparse matrix multiply. Optional weights (e.g. the incoming spectral
+irradiance flx_slr) give irradiance weighted band reflectances.
+
+band_indices() then evaluates the spectral indices defined for the sensor in
+INDICES on the band reflectances.
+
+SENSORS holds:
+
+- 'sentinel2': Sentinel-2A MSI bands B1-B12
+- 'modis': MODIS land bands 1-7
+- 'uav': MicaSense RedEdge multispectral camera bands
+- 'narrowband': single 0.01 um bins of the model grid used by the band ratios
+  in SNICAR_driver.py (2DBA, 3DBA, NDCI, MCI and the impurity index)
+
+usage:
+
+    bands = convolve_bands(outputs.albedo, outputs.wvl, 'sentinel2')
+    indices = band_indices(bands, 'sentinel2')
+
+"""
+
+import numpy as np
+
+# {sensor: {band: (centre wavelength, full width at half maximum)}} in microns
+SENSORS = {
+
+    'sentinel2': {'B1': (0.443, 0.021), 'B2': (0.492, 0.066), 'B3': (0.560, 0.036), 'B4': (0.665, 0.031),\
+        'B5': (0.704, 0.015), 'B6': (0.740, 0.015), 'B7': (0.783, 0.020), 'B8': (0.833, 0.106),\
+        'B8A': (0.865, 0.021), 'B9': (0.945, 0.020), 'B10': (1.374, 0.031), 'B11': (1.614, 0.091),\
+        'B12': (2.202, 0.175)},
+
+    'modis': {'B1': (0.645, 0.050), 'B2': (0.8585, 0.035), 'B3': (0.469, 0.020), 'B4': (0.555, 0.020),\
+        'B5': (1.240, 0.020), 'B6': (1.640, 0.024), 'B7': (2.130, 0.050)},
+
+    'uav': {'blue': (0.475, 0.032), 'green': (0.560, 0.027), 'red': (0.668, 0.014), 'rededge': (0.717, 0.012),\
+        'nir': (0.842, 0.057)},
+
+    'narrowband': {'r565': (0.565, 0.01), 'r665': (0.665, 0.01), 'r685': (0.685, 0.01), 'r705': (0.705, 0.01),\
+        'r715': (0.715, 0.01), 'r755': (0.755, 0.01), 'r865': (0.865, 0.01)},
+}
+
+# {sensor: {index: function of the dict of band reflectances}}
+INDICES = {
+
+    'sentinel2': {
+        '2DBA': lambda b: b['B5']/b['B4'],
+        'NDCI': lambda b: (b['B5']-b['B4'])/(b['B5']+b['B4']),
+        'NDVI': lambda b: (b['B8']-b['B4'])/(b['B8']+b['B4']),
+        'NDSI': lambda b: (b['B3']-b['B11'])/(b['B3']+b['B11']),
+        'Impurity': lambda b: np.log(b['B3'])/np.log(b['B8A']),
+    },
+
+    'modis': {
+        'NDVI': lambda b: (b['B2']-b['B1'])/(b['B2']+b['B1']),
+        'NDSI': lambda b: (b['B4']-b['B6'])/(b['B4']+b['B6']),
+        'Impurity': lambda b: np.log(b['B4'])/np.log(b['B2']),
+    },
+
+    'uav': {
+        '2DBA': lambda b: b['rededge']/b['red'],
+        'NDCI': lambda b: (b['rededge']-b['red'])/(b['rededge']+b['red']),
+        'NDVI': lambda b: (b['nir']-b['red'])/(b['nir']+b['red']),
+    },
+
+    'narrowband': {
+        '2DBA': lambda b: b['r715']/b['r665'],
+        '3DBA': lambda b: (b['r665']-b['r705'])/b['r755'],
+        'NDCI': lambda b: ((b['r705']-b['r685'])-(b['r755']-b['r685']))*((b['r705']-b['r685'])/(b['r755']-b['r685'])),
+        'MCI': lambda b: (b['r705']-b['r665'])/(b['r705']+b['r665']),
+        'Impurity': lambda b: np.log(b['r565'])/np.log(b['r865']),
+    },
+}
+
+# response matrices already built: {(sensor, wavelength grid): sparse matrix}
+matrices = {}
+
+
+def response_matrix(wvl, sensor):
+
+    """
+    returns the sparse (nbr_bands, len(wvl)) matrix of the spectral responses of
+    the bands of sensor (a key of SENSORS) on the wavelength grid wvl (microns,
+    evenly spaced bin centres). Each element is the fraction of the band that
+    overlaps the wavelength bin, normalised so that each row sums to one.
+
+    """
+
+    from scipy import sparse
+
+    wvl = np.asarray(wvl, dtype=float)
+    key = (sensor, len(wvl), round(wvl[0], 6), round(wvl[-1], 6))
+
+    if key in matrices:
+        return matrices[key]
+
+    if sensor not in SENSORS:
+        raise ValueError("unknown sensor {}, choose from {}".format(sensor, list(SENSORS)))
+
+    step = (wvl[-1]-wvl[0])/(len(wvl)-1)
+    bin_lo = wvl - step/2
+    bin_hi = wvl + step/2
+
+    rows, cols, values = [], [], []
+
+    for row, (name, (centre, fwhm)) in enumerate(SENSORS[sensor].items()):
+        overlap = np.minimum(bin_hi, centre+fwhm/2) - np.maximum(bin_lo, centre-fwhm/2)
+        idx = np.nonzero(overlap > 1e-9)[0]
+
+        if len(idx) == 0:
+            raise ValueError("band {} of {} is outside the wavelength grid".format(name, sensor))
+
+        rows.extend([row]*len(idx))
+        cols.extend(idx)
+        values.extend(overlap[idx]/np.sum(overlap[idx]))
+
+    M = sparse.csr_matrix((values, (rows, cols)), shape=(len(SENSORS[sensor]), len(wvl)))
+    matrices[key] = M
+
+    return M
+
+
+def convolve_bands(albedo, wvl, sensor, weights=None):
+
+    """
+    band reflectances of sensor for albedo, which has the spectral axis last and
+    any number of leading axes (e.g. zeniths and columns of a sweep). If weights
+    (a spectrum, e.g. flx_slr) are given, each band is weighted by them as well
+    as by its spectral response.
+    returns a dict of {band: array of shape albedo.shape[:-1]}
+
+    """
+
+    albedo = np.asarray(albedo, dtype=float)
+    M = response_matrix(wvl, sensor)
+
+    if weights is not None:
+        M = M.multiply(np.asarray(weights, dtype=float)[np.newaxis, :]).tocsr()
+        M = M.multiply(1/M.sum(axis=1)).tocsr()
+
+    spectra = albedo.reshape(-1, albedo.shape[-1])
+    reflectance = np.asarray(M @ spectra.T).T.reshape(albedo.shape[:-1] + (M.shape[0],))
+
+    return {band: reflectance[..., i] for i, band in enumerate(SENSORS[sensor])}
+
+
+def band_indices(bands, sensor):
+
+    """
+    evaluates the spectral indices of sensor (INDICES) on the band reflectances
+    returned by convolve_bands()
+    returns a dict of {index: array}
+
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {name: index(bands) for name, index in INDICES[sensor].items()}
@@ -0,0 +1,256 @@
+"""
+Reduced-band spectral mode for the batched solvers.
+
+The optical property libraries and the solvers use 480 bands from 0.205 to
+4.995 um, but climate and regional model coupling usually only needs the
+broadband albedos (BBA, BBAVIS, BBANIR) and the absorbed flux. This module
+aggregates the 480 bands into a small number of contiguous coarse bands (e.g. 8,
+16 or 32) and solves the column on the coarse grid:
+
+- optimal_band_edges() places the band edges so that the irradiance weighted
+  variance of a reference albedo spectrum within each band is as small as
+  possible (by dynamic programming), always keeping edges at the visible/near
+  infrared split of both solvers so that BBAVIS and BBANIR stay defined
+- band_matrix() builds the (nbr_bands, 480) matrix of normalised irradiance
+  weights that averages a spectrum over each band
+- reduce_optical_properties() averages the mixed optical depth, single
+  scattering albedo and asymmetry parameter of the column: tau with the
+  irradiance weights, SSA weighted by tau and g weighted by tau*SSA. Mixing is
+  linear in these quantities, so this is the same as mixing band averaged
+  optical property libraries.
+- solve_reduced_bands() solves inputs (already set up on the 480 band grid, as
+  in SNICAR_feeder.snicar_feeder_multizenith()) on the coarse grid
+- build_band_set() finds the band edges for a reference column and reports the
+  broadband error against the full 480 band solve
+
+usage:
+
+    edges, errors = build_band_set(inputs, 16)
+    outputs = SNICAR_feeder.snicar_feeder_reduced_bands(inputs, edges)
+
+"""
+
+import numpy as np
+
+# last index (exclusive) of the visible bands in toon_solver() and
+# adding_doubling_solver(), which are always band edges
+VIS_MAX_IDX = {'toon': 39, 'add_double': 50}
+
+
+def optimal_band_edges(flx_slr, albedo, nbr_bands, fixed=tuple(VIS_MAX_IDX.values())):
+
+    """
+    divides the spectral grid into nbr_bands contiguous bands that minimise the
+    sum over bands of the irradiance (flx_slr) weighted variance of albedo within
+    the band. albedo can be a single spectrum or an array of reference spectra
+    with the spectral axis last, in which case the variances are summed; flx_slr
+    is a spectrum or has the same shape as albedo. No band crosses an index in
+    fixed.
+    returns the nbr_bands+1 band edges (indices into the spectral grid)
+
+    """
+
+    nbr_wvl = np.shape(albedo)[-1]
+    fixed = sorted(set(i for i in fixed if 0 < i < nbr_wvl))
+
+    if nbr_bands < len(fixed)+1:
+        raise ValueError("nbr_bands must be at least {}".format(len(fixed)+1))
+    if nbr_bands > nbr_wvl:
+        raise ValueError("nbr_bands must not exceed the number of wavelengths")
+
+    w = np.broadcast_to(np.asarray(flx_slr, dtype=float), np.shape(albedo)).reshape(-1, nbr_wvl)
+    a = np.asarray(albedo, dtype=float).reshape(-1, nbr_wvl)
+
+    # prefix sums give the weighted sum of squared deviations of any band [i, j)
+    # as sum(w a^2) - sum(w a)^2 / sum(w)
+    W = np.concatenate([np.zeros((len(w), 1)), np.cumsum(w, axis=-1)], axis=-1)
+    WA = np.concatenate([np.zeros((len(w), 1)), np.cumsum(w*a, axis=-1)], axis=-1)
+    WAA = np.concatenate([np.zeros((len(w), 1)), np.cumsum(w*a*a, axis=-1)], axis=-1)
+
+    sw = W[:, np.newaxis, :] - W[:, :, np.newaxis]
+    swa = WA[:, np.newaxis, :] - WA[:, :, np.newaxis]
+    swaa = WAA[:, np.newaxis, :] - WAA[:, :, np.newaxis]
+    cost = np.sum(swaa - np.divide(swa**2, sw, out=np.zeros(sw.shape), where=sw > 0), axis=0)
+
+    # cost[i, j] is the cost of the band [i, j): only i < j and bands that do not
+    # cross a fixed edge are allowed
+    i, j = np.indices(cost.shape)
+    allowed = i < j
+    for f in fixed:
+        allowed &= ~((i < f) & (j > f))
+    cost = np.where(allowed, np.maximum(cost, 0), np.inf)
+
+    # best[k, j]: lowest cost of dividing [0, j) into k+1 bands
+    best = np.full((nbr_bands, nbr_wvl+1), np.inf)
+    start = np.zeros((nbr_bands, nbr_wvl+1), dtype=int)
+    best[0] = cost[0]
+
+    for k in np.arange(1, nbr_bands, 1):
+        total = best[k-1][:, np.newaxis] + cost
+        start[k] = np.argmin(total, axis=0)
+        best[k] = total[start[k], np.arange(nbr_wvl+1)]
+
+    edges = [nbr_wvl]
+    for k in np.arange(nbr_bands-1, 0, -1):
+        edges.append(start[k, edges[-1]])
+    edges.append(0)
+
+    return np.array(edges[::-1])
+
+
+def band_matrix(edges, weights):
+
+    """
+    returns the (nbr_bands, nbr_wvl) matrix whose rows are the weights normalised
+    to sum to one within each band [edges[b], edges[b+1]), so that
+    band_matrix @ spectrum gives the weighted band averages. Bands with no
+    weight are averaged uniformly.
+
+    """
+
+    weights = np.asarray(weights, dtype=float)
+    nbr_wvl = len(weights)
+    band = np.searchsorted(edges, np.arange(nbr_wvl), side='right')-1
+
+    M = np.zeros((len(edges)-1, nbr_wvl))
+    M[band, np.arange(nbr_wvl)] = weights
+
+    total = np.sum(M, axis=-1, keepdims=True)
+    uniform = (total[:, 0] <= 0)
+    M[uniform] = (band[np.newaxis, :] == np.nonzero(uniform)[0][:, np.newaxis])
+    M = M/np.sum(M, axis=-1, keepdims=True)
+
+    return M
+
+
+def reduce_optical_properties(tau, SSA, g, M):
+
+    """
+    band averages of the layer optical properties (..., nbr_lyr, nbr_wvl) with
+    the band matrix M: tau is averaged with the weights, SSA with the weights
+    times tau and g with the weights times tau*SSA, which conserves the band
+    averaged extinction, scattering and forward scattering of the layer.
+    returns tau, SSA, g with shape (..., nbr_lyr, nbr_bands)
+
+    """
+
+    tau = np.asarray(tau, dtype=float)
+    scat = tau*SSA
+
+    tau_band = tau @ M.T
+    scat_band = scat @ M.T
+    asym_band = (scat*g) @ M.T
+
+    SSA_band = np.divide(scat_band, tau_band, out=np.zeros(tau_band.shape), where=tau_band > 0)
+    g_band = np.divide(asym_band, scat_band, out=np.zeros(tau_band.shape), where=scat_band > 0)
+
+    return tau_band, SSA_band, g_band
+
+
+def solve_reduced_bands(inputs, edges):
+
+    """
+    solves inputs, set up on the full spectral grid (tau, SSA, g, L_snw, Fs, Fd,
+    flx_slr and R_sfc as in SNICAR_feeder.snicar_feeder_multizenith()), on the
+    coarse bands given by edges with SNICAR_feeder.solve_batch(). The optical
+    properties, surface reflectance and refractive indices are averaged over
+    each band with the irradiance weights (averaged over the zeniths) and the
+    fluxes are summed over each band.
+
+    The outputs have the same fields as snicar_feeder(); albedo has one value
+    per band and wvl holds the irradiance weighted centre of each band. BBA,
+    BBAVIS and BBANIR are recalculated from the band albedos with the
+    visible/near infrared split of the selected solver.
+
+    """
+
+    from SNICAR_feeder import solve_batch
+
+    edges = np.asarray(edges)
+    flx_slr = np.asarray(inputs.flx_slr, dtype=float)
+    weights = flx_slr.reshape(-1, flx_slr.shape[-1]).mean(axis=0)
+
+    M = band_matrix(edges, weights)
+    S = (band_matrix(edges, np.ones(M.shape[1])) > 0).astype(float)
+
+    original = dict(tau=inputs.tau, SSA=inputs.SSA, g=inputs.g, Fs=inputs.Fs, Fd=inputs.Fd,\
+        flx_slr=inputs.flx_slr, R_sfc=inputs.R_sfc, wvl=inputs.wvl, nbr_wvl=inputs.nbr_wvl)
+
+    try:
+        inputs.tau, inputs.SSA, inputs.g = reduce_optical_properties(inputs.tau, inputs.SSA, inputs.g, M)
+        inputs.Fs = np.asarray(inputs.Fs, dtype=float) @ S.T
+        inputs.Fd = np.asarray(inputs.Fd, dtype=float) @ S.T
+        inputs.flx_slr = flx_slr @ S.T
+        inputs.R_sfc = M @ (np.asarray(inputs.R_sfc, dtype=float)*np.ones(M.shape[1]))
+        inputs.wvl = M @ np.asarray(original['wvl'], dtype=float)
+        inputs.nbr_wvl = len(edges)-1
+        inputs.band_matrix = M
+
+        # the solvers' own BBAVIS and BBANIR assume the 480 band grid and are
+        # recalculated below
+        with np.errstate(divide='ignore', invalid='ignore'):
+            outputs = solve_batch(inputs)
+
+        band_flx = inputs.flx_slr
+
+    finally:
+        for name, value in original.items():
+            setattr(inputs, name, value)
+        del inputs.band_matrix
+
+    vis_max_idx = np.searchsorted(edges, VIS_MAX_IDX['toon' if inputs.TOON else 'add_double'])
+    albedo = np.asarray(outputs.albedo)
+    band_flx = band_flx.reshape(band_flx.shape[:-1] + (1,)*(albedo.ndim-band_flx.ndim) + band_flx.shape[-1:])
+
+    outputs.BBA = np.sum(band_flx*albedo, axis=-1) / np.sum(band_flx, axis=-1)
+    outputs.BBAVIS = np.sum(band_flx[..., :vis_max_idx]*albedo[..., :vis_max_idx], axis=-1)\
+        / np.sum(band_flx[..., :vis_max_idx], axis=-1)
+    outputs.BBANIR = np.sum(band_flx[..., vis_max_idx:]*albedo[..., vis_max_idx:], axis=-1)\
+        / np.sum(band_flx[..., vis_max_idx:], axis=-1)
+
+    return outputs
+
+
+def broadband_errors(full, reduced):
+
+    """
+    returns a dict of the maximum absolute difference in BBA, BBAVIS, BBANIR,
+    total absorbed flux (W m-2) and heating rate (K hr-1) between the outputs of a
+    full and a reduced band solve
+
+    """
+
+    errors = {}
+    for field in ('BBA', 'BBAVIS', 'BBANIR'):
+        errors[field] = float(np.max(np.abs(np.asarray(getattr(full, field)) - np.asarray(getattr(reduced, field)))))
+
+    errors['abs_slr'] = float(np.max(np.abs(np.sum(full.abs_slr, axis=-1) - np.sum(reduced.abs_slr, axis=-1))))
+    errors['heat_rt'] = float(np.max(np.abs(np.asarray(full.heat_rt) - np.asarray(reduced.heat_rt))))
+
+    return errors
+
+
+def build_band_set(inputs, nbr_bands):
+
+    """
+    finds the nbr_bands band edges for the reference column described by inputs
+    (set up as for SNICAR_feeder.snicar_feeder_multizenith(); solzen may be a
+    list, and the variances of all zeniths are summed) and reports the broadband
+    error of the reduced solve against the full 480 band solve.
+    returns edges, errors (see broadband_errors())
+
+    """
+
+    from SNICAR_feeder import snicar_feeder_multizenith
+
+    full = snicar_feeder_multizenith(inputs)
+
+    edges = optimal_band_edges(inputs.flx_slr, full.albedo, nbr_bands)
+    reduced = solve_reduced_bands(inputs, edges)
+
+    errors = broadband_errors(full, reduced)
+
+    print("{} bands: BBA error {:.1e}, BBAVIS error {:.1e}, BBANIR error {:.1e}, absorbed flux error {:.1e} W m-2"\
+        .format(nbr_bands, errors['BBA'], errors['BBAVIS'], errors['BBANIR'], errors['abs_slr']))
+
+    return edges, errors
@@ -0,0 +1,285 @@
+"""
+Memory-mapped library of modelled albedo spectra with a nearest-neighbour index.
+
+Matching field spectra to model runs by running SNICAR for every observed
+spectrum is slow. This module precomputes the 480-band albedo of a sweep of the
+parameterisation columns (a 1 mm surface layer with glacier algae above a
+weathering crust of thickness dz, built as in raster_driver.pixel_optics()) once
+and matches observed spectra against it in batches.
+
+build_spectral_library() solves the sweep with the batched solvers and writes
+it to a directory of .npy files, one batch of columns at a time:
+
+- albedo.npy   spectra (rows, nbr_wvl), float32
+- params.npy   generating parameters (rows, 4): density, dz, zenith, algae
+- wvl.npy      wavelengths (microns)
+- mean.npy, components.npy, scores.npy   the principal components of the
+  spectra (from a covariance accumulated over chunks of rows) and the scores
+  of every row
+
+SpectralLibrary(path) memory-maps the spectra, so only the rows that are
+compared are read from disk, and builds a KD-tree (scipy.spatial.cKDTree) of the
+PCA scores. query() projects a batch of observed spectra onto the components,
+takes the nearest candidates of each from the tree, ranks them by the RMSE of
+the full spectra (over the bands that are finite in every observed spectrum)
+and returns the k best matches and their parameters interpolated with
+inverse-distance weights. If the solar zenith of the observations is known,
+only library rows at the nearest library zenith are searched.
+
+Rows whose albedo leaves [0, 1] (ill-conditioned Toon solutions) are stored but
+left out of the index.
+
+usage:
+
+    build_spectral_library(inputs, 'spectral_library/')
+    library = SpectralLibrary('spectral_library/')
+    matches = library.query(observed_spectra, k=8, zenith=50)
+    matches.estimate      # (spectra, 4) interpolated density, dz, zenith, algae
+
+"""
+
+import collections
+import os
+import numpy as np
+
+PARAMETERS = ('density', 'dz', 'zenith', 'algae')
+
+
+def build_spectral_library(inputs, path, densities=tuple(range(400, 901, 10)),\
+    dzs=tuple(np.geomspace(0.05, 1, 20)), algs=tuple(range(0, 20001, 1000)), zeniths=tuple(range(30, 81, 5)),\
+    nbr_components=10, batch_size=500):
+
+    """
+    solves every combination of densities (multiples of 5 kg m-3, to match the
+    bubbly ice files), dzs, algs and zeniths (whole degrees) with the solver and
+    settings of inputs and writes the library to the directory path (see the
+    module docstring). Rows are ordered by density, dz, algae and then zenith.
+    returns the number of rows
+
+    """
+
+    import contextlib
+    import io
+    import itertools
+    from emulator import solve_columns
+    from raster_driver import column_template
+    from SNICAR_feeder import get_wavelengths, get_irradiance_batch
+
+    os.makedirs(path, exist_ok=True)
+
+    inputs = column_template(inputs)
+    inputs.wvl = get_wavelengths(inputs)
+    inputs.nbr_wvl = len(inputs.wvl)
+    inputs.solzen = [int(z) for z in zeniths]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_batch(inputs)
+
+    columns = np.array(list(itertools.product(densities, dzs, algs)), dtype=float)
+    nbr_zen = len(inputs.solzen)
+    nbr_rows = len(columns)*nbr_zen
+
+    albedo = np.lib.format.open_memmap(os.path.join(path, 'albedo.npy'), mode='w+', dtype=np.float32,\
+        shape=(nbr_rows, inputs.nbr_wvl))
+
+    params = np.empty((nbr_rows, len(PARAMETERS)))
+    params[:, 0] = np.repeat(columns[:, 0], nbr_zen)
+    params[:, 1] = np.repeat(columns[:, 1], nbr_zen)
+    params[:, 2] = np.tile(np.array(inputs.solzen, dtype=float), len(columns))
+    params[:, 3] = np.repeat(columns[:, 2], nbr_zen)
+
+    for start in np.arange(0, len(columns), batch_size):
+
+        batch = columns[start:start+batch_size]
+        spectra = solve_columns(inputs, batch[:, 0], batch[:, 1], batch[:, 2])
+
+        # (zeniths, columns, nbr_wvl) -> rows ordered by column, then zenith
+        albedo[start*nbr_zen:(start+len(batch))*nbr_zen] = np.swapaxes(spectra, 0, 1).reshape(-1, inputs.nbr_wvl)
+
+    albedo.flush()
+    del albedo
+
+    np.save(os.path.join(path, 'params.npy'), params)
+    np.save(os.path.join(path, 'wvl.npy'), inputs.wvl)
+
+    build_index(path, nbr_components)
+
+    return nbr_rows
+
+
+def build_index(path, nbr_components=10, chunk_rows=100000):
+
+    """
+    principal components of the spectra of the library at path, from the mean
+    and covariance accumulated over chunks of chunk_rows rows, and the scores of
+    every row. Writes mean.npy, components.npy and scores.npy.
+
+    """
+
+    albedo = np.load(os.path.join(path, 'albedo.npy'), mmap_mode='r')
+    nbr_rows, nbr_wvl = albedo.shape
+
+    total = np.zeros(nbr_wvl)
+    products = np.zeros((nbr_wvl, nbr_wvl))
+
+    for start in np.arange(0, nbr_rows, chunk_rows):
+        chunk = np.asarray(albedo[start:start+chunk_rows], dtype=float)
+        total += chunk.sum(axis=0)
+        products += chunk.T @ chunk
+
+    mean = total/nbr_rows
+    covariance = products/nbr_rows - np.outer(mean, mean)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    components = eigenvectors[:, ::-1][:, :nbr_components].T
+
+    explained = np.sum(eigenvalues[::-1][:nbr_components]) / np.sum(eigenvalues)
+    print("{} components explain {:.6f} of the spectral variance".format(nbr_components, explained))
+
+    scores = np.lib.format.open_memmap(os.path.join(path, 'scores.npy'), mode='w+', dtype=np.float32,\
+        shape=(nbr_rows, nbr_components))
+
+    for start in np.arange(0, nbr_rows, chunk_rows):
+        scores[start:start+chunk_rows] = (np.asarray(albedo[start:start+chunk_rows], dtype=float)-mean) @ components.T
+
+    scores.flush()
+
+    np.save(os.path.join(path, 'mean.npy'), mean)
+    np.save(os.path.join(path, 'components.npy'), components)
+
+    return
+
+
+class SpectralLibrary:
+
+    """
+    a library written by build_spectral_library(), with the spectra
+    memory-mapped and KD-trees of the PCA scores built on first use (one for
+    the whole library and one per library zenith)
+
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.albedo = np.load(os.path.join(path, 'albedo.npy'), mmap_mode='r')
+        self.params = np.load(os.path.join(path, 'params.npy'))
+        self.wvl = np.load(os.path.join(path, 'wvl.npy'))
+        self.mean = np.load(os.path.join(path, 'mean.npy'))
+        self.components = np.load(os.path.join(path, 'components.npy'))
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+        self.zeniths = np.unique(self.params[:, 2])
+        self.trees = {}
+
+
+    def tree(self, zenith=None):
+
+        """
+        returns the KD-tree of the well-conditioned rows at zenith (all rows if
+        None) and the library row of each point of the tree
+
+        """
+
+        if zenith not in self.trees:
+
+            from scipy.spatial import cKDTree
+
+            rows = np.arange(len(self.params)) if zenith is None else np.nonzero(self.params[:, 2] == zenith)[0]
+
+            scores = np.asarray(self.scores[rows], dtype=float)
+            valid = np.ones(len(rows), dtype=bool)
+            for start in np.arange(0, len(rows), 100000):
+                chunk = self.albedo[rows[start:start+100000]]
+                valid[start:start+100000] = np.all((chunk >= 0) & (chunk <= 1), axis=-1)
+
+            self.trees[zenith] = (cKDTree(scores[valid]), rows[valid])
+
+        return self.trees[zenith]
+
+
+    def project(self, spectra, bands):
+
+        """
+        PCA scores of spectra (n, nbr_wvl) using only the given bands (least
+        squares on the components restricted to those bands)
+
+        """
+
+        anomaly = spectra[:, bands] - self.mean[bands]
+
+        if np.all(bands):
+            return anomaly @ self.components.T
+
+        return np.linalg.lstsq(self.components[:, bands].T, anomaly.T, rcond=None)[0].T
+
+
+    def query(self, spectra, k=8, zenith=None, candidates=None, bands=None, chunk_size=1000):
+
+        """
+        spectra:    observed albedo spectra (n, nbr_wvl) on the library
+                    wavelengths. Bands that are not finite in every spectrum
+                    (e.g. removed water vapour bands) are ignored.
+        k:          number of matches returned per spectrum
+        zenith:     optional solar zenith of the observations (scalar or one
+                    per spectrum); only rows at the nearest library zenith are
+                    searched
+        candidates: number of nearest neighbours in PCA space that are ranked
+                    by their full spectra (default 4 * k)
+        bands:      optional boolean mask of the bands to compare
+
+        returns a namedtuple of the library rows (n, k) of the matches, their
+        spectral RMSE (n, k) and parameters (n, k, 4), and the estimate (n, 4)
+        of density, dz, zenith and algae interpolated from the matches with
+        inverse squared RMSE weights
+
+        """
+
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+        nbr_spectra = len(spectra)
+        candidates = min(4*k if candidates is None else max(candidates, k), len(self.params))
+
+        valid_bands = np.all(np.isfinite(spectra), axis=0)
+        if bands is not None:
+            valid_bands &= np.asarray(bands, dtype=bool)
+
+        index = np.empty((nbr_spectra, k), dtype=int)
+        rmse = np.empty((nbr_spectra, k))
+
+        if zenith is None:
+            groups = {None: np.arange(nbr_spectra)}
+        else:
+            nearest = self.zeniths[np.argmin(np.abs(np.subtract.outer(np.broadcast_to(zenith, (nbr_spectra,)),\
+                self.zeniths)), axis=-1)]
+            groups = {z: np.nonzero(nearest == z)[0] for z in np.unique(nearest)}
+
+        for zen, members in groups.items():
+
+            tree, rows = self.tree(zen)
+            nbr_candidates = min(candidates, len(rows))
+
+            for start in np.arange(0, len(members), chunk_size):
+
+                chunk = members[start:start+chunk_size]
+                observed = spectra[chunk][:, valid_bands]
+
+                neighbours = tree.query(self.project(spectra[chunk], valid_bands), k=nbr_candidates)[1]
+                neighbours = rows[np.reshape(neighbours, (len(chunk), nbr_candidates))]
+
+                # read each candidate row once, in file order
+                unique, inverse = np.unique(neighbours, return_inverse=True)
+                library = np.asarray(self.albedo[unique][:, valid_bands], dtype=float)[inverse.reshape(neighbours.shape)]
+
+                error = np.sqrt(np.mean((library - observed[:, np.newaxis, :])**2, axis=-1))
+                best = np.argsort(error, axis=-1)[:, :k]
+
+                index[chunk] = np.take_along_axis(neighbours, best, axis=-1)
+                rmse[chunk] = np.take_along_axis(error, best, axis=-1)
+
+        params = self.params[index]
+
+        # inverse squared RMSE weights; an exact match takes all the weight
+        weights = 1/np.maximum(rmse, 1e-12)**2
+        estimate = np.sum(weights[..., np.newaxis]*params, axis=1) / np.sum(weights, axis=1)[:, np.newaxis]
+
+        matches = collections.namedtuple('matches', ['index', 'rmse', 'params', 'estimate'])
+
+        return matches(index, rmse, params, estimate)
@@ -0,0 +1,186 @@
+"""
+Out-of-core least-squares fit of the parameterisation.
+
+regression_single_layer() reads the whole training set into memory and fits it
+with statsmodels, which limits the size of the sweep. This module fits the same
+kind of linear model while reading the training set a chunk of rows at a time,
+so memory use depends on the chunk size and the number of model terms, not on
+the number of rows.
+
+The fit keeps the triangular factor R of the QR decomposition of the augmented
+design matrix [X y]. Each chunk of rows is stacked under the current R and
+the stack is reduced back to a triangle with a QR decomposition. R has
+(terms + 1) x (terms + 1) entries, and its last column holds Q'y and the
+residual sum of squares. Unlike normal equations, this does not square the
+condition number of the design matrix. The columns of the design matrix are
+also scaled by their largest magnitude in the first chunk, because the powers
+of predictors as different in scale as dz (m) and algae (ppb) span many orders
+of magnitude. The coefficients then agree with an in-memory least-squares fit
+to rounding error, also for high-degree polynomials.
+
+Model terms use the format of ParameterisationRuntime.py ("const", "density",
+"density*dz", "algae^2", ...), and polynomial_terms() builds the full set of
+powers and interactions up to a given degree. The fitted coefficients are
+returned as a {term: coefficient} dict that ParameterisationRuntime.predict()
+evaluates directly and save_coefficients() writes to file.
+
+usage:
+
+    fit = fit_streaming('snicar_data_single_layer.csv', 'BBA', degree=2)
+    save_coefficients(fit.params.keys(), fit.params.values(), 'parameterisation_coefs_BBA.csv')
+
+"""
+
+import collections
+import numpy as np
+from ParameterisationRuntime import PREDICTORS, evaluate_term
+
+
+def polynomial_terms(predictors=PREDICTORS, degree=1, interactions=True):
+
+    """
+    returns the model terms of a polynomial of the given degree in predictors:
+    the constant, then every power of each predictor up to degree and (if
+    interactions is True) every product of predictors whose total degree is at
+    most degree, ordered by total degree. Degree 1 gives the terms of the
+    current linear parameterisation.
+
+    """
+
+    import itertools
+
+    terms = ['const']
+
+    for total in np.arange(1, degree+1, 1):
+        for combination in itertools.combinations_with_replacement(predictors, total):
+
+            counts = collections.Counter(combination)
+
+            if len(counts) > 1 and not interactions:
+                continue
+
+            factors = [name if counts[name] == 1 else '{}^{}'.format(name, counts[name])\
+                for name in predictors if name in counts]
+            terms.append('*'.join(factors))
+
+    return terms
+
+
+def design_matrix(terms, variables):
+
+    """
+    returns the (rows, len(terms)) design matrix of terms for the predictor
+    arrays in variables ({predictor: array})
+
+    """
+
+    rows = len(next(iter(variables.values())))
+
+    return np.column_stack([np.broadcast_to(evaluate_term(term, variables), (rows,)) for term in terms])
+
+
+class StreamingLeastSquares:
+
+    """
+    least-squares fit accumulated over chunks of rows with update(), keeping
+    only the (terms+1, terms+1) triangular factor of the augmented design
+    matrix, the row count and the sum and sum of squares of the response.
+    scale (one value per term) divides the columns of the design matrix; by
+    default it is the largest magnitude of each column in the first chunk.
+
+    """
+
+    def __init__(self, terms, scale=None):
+
+        self.terms = list(terms)
+        self.scale = None if scale is None else np.asarray(scale, dtype=float)
+        self.R = np.zeros((0, len(self.terms)+1))
+        self.nobs = 0
+        self.y_sum = 0.0
+        self.y_sumsq = 0.0
+
+
+    def update(self, X, y):
+
+        """
+        adds the rows of the design matrix X and the response y
+
+        """
+
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        if self.scale is None:
+            self.scale = np.max(np.abs(X), axis=0)
+            self.scale[self.scale == 0] = 1
+
+        stacked = np.vstack([self.R, np.column_stack([X/self.scale, y])])
+        self.R = np.linalg.qr(stacked, mode='r')
+
+        self.nobs += len(y)
+        self.y_sum += float(np.sum(y))
+        self.y_sumsq += float(np.sum(y**2))
+
+        return
+
+
+    def solve(self):
+
+        """
+        returns the coefficients (in the order of terms), the residual sum of
+        squares and r^2 of the rows added so far
+
+        """
+
+        p = len(self.terms)
+        R = np.zeros((p+1, p+1))
+        R[:len(self.R)] = self.R[:p+1]
+
+        coefs = np.linalg.lstsq(R[:p, :p], R[:p, p], rcond=None)[0]
+        rss = R[p, p]**2
+        tss = self.y_sumsq - self.y_sum**2/self.nobs
+
+        return coefs/self.scale, rss, 1 - rss/tss
+
+
+def read_chunks(path, columns, chunksize=1000000):
+
+    """
+    yields dicts of {column: array} of chunksize rows of the csv file at path
+    (e.g. the output of generate_snicar_dataset_single_layer())
+
+    """
+
+    import pandas as pd
+
+    for chunk in pd.read_csv(path, usecols=list(columns), chunksize=chunksize):
+        yield {name: chunk[name].to_numpy(dtype=float) for name in columns}
+
+
+def fit_streaming(source, var, degree=1, interactions=True, terms=None, chunksize=1000000):
+
+    """
+    fits var (BBA or abs) as a polynomial of the predictors, reading the
+    training set one chunk at a time. source is the path of a csv training set
+    or an iterable of dicts of {column: array} (e.g. chunks of a larger sweep
+    store). terms defaults to polynomial_terms(degree=degree,
+    interactions=interactions).
+    returns a namedtuple with params ({term: coefficient}), rsquared, rss and nobs
+
+    """
+
+    terms = polynomial_terms(PREDICTORS, degree, interactions) if terms is None else list(terms)
+    chunks = read_chunks(source, PREDICTORS + (var,), chunksize) if isinstance(source, str) else source
+
+    model = StreamingLeastSquares(terms)
+
+    for chunk in chunks:
+        model.update(design_matrix(terms, {name: chunk[name] for name in PREDICTORS}), chunk[var])
+
+    coefs, rss, rsquared = model.solve()
+
+    fit = collections.namedtuple('fit', ['params', 'rsquared', 'rss', 'nobs'])
+
+    print(f"{var} r^2 value = {np.round(rsquared, 4)} ({model.nobs} rows, {len(terms)} terms)")
+
+    return fit(dict(zip(terms, coefs)), rsquared, rss, model.nobs)
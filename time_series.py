@@ -0,0 +1,154 @@
+"""
+Diurnal and seasonal time series of absorbed solar energy.
+
+The parameterisation is trained at fixed solar zeniths, but surface energy
+balance models need the solar energy absorbed by the ice column integrated over
+the daily solar cycle. snicar_time_series() takes a latitude and longitude, a
+sequence of time steps and the state of the column at each time step, and:
+
+- calculates the solar zenith of every time step (solar_zenith())
+- groups the daylight time steps by column state, so the optical properties
+  of each state are calculated once
+- solves every distinct zenith of a state in one call to the batched solvers,
+  which share the zenith independent terms between zeniths; repeated zeniths
+  (e.g. the same hour on several days) are only solved once
+- interpolates the surface irradiance between the whole degree SZA files
+  (SNICAR_feeder.get_irradiance_interpolated())
+- integrates the absorbed flux and heating rate of each layer over each day
+
+Time steps with the sun below the horizon absorb nothing and are not solved.
+
+usage:
+
+    times = np.arange('2021-07-01', '2021-07-08', np.timedelta64(30, 'm'), dtype='datetime64[m]')
+    series = snicar_time_series([inputs], latitude=67.0, longitude=-49.0, times=times)
+    series.daily_abs    # (days, layers) J m-2
+
+"""
+
+import numpy as np
+
+
+def solar_zenith(latitude, longitude, times):
+
+    """
+    solar zenith angle (degrees) at latitude and longitude (degrees, east
+    positive) for times (numpy datetime64, UTC), from the NOAA approximations
+    of the solar declination and equation of time (Spencer 1971)
+
+    """
+
+    times = np.asarray(times, dtype='datetime64[s]')
+    days = times.astype('datetime64[D]')
+    doy = (days - days.astype('datetime64[Y]')).astype(int) + 1
+    hours = (times - days) / np.timedelta64(1, 'h')
+
+    # fractional year (radians)
+    gamma = 2*np.pi/365 * (doy - 1 + (hours-12)/24)
+
+    decl = 0.006918 - 0.399912*np.cos(gamma) + 0.070257*np.sin(gamma) - 0.006758*np.cos(2*gamma)\
+        + 0.000907*np.sin(2*gamma) - 0.002697*np.cos(3*gamma) + 0.00148*np.sin(3*gamma)
+
+    eqtime = 229.18*(0.000075 + 0.001868*np.cos(gamma) - 0.032077*np.sin(gamma) - 0.014615*np.cos(2*gamma)\
+        - 0.040849*np.sin(2*gamma))
+
+    # true solar time (minutes) and hour angle (radians)
+    solar_time = hours*60 + eqtime + 4*longitude
+    hour_angle = np.radians(solar_time/4 - 180)
+
+    lat = np.radians(latitude)
+    cos_zen = np.sin(lat)*np.sin(decl) + np.cos(lat)*np.cos(decl)*np.cos(hour_angle)
+
+    return np.degrees(np.arccos(np.clip(cos_zen, -1, 1)))
+
+
+def time_step_durations(times):
+
+    """
+    duration (s) represented by each time step: half the interval to the
+    previous step plus half the interval to the next (the full interval at
+    either end)
+
+    """
+
+    seconds = (np.asarray(times, dtype='datetime64[s]') - np.datetime64(0, 's')).astype(float)
+
+    if len(seconds) < 2:
+        return np.full(len(seconds), 3600.0)
+
+    return np.gradient(seconds)
+
+
+def snicar_time_series(columns, latitude, longitude, times, state=None):
+
+    """
+    runs snicar for every time step in times (numpy datetime64, UTC) at the
+    given latitude and longitude. columns is a list of inputs, one per column
+    state, each set up as for snicar_feeder() (inputs.solzen is ignored), and
+    state gives the index into columns of the state at each time step (all
+    time steps use columns[0] if state is None). Each column is solved on a copy
+    (raster_driver.column_template()), so the columns are left unchanged.
+
+    returns a namedtuple with
+        times, solzen: the time steps and their solar zeniths (degrees)
+        BBA: broadband albedo of each time step (nan at night)
+        abs_slr: absorbed flux of each layer at each time step (W m-2)
+        heat_rt: heating rate of each layer at each time step (K hr-1)
+        days: the days covered by times
+        daily_abs: energy absorbed by each layer on each day (J m-2)
+        daily_heating: temperature change of each layer from absorbed solar
+            energy on each day (K), ignoring conduction and melt
+
+    """
+
+    import collections as c
+    from raster_driver import column_template
+    from SNICAR_feeder import get_wavelengths, get_irradiance_interpolated, get_ice_optics,\
+        get_impurity_optics, mix_optical_properties, solve_batch
+
+    times = np.asarray(times, dtype='datetime64[s]')
+    state = np.zeros(len(times), dtype=int) if state is None else np.asarray(state, dtype=int)
+
+    solzen = solar_zenith(latitude, longitude, times)
+    daylight = solzen < 90
+
+    nbr_lyr = columns[0].nbr_lyr
+    BBA = np.full(len(times), np.nan)
+    abs_slr = np.zeros((len(times), nbr_lyr))
+    heat_rt = np.zeros((len(times), nbr_lyr))
+
+    for s in np.unique(state[daylight]):
+
+        inputs = column_template(columns[s])
+        steps = np.nonzero(daylight & (state == s))[0]
+
+        # each distinct zenith is solved once
+        zeniths, solve_idx = np.unique(np.minimum(solzen[steps], 89), return_inverse=True)
+
+        inputs.wvl = get_wavelengths(inputs)
+        inputs.nbr_wvl = len(inputs.wvl)
+        inputs.mu_not, inputs.flx_slr, inputs.Fs, inputs.Fd = get_irradiance_interpolated(inputs, zeniths)
+
+        SSA_snw, MAC_snw, g_snw = get_ice_optics(inputs)
+        SSAaer, MACaer, Gaer, MSSaer = get_impurity_optics(inputs)
+        inputs.tau, inputs.SSA, inputs.g, inputs.L_snw =\
+            mix_optical_properties(inputs, SSA_snw, MAC_snw, g_snw, SSAaer, MACaer, Gaer, MSSaer)
+
+        outputs = solve_batch(inputs)
+
+        BBA[steps] = np.asarray(outputs.BBA)[solve_idx]
+        abs_slr[steps] = np.asarray(outputs.abs_slr)[solve_idx]
+        heat_rt[steps] = np.asarray(outputs.heat_rt)[solve_idx]
+
+    dt = time_step_durations(times)
+    step_days = times.astype('datetime64[D]')
+    days, day_idx = np.unique(step_days, return_inverse=True)
+
+    daily_abs = np.zeros((len(days), nbr_lyr))
+    daily_heating = np.zeros((len(days), nbr_lyr))
+    np.add.at(daily_abs, day_idx, abs_slr*dt[:, np.newaxis])
+    np.add.at(daily_heating, day_idx, heat_rt*dt[:, np.newaxis]/3600)
+
+    series = c.namedtuple('series', ['times', 'solzen', 'BBA', 'abs_slr', 'heat_rt', 'days', 'daily_abs', 'daily_heating'])
+
+    return series(times, solzen, BBA, abs_slr, heat_rt, days, daily_abs, daily_heating)
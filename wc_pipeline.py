@@ -0,0 +1,108 @@
+"""
+Streaming pipeline from weathering crust (WC) model output to parameterised albedo.
+
+The WC model writes depth-resolved densities for every grid cell and time step.
+This module reads those fields one chunk at a time, collapses each column to a
+single layer using density_transformer_grid(), and evaluates the saved BBA and
+abs parameterisations (ParameterisationRuntime.py) for the chunk before writing
+the results back out. Only one chunk is held in memory at a time, so full ice
+sheet time series can be processed regardless of their size.
+
+run_wc_pipeline() works with any sliceable array-like for the inputs and outputs
+(numpy arrays, np.memmap, netCDF4 variables etc). run_wc_pipeline_netcdf() is a
+convenience wrapper that reads from and writes to NetCDF files.
+
+"""
+
+import numpy as np
+from density_transformer import density_transformer_grid
+from ParameterisationRuntime import load_coefficients, predict
+
+
+def run_wc_pipeline(thickness, density, algae, zenith, coefs_BBA, coefs_abs,\
+    out_BBA, out_abs, chunk_size=100000):
+
+    """
+    thickness:  layer thicknesses (m), shape (levels) or (time, cells, levels)
+    density:    layer densities (kg m-3), shape (time, cells, levels)
+    algae:      surface algal concentration (ppb), shape (time, cells)
+    zenith:     solar zenith angle (degrees), scalar or shape (time) or (time, cells)
+    coefs_BBA, coefs_abs: coefficients from ParameterisationRuntime.load_coefficients()
+    out_BBA, out_abs:     writable array-likes of shape (time, cells)
+    chunk_size: number of grid cells processed at once
+
+    Cells without any porous ice (all densities > 915) have no WC, so their
+    outputs are set to NaN.
+
+    """
+
+    ntime, ncells = density.shape[0], density.shape[1]
+    thickness_per_step = np.ndim(thickness) == 3
+    zenith_ndim = np.ndim(zenith)
+
+    for t in range(ntime):
+
+        for start in np.arange(0, ncells, chunk_size):
+
+            cells = slice(start, min(start + chunk_size, ncells))
+
+            if thickness_per_step:
+                thick_chunk = np.asarray(thickness[t, cells])
+            else:
+                thick_chunk = np.asarray(thickness)
+
+            dens, dz = density_transformer_grid(thick_chunk, np.asarray(density[t, cells]))
+            alg = np.asarray(algae[t, cells])
+
+            if zenith_ndim == 0:
+                zen = zenith
+            elif zenith_ndim == 1:
+                zen = zenith[t]
+            else:
+                zen = np.asarray(zenith[t, cells])
+
+            out_BBA[t, cells] = predict(coefs_BBA, dens, dz, zen, alg)
+            out_abs[t, cells] = predict(coefs_abs, dens, dz, zen, alg)
+
+    return
+
+
+def run_wc_pipeline_netcdf(path_in, path_out, path_coefs_BBA, path_coefs_abs,\
+    chunk_size=100000):
+
+    """
+    reads the variables thickness, density, algae and zenith from the WC model
+    NetCDF file at path_in and writes BBA and abs fields of shape (time, cell)
+    to a new NetCDF file at path_out, one chunk at a time.
+
+    density must have dimensions (time, cell, level), algae (time, cell),
+    thickness (level) or (time, cell, level) and zenith () (time) or (time, cell).
+
+    """
+
+    import netCDF4
+
+    coefs_BBA = load_coefficients(path_coefs_BBA)
+    coefs_abs = load_coefficients(path_coefs_abs)
+
+    with netCDF4.Dataset(path_in) as src, netCDF4.Dataset(path_out, 'w') as dst:
+
+        density = src['density']
+        time_dim, cell_dim = density.dimensions[0], density.dimensions[1]
+
+        dst.createDimension(time_dim, density.shape[0])
+        dst.createDimension(cell_dim, density.shape[1])
+        out_BBA = dst.createVariable('BBA', 'f8', (time_dim, cell_dim), fill_value=np.nan)
+        out_abs = dst.createVariable('abs', 'f8', (time_dim, cell_dim), fill_value=np.nan)
+        out_BBA.long_name = 'parameterised broadband albedo'
+        out_abs.long_name = 'parameterised energy absorbed in the surface layer'
+        out_abs.units = 'W m-2'
+
+        zenith = src['zenith']
+        if zenith.ndim < 2:
+            zenith = zenith[...]
+
+        run_wc_pipeline(src['thickness'], density, src['algae'], zenith,\
+            coefs_BBA, coefs_abs, out_BBA, out_abs, chunk_size=chunk_size)
+
+    return